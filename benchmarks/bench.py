@@ -0,0 +1,322 @@
+"""
+Benchmarks of tumorevo's hot paths, over a range of sizes.
+
+    python benchmarks/bench.py -o bench.json --baseline benchmarks/baseline.json
+
+times every benchmark at each of its sizes and writes the results to a JSON
+file. The time of a case is the best of `--repeats` runs, each of which
+calls the benchmarked code enough times to take a few hundredths of a second.
+For each benchmark, the slope of log(time) against log(size) gives how it
+scales with its size parameter (0 for constant, 1 for linear).
+
+Given a baseline written by an earlier run, every case that got slower than
+`--tolerance` times its baseline is reported and the script exits with an
+error. Baselines only make sense on the machine they were measured on.
+"""
+from tumorevo.tumorsample.main import CellSNVs
+from tumorevo.tumorsim.cell import CancerCell
+from tumorevo.tumorsim.parallel import CheckerboardScheduler
+from tumorevo.tumorsim.rng import RandomStreams
+from tumorevo.tumorsim.selection import Selection
+from tumorevo.tumorsim.tumor import Tumor
+
+import numpy as np
+import pandas as pd
+
+import atexit
+import click
+import json
+import platform
+import time
+
+BENCHMARKS = dict()
+
+MIN_RUN_TIME = 0.05 # seconds per repeat, at least
+
+
+def benchmark(scale, *cases):
+    """Register a benchmark. Its function takes the parameters of a case and
+    returns the code to time as a function without arguments. `scale` names
+    the parameter that the scaling curve is measured against."""
+    def register(func):
+        BENCHMARKS[func.__name__] = (func, scale, cases)
+        return func
+    return register
+
+
+def make_cancer_cell(n_segments=10, segment_size=100, seed=0):
+    return CancerCell(n_segments=n_segments, segment_size=segment_size, division_rate=0.2, death_rate=0.1,
+                      mutation_rate=0.01, dispersal_rate=0.1, seed=seed)
+
+
+def make_tumor(grid_size, n_cells, n_clones=50, carrying_capacity=10, n_segments=10, segment_size=100, seed=0):
+    """Tumor with `n_cells` cancer cells of `n_clones` clones, filling the
+    demes closest to the centre of the grid up to their carrying capacity."""
+    streams = RandomStreams(seed)
+    cancer_cell = make_cancer_cell(n_segments, segment_size, seed)
+    selection = Selection(n_segments=n_segments, segment_size=segment_size, rng=streams.get("selection"))
+    tumor = Tumor(cancer_cell, selection, grid_size=grid_size, deme_params=dict(carrying_capacity=carrying_capacity), streams=streams)
+    store = tumor.cells
+    center = int(grid_size / 2)
+    center_deme = tumor.get_deme(center, center)
+
+    # Mutated daughters of the first cell make the clones
+    rng = streams.get("mutation")
+    for _ in range(n_clones - 1):
+        new_cell = store.get_cell(store.members[center_deme.index][0]).divide()
+        new_cell.set_params()
+        new_cell.mutate(rng, selection.update_dict)
+        center_deme.add_cell(new_cell)
+    clones = store.members[center_deme.index][: store.deme_size[center_deme.index]].copy()
+
+    rows, cols = np.divmod(np.arange(tumor.n_demes), grid_size)
+    order = np.argsort((rows - center) ** 2 + (cols - center) ** 2, kind="stable")
+    remaining = n_cells - len(clones)
+    for deme in order.tolist():
+        if remaining <= 0:
+            break
+        k = min(carrying_capacity - int(store.deme_size[deme]), remaining)
+        if k <= 0:
+            continue
+        new_rows = store.copy_many(clones[rng.integers(len(clones), size=k)], np.full(k, deme))
+        tumor.deme_list[deme].count_cells(store.genotype[new_rows], store.type[new_rows])
+        remaining -= k
+    return tumor
+
+
+def make_cell_data(tumor):
+    """Cell data in the form tumorsample reads it, with expression in double
+    precision as it is read back from the tables."""
+    tumor.set_cell_exps()
+    cell_crd = tumor.get_cell_data()['cell_crd']
+    genotype = tumor.get_cells()[1]
+    # Cells point to the sparse mutations of their clone
+    clone_rows = np.searchsorted(np.unique(genotype), genotype)
+    return dict(
+        cell_snv=CellSNVs(tumor.get_mutation_matrix(), clone_rows, cell_crd.index),
+        cell_exp=pd.DataFrame(tumor.get_cell_exps().astype(np.float64), index=cell_crd.index, columns=tumor.get_gene_names()),
+        cell_crd=cell_crd,
+    )
+
+
+def get_deme_counts(tumor):
+    """Genotype counts per deme, as written by tumorsim."""
+    demes, clones, counts = tumor.get_deme_genotype_counts()
+    rows, cols = np.divmod(demes, tumor.grid_size)
+    coords = [f'{row},{col}' for row, col in zip(rows, cols)]
+    return pd.DataFrame(dict(deme=coords, clone=tumor.clones.get_labels(clones), count=counts))
+
+
+@benchmark("n_cells", dict(grid_size=20, n_cells=1000), dict(grid_size=50, n_cells=10000),
+           dict(grid_size=100, n_cells=10000), dict(grid_size=100, n_cells=100000))
+def tumor_update(grid_size, n_cells):
+    tumor = make_tumor(grid_size, n_cells)
+    streams = RandomStreams(1)
+    return lambda: tumor.update(streams)
+
+
+@benchmark("n_workers", dict(grid_size=200, n_cells=100000, n_workers=1), dict(grid_size=200, n_cells=100000, n_workers=2),
+           dict(grid_size=200, n_cells=100000, n_workers=4))
+def checkerboard_step(grid_size, n_cells, n_workers):
+    tumor = make_tumor(grid_size, n_cells)
+    scheduler = CheckerboardScheduler(tumor, seed=1, n_workers=n_workers, domain_size=25)
+    # The workers and shared memory stay up until the benchmarks exit
+    atexit.register(scheduler.close)
+    return scheduler.step
+
+
+@benchmark("n_genes", dict(n_segments=10, segment_size=100, n_genes=1000), dict(n_segments=10, segment_size=1000, n_genes=10000),
+           dict(n_segments=50, segment_size=1000, n_genes=50000))
+def cancer_cell_mutate(n_segments, segment_size, n_genes):
+    selection = Selection(n_segments=n_segments, segment_size=segment_size, rng=RandomStreams(0).get("selection"))
+    cell = make_cancer_cell(n_segments, segment_size)
+    streams = RandomStreams(1)
+
+    def mutate():
+        # A lineage of 100 mutated daughters
+        parent = cell
+        rng = streams.get("mutation")
+        for _ in range(100):
+            new_cell = parent.divide()
+            new_cell.set_params()
+            new_cell.mutate(rng, selection.update_dict)
+            parent = new_cell
+    return mutate
+
+
+@benchmark("n_genes", dict(n_segments=10, segment_size=100, n_genes=1000), dict(n_segments=10, segment_size=1000, n_genes=10000),
+           dict(n_segments=50, segment_size=1000, n_genes=50000))
+def selection_rates(n_segments, segment_size, n_genes):
+    selection = Selection(n_segments=n_segments, segment_size=segment_size, rng=RandomStreams(0).get("selection"))
+    rng = RandomStreams(1).get("mutation")
+    cells = [make_cancer_cell(n_segments, segment_size)]
+    for _ in range(199):
+        new_cell = cells[-1].divide()
+        new_cell.set_params()
+        new_cell.mutate(rng, selection.update_dict)
+        cells.append(new_cell)
+
+    def update_rates():
+        # Distinct genomes, without the cache
+        selection.rate_cache.clear()
+        for cell in cells:
+            cell.update_evolutionary_parameters(selection.update_dict)
+    return update_rates
+
+
+@benchmark("n_cells", dict(grid_size=20, n_cells=1000), dict(grid_size=50, n_cells=10000), dict(grid_size=100, n_cells=100000))
+def tumor_get_cell_data(grid_size, n_cells):
+    tumor = make_tumor(grid_size, n_cells)
+    tumor.set_cell_exps()
+    return lambda: tumor.get_cell_data()
+
+
+def time_assay(assay, grid_size, n_cells):
+    from tumorevo.tumorsample.assays import ASSAYS
+    cell_data = make_cell_data(make_tumor(grid_size, n_cells))
+    return lambda: ASSAYS[assay](seed=0).run(cell_data, grid_side=grid_size)
+
+
+ASSAY_CASES = [dict(grid_size=20, n_cells=1000), dict(grid_size=50, n_cells=10000)]
+
+
+@benchmark("n_cells", *ASSAY_CASES)
+def assay_bdna(grid_size, n_cells):
+    return time_assay("bdna", grid_size, n_cells)
+
+
+@benchmark("n_cells", *ASSAY_CASES)
+def assay_scdna(grid_size, n_cells):
+    return time_assay("scdna", grid_size, n_cells)
+
+
+@benchmark("n_cells", *ASSAY_CASES)
+def assay_scrna(grid_size, n_cells):
+    return time_assay("scrna", grid_size, n_cells)
+
+
+@benchmark("n_cells", *ASSAY_CASES)
+def assay_visium(grid_size, n_cells):
+    return time_assay("visium", grid_size, n_cells)
+
+
+@benchmark("grid_size", dict(grid_size=20, expand=4), dict(grid_size=50, expand=4))
+def expand_grid(grid_size, expand):
+    from tumorevo.tumorfig.util import expand_grid
+    deme_counts = get_deme_counts(make_tumor(grid_size, 5 * grid_size * grid_size))
+    return lambda: expand_grid(deme_counts, grid_size, expand)
+
+
+@benchmark("grid_size", dict(grid_size=20), dict(grid_size=100), dict(grid_size=500))
+def plot_grid(grid_size):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from tumorevo.tumorfig.util import plot_grid
+    tumor = make_tumor(grid_size, 5 * grid_size * grid_size)
+    grid = tumor.get_genotype_matrix()
+    genotypes = np.unique(grid[grid >= 0])
+    colormap = plt.get_cmap("gnuplot")(np.linspace(0, 1, len(genotypes)))
+
+    def plot():
+        ax = plot_grid(grid, colormap, genotypes, figsize=(4, 4))
+        plt.close(ax.figure)
+    return plot
+
+
+def time_case(func, repeats):
+    """Best time per call over `repeats` runs, and the number of calls per run."""
+    start = time.perf_counter()
+    func()
+    number = max(1, int(MIN_RUN_TIME / max(time.perf_counter() - start, 1e-9)))
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - start) / number)
+    return min(runs), number
+
+
+def get_scaling(cases, scale):
+    # Slope of log(time) against log(size), over the cases that ran
+    timed = [case for case in cases if "seconds" in case]
+    sizes = np.array([case["params"][scale] for case in timed], dtype=float)
+    if len(np.unique(sizes)) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log([case["seconds"] for case in timed]), 1)[0])
+
+
+def run_benchmarks(names, repeats=5, quick=False):
+    results = dict()
+    for name in names:
+        func, scale, cases = BENCHMARKS[name]
+        results[name] = dict(scale=scale, cases=[])
+        for params in cases[:1] if quick else cases:
+            case = dict(params=params)
+            try:
+                case["seconds"], case["number"] = time_case(func(**params), repeats)
+                print(f"{name} {params}: {case['seconds'] * 1e3:.3f} ms")
+            except ImportError as e:
+                # e.g. tumorfig's plotting dependencies
+                case["skipped"] = str(e)
+                print(f"{name} {params}: skipped ({e})")
+            results[name]["cases"].append(case)
+        results[name]["scaling"] = get_scaling(results[name]["cases"], scale)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Cases that take more than `tolerance` times their baseline, as
+    (benchmark, params, ratio) tuples. Cases missing from either side are ignored."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_seconds = {json.dumps(case["params"], sort_keys=True): case["seconds"]
+                            for case in baseline[name]["cases"] if "seconds" in case}
+        for case in result["cases"]:
+            key = json.dumps(case["params"], sort_keys=True)
+            if "seconds" in case and key in baseline_seconds:
+                ratio = case["seconds"] / baseline_seconds[key]
+                if ratio > tolerance:
+                    regressions.append((name, case["params"], ratio))
+    return regressions
+
+
+@click.command(help="Time tumorevo's hot paths and compare them against a baseline.")
+@click.option("-b", "--bench", multiple=True, type=click.Choice(list(BENCHMARKS)), help="Benchmarks to run. Defaults to all.")
+@click.option("--repeats", default=5, help="Runs per case, the best one is kept.")
+@click.option("--quick", is_flag=True, help="Only run the smallest case of each benchmark.")
+@click.option("--baseline", default=None, type=click.Path(exists=True, dir_okay=False), help="Results of an earlier run to compare against.")
+@click.option("--tolerance", default=1.3, help="Slowdown over the baseline that counts as a regression.")
+@click.option("-o", "--output", default="bench.json", help="JSON file to write the results to.")
+def main(bench, repeats, quick, baseline, tolerance, output):
+    names = list(bench) if len(bench) > 0 else list(BENCHMARKS)
+    results = run_benchmarks(names, repeats=repeats, quick=quick)
+    report = dict(
+        meta=dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                  platform=platform.platform(), time=time.strftime("%Y-%m-%dT%H:%M:%S"), repeats=repeats),
+        results=results,
+    )
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}.")
+
+    for name, result in results.items():
+        if result["scaling"] is not None:
+            print(f"{name} scales as {result['scale']}^{result['scaling']:.2f}")
+
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, tolerance)
+        for name, params, ratio in regressions:
+            print(f"Regression in {name} {params}: {ratio:.2f}x the baseline")
+        if len(regressions) > 0:
+            raise SystemExit(1)
+        print(f"No regressions over {tolerance}x the baseline.")
+
+
+if __name__ == "__main__":
+    main()
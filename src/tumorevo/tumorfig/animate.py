@@ -21,11 +21,11 @@ from pymuller import muller
 )
 @click.argument(
     "genotype-counts",
-    type=click.Path(exists=True, dir_okay=False),
+    type=click.Path(exists=True, dir_okay=True),
 )
 @click.argument(
     "genotype-parents",
-    type=click.Path(exists=True, dir_okay=False),
+    type=click.Path(exists=True, dir_okay=True),
 )
 @click.option("--colormap", default="gnuplot", help="Colormap for genotypes.")
 @click.option("--figw", default=8, help="Figure width.")
@@ -57,13 +57,13 @@ def main(
     output_path,
 ):
     # Make colormap
-    genotype_counts = pd.read_csv(genotype_counts, index_col=0)
-    genotype_parents = pd.read_csv(genotype_parents, index_col=0, dtype=str)
+    genotype_counts = read_genotype_counts(genotype_counts)
+    genotype_parents = read_table(genotype_parents, dtype=str)
     pop_df, anc_df, color_by = prepare_plots(genotype_counts, genotype_parents)
     cmap, genotypes = get_colormap(pop_df, anc_df, color_by, colormap)
 
     # Load grids
-    grid_file_path_list = [f for f in os.listdir(grids_dir) if ("grid_" in f and ".csv" in f)]
+    grid_file_path_list = [f for f in os.listdir(grids_dir) if f.startswith("grid_")]
     grid_file_path_nums = [int(f.split("_")[-1].split(".")[0]) for f in grid_file_path_list]
     def argsort(seq):
         # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
@@ -71,7 +71,7 @@ def main(
     grid_file_path_list = [grid_file_path_list[i] for i in argsort(grid_file_path_nums)]
     grids = []
     for grid_file_path in grid_file_path_list:
-        grid = pd.read_csv(os.path.join(grids_dir, grid_file_path), index_col=0, dtype=str)
+        grid = read_table(os.path.join(grids_dir, grid_file_path), dtype=str)
         grids.append(grid)
 
     # Make animation
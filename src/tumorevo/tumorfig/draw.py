@@ -17,11 +17,11 @@ from pymuller import muller
 @click.command(help="Plot the evolution of a tumor.")
 @click.argument(
     "genotype-counts",
-    type=click.Path(exists=True, dir_okay=False),
+    type=click.Path(exists=True, dir_okay=True),
 )
 @click.argument(
     "genotype-parents",
-    type=click.Path(exists=True, dir_okay=False),
+    type=click.Path(exists=True, dir_okay=True),
 )
 @click.option("-c", "--cells", default=100, help="Number of cells in slice plot.")
 @click.option(
@@ -32,6 +32,7 @@ from pymuller import muller
 )
 @click.option("--grid-file", default="", help="Path to grid file.")
 @click.option("--deme-counts-file", default="", help="Path to genotype counts per deme file.")
+@click.option("--section", default="", help="Cross-section of a 3-D tumor to plot from the deme counts file, e.g. z=50.")
 @click.option("--colormap", default="gnuplot", help="Colormap for genotypes.")
 @click.option("--dpi", default=100, help="DPI for figures.")
 @click.option("--plot", is_flag=True, help="Plot all the figures.")
@@ -63,6 +64,7 @@ def main(
     average_radius,
     grid_file,
     deme_counts_file,
+    section,
     colormap,
     dpi,
     plot,
@@ -78,17 +80,22 @@ def main(
     suffix,
     output_path,
 ):
-    genotype_counts = pd.read_csv(genotype_counts, index_col=0)
-    genotype_parents = pd.read_csv(genotype_parents, index_col=0, dtype=str)
+    genotype_counts = read_genotype_counts(genotype_counts)
+    genotype_parents = read_table(genotype_parents, dtype=str)
     if grid_file != "":
-        grid = pd.read_csv(grid_file, index_col=0, dtype=str)
+        grid = read_table(grid_file, dtype=str)
 
-    if deme_counts_file != "" and expand > 1:   
-        genotype_counts_grid = pd.read_csv(deme_counts_file, index_col=0)
-        grid = expand_grid(
-                genotype_counts_grid, # dataframe of index x,y and genotypes in columns
-                grid.shape[0],
-                expand)
+    if deme_counts_file != "":
+        deme_counts = read_deme_counts(deme_counts_file)
+        if section != "":
+            # Cross-section of a 3-D tumor, the grid file only gives its side
+            deme_counts = get_section_counts(deme_counts, section)
+            grid = get_genotype_grid(deme_counts, grid.shape[0])
+        if expand > 1:
+            grid = expand_grid(
+                    deme_counts, # long table of (deme, clone, count)
+                    grid.shape[0],
+                    expand)
 
     # Keep only cancer cell statistics
     genotype_counts = genotype_counts.drop(columns=list(set(normal_names).intersection(set(genotype_counts.columns))))
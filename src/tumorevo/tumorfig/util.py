@@ -2,7 +2,6 @@ import numpy as np
 import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
-from matplotlib.cm import get_cmap
 from ast import literal_eval
 
 import pymuller
@@ -10,6 +9,43 @@ import packcircles as pc
 import networkx as nx
 from networkx.drawing.nx_agraph import write_dot, graphviz_layout
 
+from ..tumorsim.traces import TRACE_COLUMNS, read_trace_counts
+from ..tumorsim.results import read_table
+from ..tumorsim.rng import RandomStreams
+from ..tumorsim.voxels import get_section, parse_section
+
+import os
+
+DEME_COUNT_COLUMNS = ["deme", "clone", "count"]
+
+
+def read_genotype_counts(path):
+    """Read genotype counts over time as a steps x clones table, either from
+    the long-format trace written by tumorsim or from a wide table."""
+    if os.path.isdir(path) and not os.path.exists(os.path.join(path, "columns.npy")):
+        # Trace written in parts
+        return read_trace_counts(path)
+    if path.endswith(".csv") and set(TRACE_COLUMNS).issubset(pd.read_csv(path, nrows=0).columns):
+        return read_trace_counts(path)
+    return read_table(path)
+
+
+def read_deme_counts(path):
+    """Read the genotype counts per deme written by tumorsim, as a long table
+    with one (deme, clone, count) row per clone present in a deme, where demes
+    are labelled by their coordinates, e.g. "3,4". Wide demes x clones tables
+    written by older versions are converted."""
+    counts = read_table(path, dtype=dict(deme=str, clone=str))
+    if list(counts.columns) == DEME_COUNT_COLUMNS:
+        counts = counts.reset_index(drop=True)
+        counts["deme"] = counts["deme"].astype(str)
+        counts["clone"] = counts["clone"].astype(str)
+        return counts
+    counts.index = counts.index.astype(str)
+    counts = counts.rename_axis("deme").reset_index().melt(id_vars="deme", var_name="clone", value_name="count")
+    counts["clone"] = counts["clone"].astype(str)
+    return counts[counts["count"] > 0].reset_index(drop=True)
+
 
 def prepare_plots(genotype_counts, genotype_parents):
     pop_df = genotype_counts
@@ -58,6 +94,7 @@ def plot_deme(
     ax=None,
     dpi=200,
     figsize=(10, 10),
+    seed=42,
 ):
     """Create a circle for each cell and color it by genotype.
     The colors are consistent with the Muller plots.
@@ -75,6 +112,7 @@ def plot_deme(
     )
     color_map = cmap(norm(ordered_colors.values))
 
+    rng = RandomStreams(seed).get("figure")
     radii = []
     colors = []
     n_total_cells = sum(genotype_counts.values)
@@ -82,12 +120,12 @@ def plot_deme(
     max_r = int(average_radius * 2)
     for i, genotype in enumerate(final_order):
         n = max(1, int(n_cells * genotype_counts[genotype] / n_total_cells))
-        g_radii = np.random.randint(min_r, max_r, size=n).tolist()
+        g_radii = rng.integers(min_r, max_r, size=n).tolist()
         radii = radii + g_radii
         colors = colors + [color_map[i]] * n
 
     # Randomly permute cells to model well mixed population in deme
-    perm = np.random.choice(len(radii), size=len(radii), replace=False)
+    perm = rng.choice(len(radii), size=len(radii), replace=False)
     radii = np.array(radii)[perm]
     colors = np.array(colors)[perm]
 
@@ -129,35 +167,58 @@ def plot_grid(
 
 
 def expand_grid(
-    genotype_counts_grid, # dataframe of index x,y and genotypes in columns
+    deme_counts, # long table of (deme, clone, count), from read_deme_counts
     original_grid_side,
     minigrid_side, 
+    seed=42,
 ):
     """If each entry is a deme with many cells, expand each entry to a grid of specified size
     and color the entries in there by the proportion of the genotype_ids present in it
     Returns a genotype grid
     """
     new_grid_side = original_grid_side * minigrid_side
-    new_grid = np.zeros((new_grid_side, new_grid_side), dtype=object)
+    new_grid = np.full((new_grid_side, new_grid_side), "", dtype=object)
 
-    cnt = 0
-    for ij in genotype_counts_grid.index:
+    rng = RandomStreams(seed).get("figure")
+    # Each deme only sees the clones it has
+    for ij, in_deme in deme_counts.groupby("deme", sort=False):
         deme_i, deme_j = np.array(ij.split(',')).astype(int).tolist()
         deme_i_start, deme_j_start = deme_i * minigrid_side, deme_j * minigrid_side
         deme_i_end, deme_j_end = deme_i_start + minigrid_side, deme_j_start + minigrid_side
+        clones = in_deme["clone"].to_numpy()
+        counts = in_deme["count"].to_numpy()
+        if np.sum(counts) == 0:
+            continue
         for pos_x in range(deme_i_start, deme_i_end):
             for pos_y in range(deme_j_start, deme_j_end):
                 # Sample genotype positions in each grid point
-                rng = np.random.default_rng(cnt)
-                counts = genotype_counts_grid.loc[ij]
-                if np.sum(counts) == 0:
-                    new_grid[pos_x,pos_y] = ""
-                else:
-                    new_grid[pos_x,pos_y] = rng.choice(genotype_counts_grid.columns, p=counts/np.sum(counts))
-                cnt += 1
+                new_grid[pos_x,pos_y] = rng.choice(clones, p=counts/np.sum(counts))
     return new_grid
 
 
+def get_section_counts(deme_counts, section):
+    """Genotype counts of the demes of a 3-D tumor (demes x,y,z) that are in
+    a cross-section such as "z=50", with the demes labelled by their row,col in it."""
+    axis, position = parse_section(section)
+    coords = np.array([xyz.split(',') for xyz in deme_counts["deme"]]).astype(int).reshape(-1, 3)
+    in_section, crd = get_section(coords, axis, position)
+    section_counts = deme_counts[in_section].reset_index(drop=True)
+    section_counts["deme"] = [f'{row},{col}' for row, col in crd]
+    return section_counts
+
+
+def get_genotype_grid(deme_counts, grid_side):
+    """Most frequent genotype at each deme of a grid_side x grid_side grid, "" if empty."""
+    grid = np.full((grid_side, grid_side), "", dtype=object)
+    present = deme_counts[deme_counts["count"] > 0]
+    # The largest clone of each deme, the first one listed on ties
+    dominant = present.iloc[np.argsort(-present["count"].to_numpy(), kind="stable")].drop_duplicates("deme")
+    for ij, clone in zip(dominant["deme"], dominant["clone"]):
+        deme_i, deme_j = np.array(ij.split(',')).astype(int).tolist()
+        grid[deme_i, deme_j] = clone
+    return grid
+
+
 def plot_tree(
     genotype_parents,
     populations_df,
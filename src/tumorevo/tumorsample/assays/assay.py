@@ -1,6 +1,9 @@
+from ...tumorsim.rng import RandomStreams
+
 class Assay(object):
     def __init__(self, seed=42):
         self.seed = seed
+        self.rng = RandomStreams(seed).get("assay")
 
     def run(self, cell_data, **kwargs):
         pass
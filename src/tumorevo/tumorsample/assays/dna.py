@@ -26,18 +26,18 @@ class bulkDNA(DNA):
         if self.target_genes == 'all':
             target_genes = all_genes
         elif isinstance(self.target_genes, float):
-            target_genes = np.random.choice(all_genes, size=int(self.target_genes * len((all_genes))), replace=False)
+            target_genes = self.rng.choice(all_genes, size=int(self.target_genes * len((all_genes))), replace=False)
         elif isinstance(self.target_genes, list):
             target_genes = self.target_genes
         n_genes = len(target_genes)
 
         target_cell_snvs = cell_snvs.loc[target_cells,target_genes]
         if self.data_mode == 'counts':
-            self.coverage = np.random.multinomial(self.n_reads, pvals=[1/len(target_genes)]*len(target_genes)) # distribute across genes
-            self.cell_coverages = np.vstack([np.random.multinomial(self.coverage[g], pvals=[1/n_cells]*n_cells) for g in range(len(self.coverage))]).T # distribute across cells
+            self.coverage = self.rng.multinomial(self.n_reads, pvals=[1/len(target_genes)]*len(target_genes)) # distribute across genes
+            self.cell_coverages = np.vstack([self.rng.multinomial(self.coverage[g], pvals=[1/n_cells]*n_cells) for g in range(len(self.coverage))]).T # distribute across cells
             self.cell_alt_counts = np.zeros((n_cells, n_genes))
-            self.cell_alt_counts[target_cell_snvs == 1] = self.cell_coverages[target_cell_snvs == 1] - np.random.binomial(self.cell_coverages[target_cell_snvs == 1], self.fnr)
-            self.cell_alt_counts[target_cell_snvs == 0] = np.random.binomial(self.cell_coverages[target_cell_snvs == 0], self.fpr)
+            self.cell_alt_counts[target_cell_snvs == 1] = self.cell_coverages[target_cell_snvs == 1] - self.rng.binomial(self.cell_coverages[target_cell_snvs == 1], self.fnr)
+            self.cell_alt_counts[target_cell_snvs == 0] = self.rng.binomial(self.cell_coverages[target_cell_snvs == 0], self.fpr)
             self.observed_data = pd.DataFrame(dict(coverage=self.coverage.astype(int), alt_counts=np.sum(self.cell_alt_counts, axis=0).astype(int)), index=target_genes)
         # Otherwise, generate reads
         elif self.data_mode == 'reads':
@@ -60,27 +60,27 @@ class scDNA(DNA):
         cell_snvs = cell_data['cell_snv']
         if len(cell_snvs.index) < self.n_cells:
             self.n_cells = len(cell_snvs.index)
-        target_cells = np.random.choice(cell_snvs.index, size=self.n_cells, replace=False)
+        target_cells = self.rng.choice(cell_snvs.index, size=self.n_cells, replace=False)
 
         all_genes = cell_snvs.columns
         if self.target_genes == 'all':
             target_genes = all_genes
         elif isinstance(self.target_genes, float):
-            target_genes = np.random.choice(all_genes, size=int(self.target_genes * len((all_genes))), replace=False)
+            target_genes = self.rng.choice(all_genes, size=int(self.target_genes * len((all_genes))), replace=False)
         elif isinstance(self.target_genes, list):
             target_genes = self.target_genes
 
         target_cell_snvs = cell_snvs.loc[target_cells,target_genes].astype(int)
         if self.data_mode == 'binary':
             self.observed_snvs = np.zeros(target_cell_snvs.shape)
-            self.observed_snvs[target_cell_snvs == 1] = 1-np.random.binomial(target_cell_snvs.values[target_cell_snvs == 1], self.fnr)
-            self.observed_snvs[target_cell_snvs == 0] = np.random.binomial(1-target_cell_snvs.values[target_cell_snvs == 0], self.fpr)
+            self.observed_snvs[target_cell_snvs == 1] = 1-self.rng.binomial(target_cell_snvs.values[target_cell_snvs == 1], self.fnr)
+            self.observed_snvs[target_cell_snvs == 0] = self.rng.binomial(1-target_cell_snvs.values[target_cell_snvs == 0], self.fpr)
             self.observed_snvs = pd.DataFrame(self.observed_snvs.astype(int), index=target_cells, columns=target_genes)
         elif self.data_mode == 'counts':
-            self.coverage = np.random.multinomial(self.n_reads, [1/len(target_genes)]*len(target_genes), size=len(target_cells))
+            self.coverage = self.rng.multinomial(self.n_reads, [1/len(target_genes)]*len(target_genes), size=len(target_cells))
             self.alt_counts = np.zeros(target_cell_snvs.shape)
-            self.alt_counts[target_cell_snvs == 1] = self.coverage[target_cell_snvs == 1] - np.random.binomial(self.coverage[target_cell_snvs == 1], self.fnr)
-            self.alt_counts[target_cell_snvs == 0] = np.random.binomial(self.coverage[target_cell_snvs == 0], self.fpr)
+            self.alt_counts[target_cell_snvs == 1] = self.coverage[target_cell_snvs == 1] - self.rng.binomial(self.coverage[target_cell_snvs == 1], self.fnr)
+            self.alt_counts[target_cell_snvs == 0] = self.rng.binomial(self.coverage[target_cell_snvs == 0], self.fpr)
             self.coverage = pd.DataFrame(self.coverage.astype(int), index=target_cells, columns=target_genes)
             self.alt_counts = pd.DataFrame(self.alt_counts.astype(int), index=target_cells, columns=target_genes)
         # Otherwise, generate reads
@@ -46,7 +46,7 @@ class Visium(Assay):
             if len(in_spot) > 0:
                 joint_expr = cell_states.loc[in_spot].values.mean(axis=0) # average transcriptional activities of all cells assigned to this spot
                 gene_prob = joint_expr / joint_expr.sum()
-                self.spot_umi[spot, :] = np.random.multinomial(self.n_reads, gene_prob)
+                self.spot_umi[spot, :] = self.rng.multinomial(self.n_reads, gene_prob)
             self.spot_cell_counts[spot] = len(in_spot)
             
     
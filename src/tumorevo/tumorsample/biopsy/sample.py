@@ -1,10 +1,13 @@
+from ...tumorsim.rng import RandomStreams
+
 import numpy as np
 
-def sample(cell_ids, fraction):
+def sample(cell_ids, fraction, seed=42):
     n_cells = len(cell_ids)
 
     # Take random subset
-    sampled_cells = np.random.choice(n_cells, size=int(n_cells*fraction), replace=False)
+    rng = RandomStreams(seed).get("biopsy")
+    sampled_cells = rng.choice(n_cells, size=int(n_cells*fraction), replace=False)
 
     return cell_ids[sampled_cells]
 
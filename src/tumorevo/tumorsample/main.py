@@ -3,6 +3,9 @@ Simulate molecular data from a tumor.
 """
 from .assays import *
 from .biopsy import *
+from ..tumorsim.mutations import MutationMatrix
+from ..tumorsim.results import find_table, read_table
+from ..tumorsim.voxels import AXES, get_section, parse_section
 
 import numpy as np
 import pandas as pd
@@ -13,6 +16,103 @@ from pathlib import Path
 import logging
 import yaml
 
+def read_cell_table(cell_data_path, name, **kwargs):
+    return read_table(find_table(os.path.join(cell_data_path, name)), **kwargs)
+
+
+class CellSNVs(object):
+    """Binary cells x sites SNV matrix that stays sparse: each cell points to
+    the row of its clone in the clones x sites mutation matrix. It has the
+    parts of the DataFrame interface that the assays and biopsies use: `index`,
+    `columns`, `.loc[cells]` for a subset of the cells, and `.loc[cells, sites]`,
+    which is the only place where a dense table is made, for just those sites."""
+
+    def __init__(self, clone_mut, clone_rows, index):
+        self.clone_mut = clone_mut
+        self.clone_rows = np.asarray(clone_rows, dtype=np.int64)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(clone_mut.columns)
+        self.loc = _CellSNVsLocator(self)
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def __len__(self):
+        return len(self.index)
+
+    def take(self, cells):
+        """Subset of the cells, by label."""
+        positions = self.index.get_indexer(cells)
+        if np.any(positions < 0):
+            raise KeyError(f"Unknown cells {list(np.asarray(cells)[positions < 0][:5])}")
+        return CellSNVs(self.clone_mut, self.clone_rows[positions], self.index[positions])
+
+    def get_frame(self, cells, sites):
+        """Dense 0/1 table of the given cells and sites."""
+        cells = self.take(cells)
+        sites = pd.Index(sites)
+        site_positions = self.columns.get_indexer(sites)
+        if np.any(site_positions < 0):
+            raise KeyError(f"Unknown sites {list(sites[site_positions < 0][:5])}")
+        # Clones x the requested sites, then one row per cell
+        used, columns = np.unique(site_positions, return_inverse=True)
+        column_of = np.full(self.shape[1], -1, dtype=np.int64)
+        column_of[used] = np.arange(len(used))
+        mut = self.clone_mut
+        row_idx = np.repeat(np.arange(mut.shape[0]), np.diff(mut.indptr))
+        keep = (column_of[mut.indices] >= 0) & (mut.data > 0)
+        clone_snvs = np.zeros((mut.shape[0], len(used)), dtype=int)
+        clone_snvs[row_idx[keep], column_of[mut.indices[keep]]] = 1
+        return pd.DataFrame(clone_snvs[cells.clone_rows][:, columns], index=cells.index, columns=sites)
+
+
+class _CellSNVsLocator(object):
+    def __init__(self, snvs):
+        self.snvs = snvs
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.snvs.get_frame(*key)
+        return self.snvs.take(key)
+
+
+def read_cell_snv(cell_data_path):
+    if os.path.exists(os.path.join(cell_data_path, 'cell_snv.csv')):
+        return read_cell_table(cell_data_path, 'cell_snv')
+    # Cells reference the sparse mutations of their clone, and stay that way
+    clone_mut = MutationMatrix.load(os.path.join(cell_data_path, 'clone_mut.npz'))
+    clone_rows = {clone: row for row, clone in enumerate(clone_mut.rows)}
+    cell_ids = read_cell_table(cell_data_path, 'cell_ids', dtype=str)
+    return CellSNVs(clone_mut, [clone_rows[str(clone)] for clone in cell_ids['cell_id']], cell_ids.index)
+
+
+def read_cell_exp(cell_data_path, genes=None):
+    try:
+        return read_cell_table(cell_data_path, 'cell_exp', columns=genes)
+    except FileNotFoundError:
+        pass
+    # Cells reference the expression of their clone
+    clone_exp = read_cell_table(cell_data_path, 'clone_exp', columns=genes)
+    clone_exp.index = clone_exp.index.astype(str)
+    cell_ids = read_cell_table(cell_data_path, 'cell_ids', dtype=str)
+    cell_exp = clone_exp.loc[cell_ids['cell_id'].astype(str)]
+    cell_exp.index = cell_ids.index
+    return cell_exp
+
+
+def select_section(cell_data, section):
+    """Keep the cells of a 3-D tumor that are in a cross-section such as
+    "z=50", with their (row, col) in it as coordinates."""
+    axis, position = parse_section(section)
+    cell_crd = cell_data['cell_crd']
+    in_section, crd = get_section(cell_crd[AXES].to_numpy(), axis, position)
+    cells = cell_crd.index[in_section]
+    cell_data = {key: cell_data[key].loc[cells] for key in cell_data}
+    cell_data['cell_crd'] = pd.DataFrame(crd, index=cells, columns=['row', 'col'])
+    return cell_data
+
+
 @click.command(help="Simulate molecular data from a tumor.")
 @click.argument(
     "cell-data-path",
@@ -23,6 +123,7 @@ import yaml
 @click.option("-s", "--spatial", default=True, help="Wether to consider the spatial structure in the assay.")
 @click.option("--biopsy-config", default='biopsyconfigs/biopsy.yaml', type=click.Path(exists=True, dir_okay=False), help="Config file for spatial-aware sample")
 @click.option("--grid-file", default="", help="Path to grid file (optional). Assumes each pixel is a cell.")
+@click.option("--section", default="", help="Cross-section of a 3-D tumor to sample, e.g. z=50.")
 @click.option(
     "--log", default=0, help="Logging level. 0 for no logging, 1 for info, 2 for debug."
 )
@@ -34,6 +135,7 @@ def main(
     spatial,
     biopsy_config,
     grid_file,
+    section,
     log,
     output_path,
 ):
@@ -55,10 +157,12 @@ def main(
         assay_config = yaml.safe_load(f)        
 
     # Read cell data
-    cell_data = dict(cell_snv=pd.read_csv(os.path.join(cell_data_path, 'cell_snv.csv'), index_col=0),
-                     cell_exp=pd.read_csv(os.path.join(cell_data_path, 'cell_exp.csv'), index_col=0),
-                     cell_crd=pd.read_csv(os.path.join(cell_data_path, 'cell_crd.csv'), index_col=0),
+    cell_data = dict(cell_snv=read_cell_snv(cell_data_path),
+                     cell_exp=read_cell_exp(cell_data_path),
+                     cell_crd=read_cell_table(cell_data_path, 'cell_crd'),
     )
+    if section != "":
+        cell_data = select_section(cell_data, section)
     cell_ids = cell_data['cell_snv'].index
     grid_side = None
 
@@ -68,7 +172,7 @@ def main(
         for key in cell_data:
             cell_data[key] = cell_data[key].loc[sampled_cell_ids]
     else:
-        grid = pd.read_csv(grid_file, index_col=0, dtype=str)
+        grid = read_table(grid_file, dtype=str)
         grid_side = grid.shape[0]
         # Select regions in space
         # cell_data = sample_regions(cell_data, grid, **biopsy_config) # subsections of the grid
@@ -1,3 +1,6 @@
+from .genome import GENOME_TABLE, to_bits
+from .clones import NORMAL_CLONES
+
 import numpy as np
 import pandas as pd
 from copy import copy
@@ -19,10 +22,10 @@ class Cell(object):
         self.type = "healthy"
         self.parent = parent
         if parent is None:
-            self.genome = [{'p':[set()], 'm':[set()]}] * n_segments # copy number = 2
+            self.genome = GENOME_TABLE.diploid(n_segments) # copy number = 2
             self.set_genotype_id()
         else:
-            self.genome = list(parent.genome)
+            self.genome = parent.genome # genomes are immutable, so share it
             self.genotype_id = self.parent.genotype_id
         # self.exp = np.random.beta(.1, 1, size=self.n_genes)  # Gene activity probability (each gene ranges from 0 to 1 indicating its prob of expression. transcripts will be sampled binomially)
 
@@ -36,16 +39,17 @@ class Cell(object):
         self.treatment_effectiveness = self.baseline_treatment_effectiveness
 
     def update_evolutionary_parameters(self, update_dict):
-        self.viability = update_dict['viability'](self.genome)
-        self.division_rate = update_dict['division_rate'](self.baseline_division_rate, self.genome)
-        self.dispersal_rate = update_dict['dispersal_rate'](self.baseline_dispersal_rate, self.genome)
-        self.treatment_effectiveness = update_dict['treatment_effectiveness'](self.baseline_treatment_effectiveness, self.genome)
+        # All rates at once, cached per genotype
+        (self.viability, self.division_rate, self.dispersal_rate, self.treatment_effectiveness) = update_dict['rates'](
+            self.genome, self.baseline_division_rate, self.baseline_dispersal_rate, self.baseline_treatment_effectiveness)
         self.division_rate = min(self.max_birth_rate, self.division_rate)            
 
-    def set_genotype_id(self):
-        self.genotype_id = id(self)#"".join(self.snv.astype(int).astype(str))
+    def set_genotype_id(self, genotype_id=None):
+        # Clone IDs are handed out by the tumor's CloneRegistry when the cell is added to a deme
+        self.genotype_id = genotype_id
 
     def divide(self, new_cell_id=0):
+        # O(1): the daughter shares the parent's immutable genome
         new_cell = copy(self)
         new_cell.parent = self
         return new_cell
@@ -56,16 +60,14 @@ class Cell(object):
             for hap in self.genome[seg]:
                 for all in self.genome[seg][hap]:
                     for pos in range(self.segment_size):
-                        mut = 0
-                        if pos in self.genome[seg][hap][all]:
-                            mut = 1
+                        mut = (all >> pos) & 1
                         row = [seg, hap, pos, mut]
                         rows.append(row)
         df = pd.DataFrame.from_records(rows, columns=['seg', 'hap', 'pos', 'mut'])
         return df
 
-    def set_baseline_exp(self):
-        self.baseline_exp = np.random.beta(.1, 1, size=self.n_segments * self.segment_size) 
+    def set_baseline_exp(self, rng):
+        self.baseline_exp = rng.beta(.1, 1, size=self.n_segments * self.segment_size) 
 
     def get_exp(self, make_exp_fun):
         exp = np.array(self.baseline_exp)
@@ -86,14 +88,14 @@ class EpithelialCell(Cell):
     def __init__(self, **cell_kwargs):
         super(EpithelialCell, self).__init__(**cell_kwargs)
         self.type = "epithelial"
-        self.genotype_id = self.type
+        self.genotype_id = NORMAL_CLONES[self.type]
         # self.exp = np.random.beta(.1, 1, size=self.n_genes)  # Gene activity probability (each gene ranges from 0 to 1 indicating its prob of expression. transcripts will be sampled binomially)
 
 class StromalCell(Cell):
     def __init__(self, **cell_kwargs):
         super(StromalCell, self).__init__(**cell_kwargs)
         self.type = "stromal"        
-        self.genotype_id = self.type
+        self.genotype_id = NORMAL_CLONES[self.type]
         # self.exp = np.random.beta(.1, 1, size=self.n_genes)  # Gene activity probability (each gene ranges from 0 to 1 indicating its prob of expression. transcripts will be sampled binomially)
 
 class ImmuneCell(Cell):
@@ -101,7 +103,7 @@ class ImmuneCell(Cell):
         super(ImmuneCell, self).__init__(**cell_kwargs)
         self.prob_kill = prob_kill # probability of killing a neighboring cancer cell
         self.type = "immune"
-        self.genotype_id = self.type
+        self.genotype_id = NORMAL_CLONES[self.type]
         # self.exp = np.random.beta(.1, 1, size=self.n_genes)  # Gene activity probability (each gene ranges from 0 to 1 indicating its prob of expression. transcripts will be sampled binomially)
 
 class CancerCell(Cell):
@@ -119,43 +121,44 @@ class CancerCell(Cell):
             self.genotype_id = self.parent.genotype_id
             
     def mutate(self, rng, update_dict, n_events=5, mut_prob=.1, cnv_prob=.1):
-        event = np.random.choice(['cnv', 'mut'], p=np.array([mut_prob, cnv_prob])/sum([mut_prob, cnv_prob])) # add WGDs too...
+        event = rng.choice(['cnv', 'mut'], p=np.array([mut_prob, cnv_prob])/sum([mut_prob, cnv_prob])) # add WGDs too...
         if event == 'mut':
             # Sample segment
-            segment_probs = np.array([len(self.genome[seg]['p'] + self.genome[seg]['m']) for seg in range(self.n_segments)]) # can't select empty segment
+            segment_probs = np.array(self.genome.get_copy_numbers()) # can't select empty segment
             segment_probs = segment_probs / np.sum(segment_probs)
-            seg = np.random.choice(range(self.n_segments), p=segment_probs)
+            seg = rng.choice(range(self.n_segments), p=segment_probs)
             # Sample haplotype
             n_p, n_m = len(self.genome[seg]['p']), len(self.genome[seg]['m'])
-            hap = np.random.choice(['p', 'm'], p=np.array([n_p, n_m])/(n_p + n_m))
+            hap = rng.choice(['p', 'm'], p=np.array([n_p, n_m])/(n_p + n_m))
             # Sample allele
-            all = np.random.choice(range(len(self.genome[seg][hap])))
+            all = rng.choice(range(len(self.genome[seg][hap])))
             # Sample number of mutations
-            n_mutations = np.min([np.random.poisson(n_events)+1, self.segment_size])
+            n_mutations = np.min([rng.poisson(n_events)+1, self.segment_size])
             # choose mutations and reject the ones which are already in the allele (force ISA)
-            muts = set(np.random.choice(self.segment_size, size=n_mutations, replace=False))
-            while len(muts.intersection(self.genome[seg][hap][all])) == len(muts):
-                muts = set(np.random.choice(self.segment_size, size=n_mutations, replace=False))
-            self.genome[seg][hap][all].update(muts)
+            allele = self.genome[seg][hap][all]
+            muts = to_bits(rng.choice(self.segment_size, size=n_mutations, replace=False))
+            while muts & allele == muts:
+                muts = to_bits(rng.choice(self.segment_size, size=n_mutations, replace=False))
+            self.genome = self.genome.set_allele(seg, hap, all, allele | muts)
         elif event == 'cnv':
             # Sample segment
-            segment_probs = np.array([len(self.genome[seg]['p'] + self.genome[seg]['m']) for seg in range(self.n_segments)]) # can't select empty segment
+            segment_probs = np.array(self.genome.get_copy_numbers()) # can't select empty segment
             segment_probs = segment_probs / np.sum(segment_probs)
-            seg = np.random.choice(range(self.n_segments), p=segment_probs)
+            seg = rng.choice(range(self.n_segments), p=segment_probs)
             # Sample haplotype
             n_p, n_m = len(self.genome[seg]['p']), len(self.genome[seg]['m'])
-            hap = np.random.choice(['p', 'm'], p=np.array([n_p, n_m])/(n_p + n_m))
+            hap = rng.choice(['p', 'm'], p=np.array([n_p, n_m])/(n_p + n_m))
             # Sample allele
-            all = np.random.choice(range(len(self.genome[seg][hap])))
+            all = rng.choice(range(len(self.genome[seg][hap])))
             # Decide wether to delete or copy
-            evt = np.random.choice(['del', 'amp'])
+            evt = rng.choice(['del', 'amp'])
             if evt == 'amp':
-                self.genome[seg][hap].append(self.genome[seg][hap][all]) # add a copy
+                self.genome = self.genome.add_allele(seg, hap, self.genome[seg][hap][all]) # add a copy
             elif evt == 'del':
                 if len(self.genome[seg][hap]) == 1:
-                    self.genome[seg][hap][all] = set()
+                    self.genome = self.genome.set_allele(seg, hap, all, 0)
                 else:
-                    del self.genome[seg][hap][all] # remove
+                    self.genome = self.genome.remove_allele(seg, hap, all) # remove
 
         self.update_evolutionary_parameters(update_dict)
         self.set_genotype_id()
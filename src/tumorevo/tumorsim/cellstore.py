@@ -0,0 +1,222 @@
+import numpy as np
+from copy import copy
+
+CELL_TYPES = ["cancer", "epithelial", "stromal", "immune"]
+CELL_TYPE_CODES = {celltype: code for code, celltype in enumerate(CELL_TYPES)}
+
+RATES = [
+    "division_rate",
+    "death_rate",
+    "dispersal_rate",
+    "mutation_rate",
+    "treatment_effectiveness",
+    "viability",
+]
+DIVISION, DEATH, DISPERSAL, MUTATION, TREATMENT, VIABILITY = range(len(RATES))
+
+
+class CellStore(object):
+    """Tumor-wide struct-of-arrays container for cells.
+
+    Each cell is a row in a set of NumPy arrays (deme index, clone ID, cell
+    type code and rates). Cells of the same clone share one prototype
+    `Cell` object, which is only copied when a cell needs to be materialized
+    (e.g. to mutate it). Each deme keeps an array of the rows it holds so
+    that cells can be sampled per deme in O(1), and removal swaps the last
+    row into the freed one.
+    """
+
+    def __init__(self, n_demes, capacity=1024):
+        self.n_demes = n_demes
+        self.size = 0
+        self.capacity = capacity
+        self.deme = np.zeros(capacity, dtype=np.int32)
+        self.genotype = np.zeros(capacity, dtype=np.int32)
+        self.type = np.zeros(capacity, dtype=np.int8)
+        self.slot = np.zeros(capacity, dtype=np.int32)  # position in the deme's members
+        self.rates = np.zeros((capacity, len(RATES)), dtype=np.float32)
+
+        self.deme_size = np.zeros(n_demes, dtype=np.int64)
+        self.members = dict()  # deme index -> array of rows, only for demes that were ever occupied
+
+        self.prototypes = dict()  # clone ID -> Cell, for the live clones (see Tumor.count_clone)
+
+    def __len__(self):
+        return self.size
+
+    def grow_demes(self, n_demes):
+        """Make room for demes up to `n_demes`, for grids that grow."""
+        if n_demes > self.n_demes:
+            self.deme_size = np.concatenate([self.deme_size, np.zeros(n_demes - self.n_demes, dtype=np.int64)])
+            self.n_demes = n_demes
+
+    def add(self, cell, deme):
+        """Insert a new row for `cell` in `deme` and return its index. The cell
+        must already have a clone ID."""
+        if cell.genotype_id not in self.prototypes:
+            self.prototypes[cell.genotype_id] = cell
+        rates = [getattr(cell, rate, 0.0) for rate in RATES]
+        return self._append(deme, cell.genotype_id, CELL_TYPE_CODES[cell.type], rates)
+
+    def copy(self, idx, deme):
+        """Insert a copy of row `idx` in `deme` and return its index."""
+        return self._append(deme, self.genotype[idx], self.type[idx], self.rates[idx])
+
+    def copy_many(self, rows, demes):
+        """Insert copies of `rows` in `demes` and return their indices."""
+        n = len(rows)
+        while self.size + n > self.capacity:
+            self._grow()
+        new_rows = np.arange(self.size, self.size + n)
+        self.genotype[new_rows] = self.genotype[rows]
+        self.type[new_rows] = self.type[rows]
+        self.rates[new_rows] = self.rates[rows]
+        self.deme[new_rows] = demes
+        for idx, deme in zip(new_rows.tolist(), np.asarray(demes).tolist()):
+            self._add_member(deme, idx)
+        self.size += n
+        return new_rows
+
+    def remove(self, idx):
+        """Remove row `idx`. The last row is moved into its place, and the
+        index it was moved from is returned (-1 if nothing moved)."""
+        deme = self.deme[idx]
+        members = self.members[deme]
+        last_slot = self.deme_size[deme] - 1
+        moved_member = members[last_slot]
+        members[self.slot[idx]] = moved_member
+        self.slot[moved_member] = self.slot[idx]
+        self.deme_size[deme] = last_slot
+
+        last = self.size - 1
+        self.size = last
+        if idx == last:
+            return -1
+        self.deme[idx] = self.deme[last]
+        self.genotype[idx] = self.genotype[last]
+        self.type[idx] = self.type[last]
+        self.slot[idx] = self.slot[last]
+        self.rates[idx] = self.rates[last]
+        self.members[self.deme[idx]][self.slot[idx]] = idx
+        return last
+
+    def remove_many(self, rows):
+        """Remove `rows`. They are removed from the last one down, so that the
+        rows still to be removed are never the ones moved."""
+        for idx in sorted(np.asarray(rows).tolist(), reverse=True):
+            self.remove(idx)
+
+    def move_many(self, rows, deme):
+        """Move `rows` to `deme`. The rows keep their data and only the demes'
+        member arrays change: the moved rows are swapped to the tail of their
+        source's members, which is cut off with one slice, so a move costs
+        O(len(rows)) whatever the size of the source."""
+        rows = np.asarray(rows, dtype=np.int64)
+        sources = self.deme[rows]
+        for source in np.unique(sources).tolist():
+            moved = rows[sources == source]
+            members = self.members[source]
+            size = self.deme_size[source]
+            tail = size - len(moved)
+            slots = self.slot[moved]
+            # Rows that stay but sit in the tail trade places with the moved rows before it
+            in_tail = np.zeros(len(moved), dtype=bool)
+            in_tail[slots[slots >= tail] - tail] = True
+            staying = members[tail:size][~in_tail]
+            freed = slots[slots < tail]
+            members[freed] = staying
+            self.slot[staying] = freed
+            self.deme_size[source] = tail
+        size = self.deme_size[deme]
+        end = size + len(rows)
+        members = self.members.get(deme)
+        if members is None or members.shape[0] < end:
+            grown = np.zeros(max(4, 2 * end), dtype=np.int32)
+            if members is not None:
+                grown[:size] = members[:size]
+            members = self.members[deme] = grown
+        members[size:end] = rows
+        self.slot[rows] = np.arange(size, end)
+        self.deme_size[deme] = end
+        self.deme[rows] = deme
+
+    def move(self, idx, deme):
+        """Move row `idx` to another deme."""
+        genotype, celltype, rates = self.genotype[idx], self.type[idx], np.array(self.rates[idx])
+        self.remove(idx)
+        return self._append(deme, genotype, celltype, rates)
+
+    def get_members(self, deme):
+        if deme not in self.members:
+            return np.zeros(0, dtype=np.int32)
+        return self.members[deme][: self.deme_size[deme]]
+
+    def sample(self, deme, size, rng):
+        """Sample `size` distinct rows of `deme` uniformly at random."""
+        slots = rng.choice(self.deme_size[deme], size=size, replace=False)
+        return self.members[deme][slots]
+
+    def get_cell(self, idx):
+        """Materialize row `idx` as a Cell object."""
+        return self.make_cell(self.genotype[idx], self.rates[idx])
+
+    def make_cell(self, genotype, rates):
+        """Cell object of clone `genotype` with the given rates."""
+        cell = copy(self.prototypes[genotype])
+        for col, rate in enumerate(RATES):
+            setattr(cell, rate, float(rates[col]))
+        return cell
+
+    def load(self, demes, genotypes, types, rates):
+        """Replace all the rows with the given cells, which must be sorted by
+        deme. The cells of a deme take its slots in order."""
+        n = len(demes)
+        while self.capacity < n:
+            self.capacity *= 2
+        self.size = n
+        for attr, values in [("deme", demes), ("genotype", genotypes), ("type", types), ("rates", rates)]:
+            old = getattr(self, attr)
+            new = np.zeros((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:n] = values
+            setattr(self, attr, new)
+        self.deme_size = np.bincount(demes, minlength=self.n_demes).astype(np.int64)
+        starts = np.cumsum(self.deme_size) - self.deme_size
+        self.slot = np.zeros(self.capacity, dtype=np.int32)
+        self.slot[:n] = np.arange(n) - np.repeat(starts, self.deme_size)
+        self.members = {deme: np.arange(starts[deme], starts[deme] + self.deme_size[deme], dtype=np.int32)
+                        for deme in np.flatnonzero(self.deme_size).tolist()}
+
+    def get_genotype_id(self, idx):
+        return int(self.genotype[idx])
+
+    def _append(self, deme, genotype, celltype, rates):
+        if self.size == self.capacity:
+            self._grow()
+        idx = self.size
+        self._add_member(deme, idx)
+        self.deme[idx] = deme
+        self.genotype[idx] = genotype
+        self.type[idx] = celltype
+        self.rates[idx] = rates
+        self.size = idx + 1
+        return idx
+
+    def _add_member(self, deme, idx):
+        if deme not in self.members:
+            self.members[deme] = np.zeros(4, dtype=np.int32)
+        members = self.members[deme]
+        slot = self.deme_size[deme]
+        if slot == members.shape[0]:
+            members = np.concatenate([members, np.zeros_like(members)])
+            self.members[deme] = members
+        members[slot] = idx
+        self.deme_size[deme] = slot + 1
+        self.slot[idx] = slot
+
+    def _grow(self):
+        self.capacity *= 2
+        for attr in ["deme", "genotype", "type", "slot", "rates"]:
+            old = getattr(self, attr)
+            new = np.zeros((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, attr, new)
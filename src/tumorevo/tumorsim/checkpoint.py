@@ -0,0 +1,29 @@
+"""
+Snapshots of a running simulation, to resume it later from the same state.
+"""
+import gzip
+import os
+import pickle
+
+SNAPSHOT_VERSION = 7
+
+
+def save_snapshot(path, **state):
+    """Write the simulation state to a compressed, versioned snapshot. The
+    file is replaced atomically so that an interrupted save keeps the
+    previous snapshot."""
+    state = dict(state, version=SNAPSHOT_VERSION)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=3) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    """Read a snapshot. The random streams are part of the tumor's state."""
+    with gzip.open(path, "rb") as f:
+        state = pickle.load(f)
+    version = state.get("version", 0)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {version} is not supported (expected {SNAPSHOT_VERSION}).")
+    return state
@@ -0,0 +1,64 @@
+from .cellstore import CELL_TYPES
+
+import numpy as np
+
+# Normal cell types are fixed clones with reserved IDs
+NORMAL_CLONES = {celltype: clone for clone, celltype in enumerate(CELL_TYPES[1:])}
+
+
+class CloneRegistry(object):
+    """Tumor-wide registry of clones. Each new genotype gets the next integer
+    ID, and its parent, birth time and founding deme are kept in NumPy
+    arrays. IDs are only turned into display strings when writing outputs."""
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.parent = np.zeros(capacity, dtype=np.int32)
+        self.birth_time = np.zeros(capacity, dtype=np.float64)
+        self.founding_deme = np.zeros(capacity, dtype=np.int32)
+        for celltype in NORMAL_CLONES:
+            self.register()
+
+    def __len__(self):
+        return self.size
+
+    def register(self, parent=-1, deme=-1, time=0.0):
+        """Add a new clone and return its ID. `time` is the tumor's clock,
+        which counts steps unless the next-reaction scheduler is used."""
+        if self.size == self.parent.shape[0]:
+            for attr in ["parent", "birth_time", "founding_deme"]:
+                old = getattr(self, attr)
+                new = np.zeros(2 * old.shape[0], dtype=old.dtype)
+                new[: self.size] = old
+                setattr(self, attr, new)
+        clone = self.size
+        self.parent[clone] = parent
+        self.birth_time[clone] = time
+        self.founding_deme[clone] = deme
+        self.size += 1
+        return clone
+
+    def is_normal(self, clone):
+        return clone < len(NORMAL_CLONES)
+
+    def get_label(self, clone):
+        if clone < 0:
+            return ""
+        if self.is_normal(clone):
+            return CELL_TYPES[1 + clone]
+        return str(clone)
+
+    def get_labels(self, clones):
+        return [self.get_label(clone) for clone in clones]
+
+    def get_parents(self):
+        """Parent of each cancer clone with a parent, keyed by clone ID."""
+        clones = np.where(self.parent[: self.size] >= 0)[0]
+        return {int(clone): int(self.parent[clone]) for clone in clones}
+
+    def get_table(self):
+        return dict(
+            parent=self.parent[: self.size],
+            birth_time=self.birth_time[: self.size],
+            founding_deme=self.founding_deme[: self.size],
+        )
@@ -0,0 +1,68 @@
+import numpy as np
+
+from collections import Counter
+
+
+class GenotypeCounts(Counter):
+    """Counter of cells per genotype which is updated by deltas and only
+    keeps genotypes with live cells."""
+
+    def add(self, genotype_id, delta=1):
+        count = self.get(genotype_id, 0) + delta
+        if count > 0:
+            self[genotype_id] = count
+        elif count == 0:
+            self.pop(genotype_id, None)
+        else:
+            raise ValueError(f"Negative count for genotype {genotype_id}")
+
+
+class IndexSet(object):
+    """Set of integers in [0, size) with O(1) membership, insertion, removal
+    and uniform sampling. Items are kept packed in an array, and removal
+    moves the last item into the removed one's place."""
+
+    def __init__(self, size):
+        self.items = np.empty(size, dtype=np.int64)
+        self.positions = np.full(size, -1, dtype=np.int64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, item):
+        return self.positions[item] >= 0
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def add(self, item):
+        if self.positions[item] >= 0:
+            return
+        self.items[self.n] = item
+        self.positions[item] = self.n
+        self.n += 1
+
+    def remove(self, item):
+        pos = self.positions[item]
+        if pos < 0:
+            raise KeyError(item)
+        last = self.items[self.n - 1]
+        self.items[pos] = last
+        self.positions[last] = pos
+        self.positions[item] = -1
+        self.n -= 1
+
+    def grow(self, size):
+        """Extend the range of items to [0, size)."""
+        if size <= len(self.positions):
+            return
+        self.items = np.concatenate([self.items, np.empty(size - len(self.items), dtype=np.int64)])
+        self.positions = np.concatenate([self.positions, np.full(size - len(self.positions), -1, dtype=np.int64)])
+
+    def to_array(self):
+        return self.items[: self.n].copy()
+
+    def sample(self, size, rng):
+        """Distinct items drawn uniformly, in O(size)."""
+        return self.items[rng.choice(self.n, size=size, replace=False)]
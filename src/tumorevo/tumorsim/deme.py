@@ -1,154 +1,262 @@
 import numpy as np
 
+from .cellstore import *
+from .counts import GenotypeCounts
+from .clones import NORMAL_CLONES
+
 from collections import Counter
 import logging
 
+N_SAMPLED = 5 # cells tried per deme update
+
 
 class Deme(object):
-    def __init__(
-        self,
-        cell=None,
-        carrying_capacity=1,
-        initial_death_rate=0.1,
-        maximum_death_rate=0.5,
-        tumor=None,
-        row=None,
-        col=None,
-    ):
-        if cell is None and tumor is None:
+    """View of one deme of the tumor's grid. The deme's parameters and per-type
+    counts live in the tumor's arrays, and its cells in the tumor's cell store,
+    so views are cheap and only created for demes that are used."""
+
+    def __init__(self, tumor=None, index=None):
+        if tumor is None:
             raise ValueError(
-                "Must initialise Deme with either a Cell or a Tumor object."
+                "Must initialise Deme with a Tumor object, which holds the cells."
             )
-        self.carrying_capacity = carrying_capacity
-        self.initial_death_rate = initial_death_rate
-        self.maximum_death_rate = maximum_death_rate
         self.tumor = tumor
-        self.row = row
-        self.col = col
-        self.types_counts = Counter()
-        self.genotypes_counts = Counter()
-        self.genotypes_parents = dict()
-        self.cells = set()
-
-        if cell is not None:
-            self.add_cell(cell)
-
-    def add_cell(self, cell, genotype_id=None):
-        if genotype_id is None:
-            if cell.type == 'cancer':
-                cell.genotype_id = str(cell.genotype_id)
-            else:
-                cell.genotype_id = cell.type    
-        else:
-            cell.genotype_id = genotype_id
-        self.cells.add(cell)
-        if cell.genotype_id in self.genotypes_counts:
-            self.genotypes_counts[cell.genotype_id] += 1
-        else:
-            self.genotypes_counts[cell.genotype_id] = 1
-        
-        if cell.type in self.types_counts:
-            self.types_counts[cell.type] += 1
-        else:
-            self.types_counts[cell.type] = 1            
+        self.index = index
+        self.coords = tuple(tumor.get_coords(index).tolist())
+        self.row, self.col = self.coords[:2]
 
-    def update(self, treat=False, treatment_target=None, rng=None):
-        cells_killed = 0
+    @property
+    def carrying_capacity(self):
+        return self.tumor.carrying_capacity[self.index]
+
+    @property
+    def initial_death_rate(self):
+        return self.tumor.initial_death_rate[self.index]
+
+    @property
+    def maximum_death_rate(self):
+        return self.tumor.maximum_death_rate[self.index]
+
+    @property
+    def death_rate(self):
+        return self.tumor.death_rate[self.index]
+
+    @death_rate.setter
+    def death_rate(self, value):
+        self.tumor.death_rate[self.index] = value
+
+    @property
+    def types_counts(self):
+        return Counter(dict(zip(CELL_TYPES, self.tumor.type_counts[self.index].tolist())))
+
+    @property
+    def genotypes_counts(self):
+        """Cells per clone in this deme, counted from its rows in the cell
+        store, so that views never go stale."""
+        genotypes_counts = GenotypeCounts()
+        # Normal cells that are still only counts belong to their fixed clones
+        for code in np.flatnonzero(self.tumor.normal_counts[self.index]).tolist():
+            genotypes_counts.add(NORMAL_CLONES[CELL_TYPES[code]], int(self.tumor.normal_counts[self.index, code]))
+        for genotype_id, count in Counter(self.tumor.cells.genotype[self.cells].tolist()).items():
+            genotypes_counts.add(genotype_id, count)
+        return genotypes_counts
+
+    @property
+    def cells(self):
+        """Indices of this deme's cells in the tumor's cell store."""
+        return self.tumor.cells.get_members(self.index)
+
+    @property
+    def n_cells(self):
+        return int(self.tumor.type_counts[self.index].sum())
+
+    @property
+    def n_cancer(self):
+        return int(self.tumor.type_counts[self.index, CELL_TYPE_CODES['cancer']])
+
+    def add_cell(self, cell):
+        if cell.genotype_id is None:
+            # New clone
+            parent = -1
+            if cell.parent is not None:
+                parent = cell.parent.genotype_id
+            cell.genotype_id = self.tumor.clones.register(parent, self.index, self.tumor.time)
+            # The registry has the parent's ID, and holding the parent would keep every ancestor alive
+            cell.parent = None
+        idx = self.tumor.cells.add(cell, self.index)
+        self.count_cell(cell.genotype_id, cell.type)
+        return idx
+
+    def add_copy(self, idx):
+        """Add a copy of the cell at row `idx` of the cell store to this deme."""
+        store = self.tumor.cells
+        new_idx = store.copy(idx, self.index)
+        self.count_cell(store.get_genotype_id(new_idx), CELL_TYPES[store.type[new_idx]])
+        return new_idx
+
+    def remove_cell(self, idx):
+        """Remove the cell at row `idx` and return the row that was moved into it."""
+        store = self.tumor.cells
+        self.count_cell(store.get_genotype_id(idx), CELL_TYPES[store.type[idx]], -1)
+        return store.remove(idx)
+
+    def count_cell(self, genotype_id, celltype, delta=1):
+        self.tumor.count_clone(genotype_id, delta)
+        code = CELL_TYPE_CODES[celltype]
+        self.tumor.type_counts[self.index, code] += delta
+        if celltype == 'cancer':
+            self.update_active(self.tumor.type_counts[self.index, code] - delta)
+
+    def count_cells(self, genotypes, codes, delta=1):
+        """Same as count_cell for a batch of cells, given by their clone IDs and type codes."""
+        for genotype_id, count in Counter(genotypes.tolist()).items():
+            self.tumor.count_clone(genotype_id, delta * count)
+        cancer = CELL_TYPE_CODES['cancer']
+        n_cancer = self.tumor.type_counts[self.index, cancer]
+        self.tumor.type_counts[self.index] += delta * np.bincount(codes, minlength=len(CELL_TYPES))
+        self.update_active(n_cancer)
+
+    def update_active(self, n_cancer_before):
+        # Keep the tumor's set of demes with cancer cells current
+        n_cancer = self.tumor.type_counts[self.index, CELL_TYPE_CODES['cancer']]
+        if n_cancer > 0 and n_cancer_before == 0:
+            self.tumor.set_active(self.index, True)
+            # Cancer cells interact with the normal cells, which need their own rows now
+            self.tumor.materialize(self.index)
+        elif n_cancer == 0 and n_cancer_before > 0:
+            self.tumor.set_active(self.index, False)
+
+    def update(self, treat=False, treatment_target=None, rng=None, dispersal=True):
+        """Try an event on each of up to N_SAMPLED cells of the deme. The events
+        of all the sampled cells are drawn at once from their rates, with the
+        deme's crowding as it is at the start of the update, and then applied
+        together. Without `dispersal`, daughters stay in the deme. Returns the
+        number of cells killed by treatment."""
+        tumor = self.tumor
+        store = tumor.cells
+        n_cells = self.n_cells
         # Choose subset of cells randomly
-        l = list(self.cells)
-        # l.sort(key=lambda x: x.genotype_id)
-        cells = rng.choice(
-            l, size=min(5, len(self.cells)), replace=False
-        )
-
-        # Try to apply events
-        for i, cell in enumerate(cells):
-            if cell.type == 'cancer':
-                events = ["death", "division"]
-                if treat and cell.snv[treatment_target] == 1:
-                    rates = [cell.treatment_effectiveness, cell.division_rate]
-                else:
-                    rates = [self.get_death_rate(cell.death_rate), cell.division_rate]
-                event = rng.choice(events, p=np.array(rates) / np.sum(rates))                    
-            else: # assume non-cancer cells don't divide
-                events = ['death']
-                rates = [self.get_death_rate(cell.death_rate)]
-                event = 'death'
-                
-            rates_dict = dict(zip(events, rates))
-            success = rng.binomial(1, rates_dict[event])
-            if cell.viability == 0:
-                event = "death"
-                success = 1
-            if success:
-                if event == "death":
-                    if treat and cell.snv[treatment_target] == 1:
-                        cells_killed += 1
-                    pre_death_count = self.genotypes_counts[cell.genotype_id]
-                    self.cells.remove(cell)
-                    self.genotypes_counts[cell.genotype_id] -= 1
-                    self.types_counts[cell.type] -= 1
-                    
-                    if self.genotypes_counts[cell.genotype_id] < 0:
-                        print(cell.genotype_id)
-                        print(cell.type)
-
-                    del cell    
-                elif event == "division":
-                    new_cell = cell.divide()
-                    new_cell.set_params()
-                    if cell.type == "cancer":
-                        mutate = rng.binomial(1, cell.mutation_rate)
-
-                        if mutate:
-                            new_cell.mutate(rng, self.tumor.selection.update_dict)
-                            # new_cell.genotype_id = f"{i:03}" + str(
-                            #     new_cell.genotype_id
-                            # )  # TODO: Maybe not a great idea to depend on number of cells
-                            self.genotypes_parents[
-                                new_cell.genotype_id
-                            ] = new_cell.parent.genotype_id
-                            if (
-                                self.genotypes_parents[new_cell.genotype_id]
-                                == new_cell.genotype_id
-                            ):
-                                raise Exception(
-                                    f"Oh no! genotype is its own parent?!: {new_cell.genotype_id}"
-                                )
-                            self.add_cell(new_cell, genotype_id=new_cell.genotype_id)
-                        else:
-                            disperse = rng.binomial(1, new_cell.dispersal_rate)
-                            if disperse:
-                                possible_demes = self.tumor.get_neighboring_demes(self)
-                                target_deme = rng.choice(possible_demes)                                    
-                                target_deme.add_cell(new_cell, genotype_id=new_cell.genotype_id)
-                            else:
-                                self.add_cell(new_cell, genotype_id=new_cell.genotype_id)
+        rows = store.sample(self.index, min(N_SAMPLED, n_cells), rng)
+        rates = store.rates[rows]
+
+        death = rates[:, DEATH]
+        if n_cells > self.carrying_capacity:
+            death = np.minimum(death * self.carrying_capacity, self.maximum_death_rate)
+        targeted = np.zeros(len(rows), dtype=bool)
+        if treat:
+            targeted = np.array([tumor.is_targeted(genotype, treatment_target) for genotype in store.genotype[rows].tolist()], dtype=bool)
+            death = np.where(targeted, rates[:, TREATMENT], death)
+        # assume non-cancer cells don't divide
+        division = np.where(store.type[rows] == CELL_TYPE_CODES['cancer'], rates[:, DIVISION], 0.)
+
+        # Uniforms for the event, its success, mutation, dispersal and the target deme
+        u = rng.random((5, len(rows)))
+        # Cancer cells pick death or division in proportion to their rates,
+        # and the event then happens with its own rate
+        divide = u[0] * (death + division) >= death
+        success = u[1] < np.where(divide, division, death)
+        unviable = rates[:, VIABILITY] == 0
+        die = (success & ~divide) | unviable
+        divide &= success & ~unviable
+        mutate = divide & (u[2] < rates[:, MUTATION])
+        copy = divide & ~mutate
+        targets = np.full(len(rows), self.index)
+        disperse = copy & (u[3] < rates[:, DISPERSAL])
+        if dispersal and disperse.any():
+            neighbors = tumor.get_neighbors(self.index)
+            if len(neighbors) > 0:
+                targets[disperse] = neighbors[(u[4, disperse] * len(neighbors)).astype(np.int64)]
+
+        # Daughters go in first, while the rows of their parents are in place
+        if copy.any():
+            targets = targets[copy]
+            new_rows = store.copy_many(rows[copy], targets)
+            genotypes, codes = store.genotype[new_rows], store.type[new_rows]
+            for target in set(targets.tolist()):
+                into = targets == target
+                tumor.deme_list[target].count_cells(genotypes[into], codes[into])
+        for idx in rows[mutate].tolist():
+            new_cell = store.get_cell(idx).divide()
+            new_cell.set_params()
+            new_cell.mutate(rng, tumor.selection.update_dict)
+            self.add_cell(new_cell)
+        if die.any():
+            dead = rows[die]
+            self.count_cells(store.genotype[dead], store.type[dead], -1)
+            store.remove_many(dead)
 
         # Update death rate
         self.update_death_rate()
 
-        return cells_killed
+        return int((die & targeted).sum())
+
+    def fire(self, rate_bound, treat=False, treatment_target=None, rng=None):
+        """Apply one event of the next-reaction scheduler. The deme fires at
+        `rate_bound` per cell: pick a cell uniformly and accept a death or a
+        division with probability proportional to its rates (thinning).
+        Returns the deme that gained a cell, if any, and the number of cells killed."""
+        store = self.tumor.cells
+        members = store.members[self.index]
+        idx = members[rng.integers(store.deme_size[self.index])]
+        targeted = treat and self.tumor.is_targeted(store.genotype[idx], treatment_target)
+        if targeted:
+            death_rate = store.rates[idx, TREATMENT]
+        else:
+            death_rate = self.get_death_rate(store.rates[idx, DEATH])
+        division_rate = 0.
+        if store.type[idx] == CELL_TYPE_CODES['cancer']: # assume non-cancer cells don't divide
+            division_rate = store.rates[idx, DIVISION]
+
+        u = rng.random() * rate_bound
+        target_deme = None
+        cells_killed = 0
+        if store.rates[idx, VIABILITY] == 0 or u < death_rate:
+            cells_killed = int(targeted)
+            self.remove_cell(idx)
+        elif u < death_rate + division_rate:
+            target_deme = self.divide_cell(idx, rng)
+        self.update_death_rate()
+        return target_deme, cells_killed
+
+    def divide_cell(self, idx, rng):
+        """Divide the cell at row `idx`, possibly mutating or dispersing the
+        daughter. Returns the deme the daughter was added to."""
+        store = self.tumor.cells
+        mutate = rng.binomial(1, store.rates[idx, MUTATION])
+        if mutate:
+            new_cell = store.get_cell(idx).divide()
+            new_cell.set_params()
+            new_cell.mutate(rng, self.tumor.selection.update_dict)
+            self.add_cell(new_cell)
+            return self
+        disperse = rng.binomial(1, store.rates[idx, DISPERSAL])
+        if disperse:
+            neighbors = self.tumor.get_neighbors(self.index)
+            if len(neighbors) > 0:
+                target_deme = self.tumor.deme_list[neighbors[rng.integers(len(neighbors))]]
+                target_deme.add_copy(idx)
+                return target_deme
+        self.add_copy(idx)
+        return self
 
     def get_death_rate(self, cell_death_rate):
         """Update prob of each cell dieing based on its own 
         rate and the deme's carrying capacity"""
-        if len(self.cells) <= self.carrying_capacity:
+        if self.n_cells <= self.carrying_capacity:
             return cell_death_rate
         else:
             return min(cell_death_rate * self.carrying_capacity, self.maximum_death_rate)
 
     def update_death_rate(self):
-        if len(self.cells) <= self.carrying_capacity:
+        if self.n_cells <= self.carrying_capacity:
             self.death_rate = self.initial_death_rate
         else:
             self.death_rate = self.maximum_death_rate
 
     def get_genotype_frequencies(self, normalize=True):
         # Get unique genotypes and their frequencies
-        genotypes = np.vstack([cell.snv for cell in self.cells])
-        unique, counts = np.unique(genotypes, return_counts=True, axis=0)
-        freqs = np.array(counts)
+        genotypes = [genotype for genotype in self.genotypes_counts if self.genotypes_counts[genotype] > 0]
+        freqs = np.array([self.genotypes_counts[genotype] for genotype in genotypes])
         if normalize:
             freqs = freqs / np.sum(freqs)
         return genotypes, freqs
@@ -165,3 +273,28 @@ class Deme(object):
 
     def plot_tree(self):
         raise NotImplementedError
+
+
+class DemeList(object):
+    """Sequence of a tumor's deme views, which are created when first used."""
+
+    def __init__(self, tumor):
+        self.tumor = tumor
+        self.demes = dict()
+
+    def __len__(self):
+        return self.tumor.n_demes
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0 or index >= len(self):
+            raise IndexError(f"Deme {index} is out of the grid.")
+        deme = self.demes.get(index)
+        if deme is None:
+            deme = Deme(tumor=self.tumor, index=index)
+            self.demes[index] = deme
+        return deme
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
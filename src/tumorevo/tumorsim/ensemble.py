@@ -0,0 +1,137 @@
+"""
+Run many replicates of one simulation config in parallel and summarize them.
+"""
+from .modes import MODE_LIST, make_tumor
+
+import numpy as np
+import pandas as pd
+
+import multiprocessing
+import os
+import time
+
+SUMMARY_COLUMNS = [
+    "replicate",
+    "seed",
+    "n_cells",
+    "n_clones",
+    "shannon",
+    "simpson",
+    "largest_clone",
+    "n_mutations",
+    "time",
+    "seconds",
+]
+
+
+def get_replicate_seeds(random_seed, n_replicates):
+    """Independent seeds for each replicate, spawned from one SeedSequence.
+    Each replicate gets a seed for its initial tumor and one for the
+    simulation modes."""
+    seeds = []
+    for child in np.random.SeedSequence(random_seed).spawn(n_replicates):
+        tumor_seed, mode_seed = child.generate_state(2, dtype=np.uint32)
+        seeds.append((int(tumor_seed), int(mode_seed)))
+    return seeds
+
+
+def get_diversity(counts):
+    """Shannon and Simpson diversity of clone sizes."""
+    if len(counts) == 0:
+        return 0.0, 0.0
+    p = np.asarray(counts, dtype=float) / np.sum(counts)
+    return float(-np.sum(p * np.log(p))), float(1.0 - np.sum(p**2))
+
+
+def run_replicate(config, n_steps, replicate, seeds):
+    """Simulate one replicate and return its summary and final clone sizes."""
+    tumor_seed, mode_seed = seeds
+    start = time.time()
+    tumor = make_tumor(config, seed=tumor_seed)
+    tumor, traces, _, _ = MODE_LIST[config['mode']](
+        n_steps,
+        tumor,
+        seed=mode_seed,
+        progress=False,
+        **config['treatment_params'],
+        **config.get('scheduler_params', dict()),
+    )
+    clones, counts = tumor.get_genotype_frequencies(normalize=False)
+    shannon, simpson = get_diversity(counts)
+    summary = dict(
+        replicate=replicate,
+        seed=tumor_seed,
+        n_cells=int(np.sum(counts)),
+        n_clones=len(clones),
+        shannon=shannon,
+        simpson=simpson,
+        largest_clone=float(np.max(counts) / np.sum(counts)) if len(counts) > 0 else 0.0,
+        n_mutations=int(np.sum(tumor.get_mutation_prevalences() > 0)),
+        time=float(tumor.time),
+        seconds=time.time() - start,
+    )
+    clone_sizes = pd.DataFrame(dict(replicate=replicate, clone=tumor.clones.get_labels(clones), count=counts))
+    return summary, clone_sizes
+
+
+def _run_replicate(args):
+    return run_replicate(*args)
+
+
+def get_distributions(summaries, clone_sizes):
+    """Aggregate distributions over replicates: quantiles of each summary
+    statistic and a log2-binned histogram of clone sizes."""
+    stats = summaries[SUMMARY_COLUMNS[2:-1]]
+    quantiles = stats.quantile([0.05, 0.25, 0.5, 0.75, 0.95]).T
+    quantiles.columns = [f"q{int(q * 100)}" for q in quantiles.columns]
+    quantiles.insert(0, "std", stats.std())
+    quantiles.insert(0, "mean", stats.mean())
+
+    sizes = clone_sizes["count"].values
+    n_bins = int(np.ceil(np.log2(sizes.max() + 1))) if len(sizes) > 0 else 0
+    edges = 2 ** np.arange(n_bins + 1)
+    histogram = pd.DataFrame(dict(
+        min_size=edges[:-1],
+        max_size=edges[1:] - 1,
+        n_clones=np.histogram(sizes, bins=edges)[0] if n_bins > 0 else np.zeros(0, dtype=int),
+    ))
+    histogram["n_clones_per_replicate"] = histogram["n_clones"] / max(len(summaries), 1)
+    return quantiles, histogram
+
+
+def run_ensemble(config, n_steps, n_replicates, random_seed=42, n_jobs=None, output_path=None):
+    """Run replicates across a process pool. With an `output_path`, each
+    replicate's summary and clone sizes are appended to `ensemble_summary.csv`
+    and `ensemble_clone_sizes.csv` as soon as it finishes. Returns the
+    summaries, clone sizes and their aggregate distributions."""
+    seeds = get_replicate_seeds(random_seed, n_replicates)
+    jobs = [(config, n_steps, replicate, seeds[replicate]) for replicate in range(n_replicates)]
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, n_replicates), 1)
+
+    if output_path is not None:
+        summary_path = os.path.join(output_path, "ensemble_summary.csv")
+        clone_sizes_path = os.path.join(output_path, "ensemble_clone_sizes.csv")
+        for path in [summary_path, clone_sizes_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    summaries = []
+    clone_sizes = []
+    with multiprocessing.Pool(n_jobs) as pool:
+        for summary, sizes in pool.imap_unordered(_run_replicate, jobs):
+            summary = pd.DataFrame([summary], columns=SUMMARY_COLUMNS)
+            summaries.append(summary)
+            clone_sizes.append(sizes)
+            if output_path is not None:
+                summary.to_csv(summary_path, mode="a", header=not os.path.exists(summary_path), index=False)
+                sizes.to_csv(clone_sizes_path, mode="a", header=not os.path.exists(clone_sizes_path), index=False)
+
+    summaries = pd.concat(summaries, ignore_index=True).sort_values("replicate", ignore_index=True)
+    clone_sizes = pd.concat(clone_sizes, ignore_index=True).sort_values(["replicate", "count"], ascending=[True, False], ignore_index=True)
+    quantiles, histogram = get_distributions(summaries, clone_sizes)
+    if output_path is not None:
+        quantiles.to_csv(os.path.join(output_path, "ensemble_statistics.csv"))
+        histogram.to_csv(os.path.join(output_path, "ensemble_clone_size_histogram.csv"), index=False)
+    return summaries, clone_sizes, quantiles, histogram
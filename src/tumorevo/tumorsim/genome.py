@@ -0,0 +1,226 @@
+"""
+Immutable, hash-consed genomes. A genome is a tuple of segments, each segment
+holds the alleles of its paternal ('p') and maternal ('m') haplotypes, and each
+allele is a bitset (a Python int) of the mutated positions in the segment, so
+that masks can be applied with & and counted with int.bit_count. Segments and
+genomes are interned in a global table, so cells with the same genome share a
+single object, division is pointer sharing, and a mutation only allocates the
+allele, segment and genome on the changed path. The table only holds weak
+references, so the genomes of extinct clones and finished runs are freed.
+"""
+
+import numpy as np
+
+import struct
+import weakref
+
+HAPLOTYPES = ("p", "m")
+
+
+def to_bits(positions):
+    """Bitset with the given positions set."""
+    bits = 0
+    for pos in positions:
+        bits |= 1 << int(pos)
+    return bits
+
+
+def to_positions(bits):
+    positions = []
+    while bits:
+        low = bits & -bits
+        positions.append(low.bit_length() - 1)
+        bits ^= low
+    return positions
+
+
+def to_array(bits, size):
+    """Bitset as a 0/1 array of length `size`."""
+    packed = np.frombuffer(bits.to_bytes((size + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(packed, bitorder="little")[:size]
+
+
+def from_array(mask):
+    """Bitset of the nonzero entries of an array."""
+    packed = np.packbits(np.asarray(mask) != 0, bitorder="little")
+    return int.from_bytes(packed.tobytes(), "little")
+
+
+class Segment(object):
+    __slots__ = ("p", "m", "_hash", "__weakref__")
+
+    def __init__(self, p, m):
+        self.p = p
+        self.m = m
+        self._hash = hash((p, m))
+
+    def __getitem__(self, hap):
+        if hap == "p":
+            return self.p
+        elif hap == "m":
+            return self.m
+        raise KeyError(hap)
+
+    def __iter__(self):
+        return iter(HAPLOTYPES)
+
+    def __eq__(self, other):
+        return self is other or (
+            isinstance(other, Segment) and self.p == other.p and self.m == other.m
+        )
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"Segment(p={list(map(to_positions, self.p))}, m={list(map(to_positions, self.m))})"
+
+    @property
+    def copy_number(self):
+        return len(self.p) + len(self.m)
+
+    def replace(self, hap, alleles):
+        if hap == "p":
+            return Segment(alleles, self.m)
+        return Segment(self.p, alleles)
+
+
+class Genome(object):
+    __slots__ = ("segments", "_hash", "__weakref__")
+
+    def __init__(self, segments):
+        self.segments = segments
+        self._hash = hash(segments)
+
+    def __getitem__(self, seg):
+        return self.segments[seg]
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __eq__(self, other):
+        return self is other or (
+            isinstance(other, Genome) and self.segments == other.segments
+        )
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"Genome({list(self.segments)})"
+
+    def __reduce__(self):
+        # Re-intern on unpickling so that loaded genomes share objects again
+        return (_intern_genome, (self.segments,))
+
+    def get_copy_numbers(self):
+        return [segment.copy_number for segment in self.segments]
+
+    def pack(self, segment_size):
+        """Compact binary encoding: for each segment the number of paternal and
+        maternal alleles (as little-endian uint32) followed by each allele's
+        packed bits."""
+        n_bytes = (segment_size + 7) // 8
+        chunks = []
+        for segment in self.segments:
+            chunks.append(struct.pack("<II", len(segment.p), len(segment.m)))
+            for hap in segment:
+                for allele in segment[hap]:
+                    chunks.append(allele.to_bytes(n_bytes, "little"))
+        return b"".join(chunks)
+
+    def set_allele(self, seg, hap, all, muts):
+        """Return the genome with allele `all` of `hap` in `seg` replaced by the bitset `muts`."""
+        alleles = list(self.segments[seg][hap])
+        alleles[all] = GENOME_TABLE.allele(muts)
+        return self._replace_alleles(seg, hap, alleles)
+
+    def add_allele(self, seg, hap, muts):
+        """Return the genome with an extra allele `muts` in `hap` of `seg`."""
+        alleles = list(self.segments[seg][hap]) + [GENOME_TABLE.allele(muts)]
+        return self._replace_alleles(seg, hap, alleles)
+
+    def remove_allele(self, seg, hap, all):
+        """Return the genome without allele `all` of `hap` in `seg`."""
+        alleles = list(self.segments[seg][hap])
+        del alleles[all]
+        return self._replace_alleles(seg, hap, alleles)
+
+    def _replace_alleles(self, seg, hap, alleles):
+        segment = self.segments[seg].replace(hap, tuple(alleles))
+        segments = self.segments[:seg] + (segment,) + self.segments[seg + 1 :]
+        return GENOME_TABLE.genome(segments)
+
+
+class GenomeTable(object):
+    """Interning table for segments and genomes. Entries go away with the last
+    reference to their segment or genome."""
+
+    def __init__(self):
+        # Keyed by contents, which don't keep the interned objects alive
+        self.segments = weakref.WeakValueDictionary()
+        self.genomes = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.genomes)
+
+    def allele(self, muts):
+        # Alleles are ints, which can't be weakly referenced, so they are
+        # shared through their segments instead of being interned
+        return int(muts)
+
+    def segment(self, segment):
+        key = (segment.p, segment.m)
+        interned = self.segments.get(key)
+        if interned is None:
+            interned = self.segments[key] = segment
+        return interned
+
+    def genome(self, segments):
+        segments = tuple(self.segment(segment) for segment in segments)
+        genome = self.genomes.get(segments)
+        if genome is None:
+            genome = self.genomes[segments] = Genome(segments)
+        return genome
+
+    def diploid(self, n_segments):
+        """Genome with two unmutated copies of each segment."""
+        empty = (self.allele(0),)
+        return self.genome([Segment(empty, empty)] * n_segments)
+
+    def unpack(self, data, segment_size):
+        """Inverse of Genome.pack."""
+        n_bytes = (segment_size + 7) // 8
+        segments = []
+        i = 0
+        while i < len(data):
+            n_p, n_m = struct.unpack_from("<II", data, i)
+            i += 8
+            alleles = []
+            for _ in range(n_p + n_m):
+                alleles.append(self.allele(int.from_bytes(data[i : i + n_bytes], "little")))
+                i += n_bytes
+            segments.append(Segment(tuple(alleles[:n_p]), tuple(alleles[n_p:])))
+        return self.genome(segments)
+
+    def clear(self):
+        self.segments.clear()
+        self.genomes.clear()
+
+
+GENOME_TABLE = GenomeTable()
+
+
+def _intern_genome(segments):
+    table = GENOME_TABLE
+    segments = [
+        Segment(
+            tuple(table.allele(muts) for muts in segment.p),
+            tuple(table.allele(muts) for muts in segment.m),
+        )
+        for segment in segments
+    ]
+    return table.genome(segments)
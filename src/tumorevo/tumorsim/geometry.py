@@ -0,0 +1,67 @@
+"""
+Tissue structures (glands, ducts) as integer label images over the deme grid.
+
+Label 0 is stroma and label k > 0 marks the demes of structure k, including
+its wall. The wall (border) of a structure is made of its demes that touch a
+deme with another label, and is lined with epithelial cells.
+"""
+import numpy as np
+
+
+def get_disk_labels(grid_size, centers, radii):
+    """Label image of disks at `centers` (row, col) with `radii`. Where disks
+    overlap, the later one wins."""
+    centers = np.atleast_2d(np.asarray(centers, dtype=np.float64))
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(centers),))
+    labels = np.zeros((grid_size, grid_size), dtype=np.int32)
+    for k, ((row, col), radius) in enumerate(zip(centers, radii)):
+        # Demes whose centre is within the radius, only looking at the disk's bounding box
+        r0, r1 = max(int(np.floor(row - radius)), 0), min(int(np.ceil(row + radius)) + 1, grid_size)
+        c0, c1 = max(int(np.floor(col - radius)), 0), min(int(np.ceil(col + radius)) + 1, grid_size)
+        rows, cols = np.ogrid[r0:r1, c0:c1]
+        box = labels[r0:r1, c0:c1]
+        box[(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = k + 1
+    return labels
+
+
+def get_random_centers(grid_size, radii, rng):
+    """Centres for disks with `radii`, drawn uniformly so that every disk fits in the grid."""
+    radii = np.ceil(np.asarray(radii)).astype(np.int64)
+    low = np.minimum(radii, grid_size - 1)
+    high = np.maximum(grid_size - radii, low + 1)
+    return np.stack([rng.integers(low, high), rng.integers(low, high)], axis=1)
+
+
+def read_labels(path, grid_size):
+    """Label image from a .npy or .csv file."""
+    labels = np.load(path) if path.endswith(".npy") else np.loadtxt(path, delimiter=",")
+    labels = np.asarray(labels).astype(np.int32)
+    if labels.shape != (grid_size, grid_size):
+        raise ValueError(f"Label image has shape {labels.shape}, expected {(grid_size, grid_size)}.")
+    return labels
+
+
+def _differs_from_neighbor(labels):
+    # True where a von Neumann neighbour has another label. The grid's edge counts as stroma
+    padded = np.pad(labels, 1, constant_values=0)
+    center = padded[1:-1, 1:-1]
+    return (
+        (padded[:-2, 1:-1] != center)
+        | (padded[2:, 1:-1] != center)
+        | (padded[1:-1, :-2] != center)
+        | (padded[1:-1, 2:] != center)
+    )
+
+
+def get_borders(labels):
+    """Mask of the demes in the walls of the structures."""
+    return (labels > 0) & _differs_from_neighbor(labels)
+
+
+def get_inner_rims(labels):
+    """Mask of the demes inside the structures that touch their walls."""
+    borders = get_borders(labels)
+    inside = np.where((labels > 0) & ~borders, labels, 0)
+    padded = np.pad(borders, 1, constant_values=False)
+    touches = padded[:-2, 1:-1] | padded[2:, 1:-1] | padded[1:-1, :-2] | padded[1:-1, 2:]
+    return (inside > 0) & touches
@@ -1,10 +1,13 @@
 """
 Simulate tumor growth under different spatial models. Inspired by Noble et al, 2019.
 """
-from .cell import CancerCell
-from .selection import Selection
-from .tumor import Tumor
 from .modes import *
+from .traces import TraceRecorder
+from .results import ResultWriter, FORMATS
+from .checkpoint import save_snapshot, load_snapshot
+from .ensemble import run_ensemble
+from .sweep import load_sweep, run_sweep
+from .profiling import Profiler
 
 import numpy as np
 import pandas as pd
@@ -15,21 +18,54 @@ from pathlib import Path
 import logging
 import yaml
 
-MODE_LIST = [
-    simulate_nonspatial,
-    simulate_invasion,
-    simulate_fission,
-    simulate_boundary,
-]
+def write_record(env, writer, traces, i, spatial=True):
+    # Clone IDs are only turned into labels here
+    clones = env.clones
+    genotypes, _ = env.get_genotype_frequencies()
+    parents = {clones.get_label(clone): clones.get_label(parent) for clone, parent in env.genotypes_parents.items()}
+
+    traces.flush()
+    writer.add("trace_counts", traces.path, "trace")
+    writer.write(f"parents_{i}", pd.DataFrame([parents]))
+    writer.write(f"genotypes_{i}", env.get_genotype_data(genotypes))
+
+    if spatial:
+        genotype_matrix = env.get_genotype_matrix()
+        writer.write(f"grid_{i}", pd.DataFrame(genotype_matrix).map(clones.get_label))
+
+        # Save genotype counts per deme in this step, one (deme, clone, count) row per clone present in a deme
+        demes, genotype_ids, counts = env.get_deme_genotype_counts()
+        coords = [','.join(map(str, crd)) for crd in env.get_coords(demes).tolist()]
+        writer.write(f"genotype_counts_demes_{i}", pd.DataFrame(dict(deme=coords, clone=clones.get_labels(genotype_ids), count=counts)))
+
+
+def write_cell_data(writer, cell_data, i):
+    for mat in cell_data:
+        writer.write(f"cell_data_{i}/{mat}", cell_data[mat])
+
+
+class SimGroup(click.Group):
+    # Arguments that don't start with a subcommand are passed to `run`, so
+    # `tumorsim --sim-config ...` keeps working
+    def parse_args(self, ctx, args):
+        if len(args) > 0 and args[0] not in self.commands and args[0] not in ["--help", "-h"]:
+            args = ["run"] + list(args)
+        return super(SimGroup, self).parse_args(ctx, args)
 
 
-@click.command(help="Simulate tumor evolution under different spatial constraints.")
+@click.group(cls=SimGroup, help="Simulate tumor evolution under different spatial constraints.")
+def main():
+    pass
+
+
+@main.command(help="Simulate tumor evolution under different spatial constraints.")
 @click.option("--sim-config", type=click.Path(exists=True, dir_okay=False), help="Config file with simulation parameters")
 @click.option(
     "-s",
     "--steps",
-    default=1000,
-    help="Number of steps in simulation.",
+    default=None,
+    type=int,
+    help="Number of steps in simulation. Defaults to 1000, or to the steps of the resumed run.",
 )
 @click.option(
     "-r",
@@ -44,13 +80,23 @@ MODE_LIST = [
     "--log", default=0, help="Logging level. 0 for no logging, 1 for info, 2 for debug."
 )
 @click.option("-o", "--output-path", default="./sim_out", help="Output directory")
-def main(
+@click.option("--format", "format", default="csv", type=click.Choice(list(FORMATS)), help="Format of output tables.")
+@click.option(
+    "--checkpoint-every", default=0, help="Save a snapshot to resume from after every N steps, at the next record. 0 for none."
+)
+@click.option("--resume", default=None, type=click.Path(exists=True, dir_okay=False), help="Snapshot to resume the simulation from.")
+@click.option("--profile", is_flag=True, help="Time the phases and hot paths of the run and write a report to OUTPUT_PATH/profile.json.")
+def run(
     sim_config,
     steps,
     random_seed,
     log,
     record_after_steps,
     output_path,
+    format,
+    checkpoint_every,
+    resume,
+    profile,
 ):
     if log == 0:
         log = logging.CRITICAL
@@ -60,123 +106,139 @@ def main(
         log == logging.DEBUG
     logging.basicConfig(level=log)
 
-    with open(sim_config) as f:
-        config = yaml.safe_load(f)  
+    # Does nothing unless --profile is given
+    profiler = Profiler(enabled=profile)
+
+    if resume is not None:
+        # Everything but the number of steps comes from the snapshot, so the run continues as it was
+        with profiler.phase("load_snapshot"):
+            state = load_snapshot(resume)
+        config = state['config']
+        random_seed = state['random_seed']
+        record_after_steps = state['record_after_steps']
+        checkpoint_every = state['checkpoint_every']
+        if steps is None:
+            steps = state['steps']
+        env, traces, writer = state['tumor'], state['traces'], state['writer']
+        treatment_target, cells_killed = state['treatment_target'], state['cells_killed']
+        start = state['record']
+        output_path = writer.output_path
+        traces.truncate()
+        logging.info(f"Resuming from record {start} of {resume}.")
+    else:
+        if sim_config is None:
+            raise click.UsageError("Either --sim-config or --resume is required.")
+        with open(sim_config) as f:
+            config = yaml.safe_load(f)
+        if steps is None:
+            steps = 1000
+        if record_after_steps <= 0:
+            record_after_steps = steps
+
+        with profiler.phase("make_tumor"):
+            env = make_tumor(config, seed=random_seed)
+
+        # Make output directory
+        Path(output_path).mkdir(parents=True, exist_ok=True)
 
-    cancer_cell = CancerCell(
-        n_segments=config['cell_params']['n_segments'],
-        seed=random_seed,
-        **config['cell_params']['cancer_params'],
-    )
+        writer = ResultWriter(output_path, format=format, mode=config['mode'], steps=steps,
+                              random_seed=random_seed, record_after_steps=record_after_steps)
+
+        # Clone sizes are streamed to a single file as the simulation runs
+        trace_path = os.path.join(output_path, "trace_counts.csv" if format == "csv" else "trace_counts")
+        traces = TraceRecorder(path=trace_path, clones=env.clones, format=format)
+        treatment_target, cells_killed = -1, 0
+        start = 0
+
+    records = max(int(steps/record_after_steps), 1)
+    writer.manifest['metadata']['steps'] = steps
+
+    with profiler.instrument():
+        for i in range(start, records):
+            with profiler.phase("simulate"):
+                env, traces, treatment_target, cells_killed = MODE_LIST[config['mode']](
+                    record_after_steps,
+                    env,
+                    traces=traces,
+                    treatment_target=treatment_target,
+                    cells_killed=cells_killed,
+                    seed=random_seed + i,
+                    **config['treatment_params'],
+                    **config.get('scheduler_params', dict()),
+                )
+            with profiler.phase("write_record"):
+                write_record(env, writer, traces, i, spatial=config['mode'] > 0)
+
+            with profiler.phase("write_cell_data"):
+                if i == 0:
+                    # Make gene data
+                    gene_data = env.get_gene_data()
+                    for mat in gene_data:
+                        writer.write(f"gene_data/{mat}", gene_data[mat])
+                else:
+                    # Make cells by genotypes matrix
+                    write_cell_data(writer, env.get_cell_data(), i)
+
+            if checkpoint_every > 0 and ((i+1)*record_after_steps) // checkpoint_every > (i*record_after_steps) // checkpoint_every:
+                with profiler.phase("save_snapshot"):
+                    save_snapshot(os.path.join(output_path, "snapshot.pkl.gz"),
+                                  tumor=env, traces=traces, writer=writer, record=i+1,
+                                  treatment_target=treatment_target, cells_killed=cells_killed,
+                                  config=config, steps=steps, random_seed=random_seed,
+                                  record_after_steps=record_after_steps, checkpoint_every=checkpoint_every)
+                logging.info(f"Saved snapshot after record {i}.")
+
+            profiler.sample(env, traces, step=(i+1)*record_after_steps)
+
+        # Make cells by genes matrices
+        with profiler.phase("write_cell_data"):
+            env.set_cell_exps()
+            write_cell_data(writer, env.get_cell_data(), records-1)
+
+    if profile:
+        profile_path = os.path.join(output_path, "profile.json")
+        profiler.write(profile_path, steps=(records-start)*record_after_steps, mode=config['mode'],
+                       scheduler=config.get('scheduler_params', dict()).get('scheduler', "steps"),
+                       start_record=start, records=records)
+        writer.add("profile", profile_path, "profile")
 
-    selection = Selection(
-        n_segments=cancer_cell.n_segments,
-        **config['selection_params'],
-    )
+    print(f"Simulation in mode {config['mode']} finished.")
 
-    tumor = Tumor(cancer_cell, selection,
-                  epithelial_cell_params=config['cell_params']['epithelial_params'],
-                    stromal_cell_params=config['cell_params']['stromal_params'],
-                    immune_cell_params=config['cell_params']['immune_params'],
-                    deme_params=config['deme_params'],
-                    **config['spatial_params'])
+    print(f"Saved results to {output_path}.")
 
-    if record_after_steps > 0:
-        records = int(steps/record_after_steps)
-    else:
-        records = 1
-        record_after_steps = steps
-    envs = []
-    env, traces, treatment_target, cells_killed = MODE_LIST[config['mode']](
-        record_after_steps,
-        tumor,
-        seed=random_seed,
-        **config['treatment_params'],
-    )
-    genotypes, _ = env.get_genotype_frequencies()
-    parents = env.genotypes_parents
 
-    # Make output directory
+@main.command(help="Run replicates of a simulation in parallel and summarize them.")
+@click.option("--sim-config", required=True, type=click.Path(exists=True, dir_okay=False), help="Config file with simulation parameters")
+@click.option("-n", "--replicates", default=10, help="Number of replicates.")
+@click.option("-s", "--steps", default=1000, help="Number of steps in each replicate.")
+@click.option("-r", "--random_seed", default=42, help="Seed from which the replicates' seeds are spawned.")
+@click.option("-j", "--jobs", default=None, type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+@click.option("-o", "--output-path", default="./ensemble_out", help="Output directory")
+def ensemble(sim_config, replicates, steps, random_seed, jobs, output_path):
+    with open(sim_config) as f:
+        config = yaml.safe_load(f)
     Path(output_path).mkdir(parents=True, exist_ok=True)
-
-    pd.DataFrame([t["genotypes_counts"] for t in traces]).fillna(0).to_csv(
-        os.path.join(output_path, "trace_counts_0.csv")
+    summaries, clone_sizes, quantiles, histogram = run_ensemble(
+        config, steps, replicates, random_seed=random_seed, n_jobs=jobs, output_path=output_path
     )
-    pd.DataFrame([parents]).to_csv(os.path.join(output_path, "parents_0.csv"))
-    pd.DataFrame(genotypes).to_csv(os.path.join(output_path, "genotypes_0.csv"))
-
-    # Make gene data
-    gene_data = env.get_gene_data()
-    Path(os.path.join(output_path, 'gene_data')).mkdir(parents=True, exist_ok=True)
-    for mat in gene_data:
-        pd.DataFrame(gene_data[mat]).to_csv(os.path.join(output_path, 'gene_data', f'{mat}.csv'))
-
-    if config['mode'] > 0:
-        genotype_matrix = env.get_genotype_matrix()
-        pd.DataFrame(genotype_matrix).to_csv(os.path.join(output_path, "grid_0.csv"))
-
-        # Save genotype counts per deme in this step
-        coords = []
-        gcounts = []
-        for deme in env.deme_list:
-            coords.append(f'{deme.row},{deme.col}')
-            gcounts.append(deme.genotypes_counts)
-        df = pd.DataFrame(gcounts).fillna(0)
-        df.index = coords
-        df.to_csv(os.path.join(output_path, f"genotype_counts_demes_0.csv"))
-
-    for i in range(1, records):
-        env, traces, treatment_target, cells_killed = MODE_LIST[config['mode']](
-            record_after_steps,
-            env,
-            traces=traces,
-            treatment_target=treatment_target,
-            cells_killed=cells_killed,
-            seed=random_seed + i,
-            **config['treatment_params'],         
-        )
-        genotypes, _ = env.get_genotype_frequencies()
-        parents = env.genotypes_parents
-
-
-        Path(output_path).mkdir(parents=True, exist_ok=True)
-        pd.DataFrame([t["genotypes_counts"] for t in traces]).fillna(0).to_csv(
-            os.path.join(output_path, f"trace_counts_{i}.csv")
-        )
-        pd.DataFrame([parents]).to_csv(os.path.join(output_path, f"parents_{i}.csv"))
-        pd.DataFrame(genotypes).to_csv(os.path.join(output_path, f"genotypes_{i}.csv"))
-
-        # Make cells by genotypes matrix
-        cell_data = env.get_cell_data()
-        Path(os.path.join(output_path, f'cell_data_{i}')).mkdir(parents=True, exist_ok=True)
-        for mat in cell_data:
-            os.mkdir(exists_ok=True)
-            pd.DataFrame(cell_data[mat]).to_csv(os.path.join(output_path, f'cell_data_{i}', f'{mat}.csv'))
-
-        if config['mode'] > 0:
-            genotype_matrix = env.get_genotype_matrix()
-            pd.DataFrame(genotype_matrix).to_csv(os.path.join(output_path, f"grid_{i}.csv"))
-
-            # Save genotype counts per deme in this step
-            coords = []
-            gcounts = []
-            for deme in env.deme_list:
-                coords.append(f'{deme.row},{deme.col}')
-                gcounts.append(deme.genotypes_counts)
-            df = pd.DataFrame(gcounts).fillna(0)
-            df.index = coords
-            df.to_csv(os.path.join(output_path, f"genotype_counts_demes_{i}.csv"))
-                
-    # Make cells by genes matrices
-    env.set_cell_exps()
-    cell_data = env.get_cell_data()
-    Path(os.path.join(output_path, f'cell_data_{records-1}')).mkdir(parents=True, exist_ok=True)
-    for mat in cell_data:
-        pd.DataFrame(cell_data[mat]).to_csv(os.path.join(output_path, f'cell_data_{records-1}', f'{mat}.csv'))
-
+    print(quantiles.to_string(float_format="{:.3g}".format))
+    print(f"Ran {replicates} replicates in {summaries['seconds'].sum():.1f} CPU seconds.")
+    print(f"Saved results to {output_path}.")
 
-    print(f"Simulation in mode {config['mode']} finished.")
 
+@main.command(help="Run a parameter sweep, reusing cached results.")
+@click.argument("sweep-spec", type=click.Path(exists=True, dir_okay=False))
+@click.option("-j", "--jobs", default=None, type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+@click.option("--cache-dir", default=None, help="Directory of cached results. Defaults to OUTPUT_PATH/cache.")
+@click.option("-o", "--output-path", default="./sweep_out", help="Output directory")
+def sweep(sweep_spec, jobs, cache_dir, output_path):
+    spec, base_config = load_sweep(sweep_spec)
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    if cache_dir is None:
+        cache_dir = os.path.join(output_path, "cache")
+    results, n_computed = run_sweep(spec, base_config, cache_dir, n_jobs=jobs)
+    results.to_csv(os.path.join(output_path, "sweep_results.csv"), index=False)
+    print(f"Ran {n_computed} new jobs, {len(results) - n_computed} results were cached.")
     print(f"Saved results to {output_path}.")
 
 
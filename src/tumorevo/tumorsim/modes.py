@@ -1,61 +1,173 @@
+from .cell import CancerCell
+from .selection import Selection
 from .tumor import Tumor
+from .tumor3d import Tumor3D
+from .scheduler import NextReactionScheduler
+from .parallel import CheckerboardScheduler
+from .traces import TraceRecorder
+from .rng import RandomStreams
 
 import numpy as np
 from tqdm import tqdm
-from copy import deepcopy
 
 
-def simulate_nonspatial(n_steps, tumor, traces=None, seed=42, **kwargs):
+def make_tumor(config, seed=42):
+    """Build the initial tumor described by a simulation config. Its random
+    draws come from streams keyed by `seed`."""
+    streams = RandomStreams(seed)
+
+    cancer_cell = CancerCell(
+        n_segments=config['cell_params']['n_segments'],
+        seed=seed,
+        **config['cell_params']['cancer_params'],
+    )
+
+    selection = Selection(
+        n_segments=cancer_cell.n_segments,
+        rng=streams.get("selection"),
+        **config['selection_params'],
+    )
+
+    spatial_params = dict(config['spatial_params'])
+    # 3-D tumors live on a sparse voxel grid
+    tumor_class = Tumor3D if spatial_params.pop('dims', 2) == 3 else Tumor
+    return tumor_class(cancer_cell, selection,
+                       epithelial_cell_params=config['cell_params']['epithelial_params'],
+                       stromal_cell_params=config['cell_params']['stromal_params'],
+                       immune_cell_params=config['cell_params']['immune_params'],
+                       deme_params=config['deme_params'],
+                       streams=streams,
+                       **spatial_params)
+
+
+def get_treatment(tumor, iteration, treatment_duration, treatment_iteration, treatment_target, cells_killed):
+    """Whether to treat at `iteration`, and the target gene. Treatment starts at
+    `treatment_iteration` and lasts `treatment_duration` iterations."""
+    treat = False
+    if iteration == treatment_iteration:
+        treat = True
+        # TODO: treatment types - all cells, most common mutation, immunotherapy
+        # Most common mutation among live cancer cells
+        prevalences = tumor.get_mutation_prevalences()
+        treatment_target = int(np.argmax(prevalences))
+        n_cancer_cells = sum(tumor.get_genotype_frequencies(normalize=False)[1])
+        print(f"Starting treatment with target {treatment_target}, which is present in {prevalences[treatment_target]}/{n_cancer_cells} of cells")
+    if iteration > treatment_iteration and iteration <= treatment_iteration + treatment_duration:
+        treat = True
+    if iteration > treatment_iteration + treatment_duration and treatment_target != -1:
+        print(f"Stopped treating with target {treatment_target}, killed {cells_killed} cells")
+        treatment_target = -1
+    return treat, treatment_target
+
+
+def simulate_nonspatial(n_steps, tumor, traces=None, seed=42, scheduler="steps", dt=1., n_workers=1, domain_size=32, progress=True, **kwargs):
     if traces is None:
-        traces = []
-        traces.append(dict(genotypes_counts=deepcopy(tumor.genotypes_counts)))
+        traces = TraceRecorder(clones=tumor.clones)
+    if len(traces) == 0:
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    streams = RandomStreams(seed)
+    if scheduler == "next_reaction":
+        engine = NextReactionScheduler(tumor, streams)
+    elif scheduler == "checkerboard":
+        engine = CheckerboardScheduler(tumor, seed=seed, n_workers=n_workers, domain_size=domain_size)
 
     # Simulate within-deme dynamics
-    for step in tqdm(range(n_steps - 1)):
-        rng = np.random.default_rng(seed + step)
-        tumor.update(rng=rng)
-        traces.append(dict(genotypes_counts=deepcopy(tumor.genotypes_counts)))
+    for step in tqdm(range(n_steps - 1), disable=not progress):
+        if scheduler == "next_reaction":
+            # Each step is an interval of dt in simulated time
+            engine.run(dt)
+        elif scheduler == "checkerboard":
+            # Each step updates every deme with cancer cells once
+            engine.step()
+        else:
+            tumor.update(streams)
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    if scheduler == "checkerboard":
+        engine.close()
 
     # Return tumor
-    return tumor, traces, -1
+    return tumor, traces, -1, 0
 
 
-def simulate_invasion(n_steps, tumor, traces=None, treatment_duration=10, treatment_iteration=-1, treatment_target=-1, cells_killed=0, seed=42, **kwargs):
+def simulate_invasion(n_steps, tumor, traces=None, treatment_duration=10, treatment_iteration=-1, treatment_target=-1, cells_killed=0, seed=42, scheduler="steps", dt=1., n_workers=1, domain_size=32, progress=True, **kwargs):
     if traces is None:
-        traces = []
-        traces.append(dict(genotypes_counts=deepcopy(tumor.genotypes_counts)))
+        traces = TraceRecorder(clones=tumor.clones)
+    if len(traces) == 0:
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    streams = RandomStreams(seed)
+    if scheduler == "next_reaction":
+        engine = NextReactionScheduler(tumor, streams)
+    elif scheduler == "checkerboard":
+        engine = CheckerboardScheduler(tumor, seed=seed, n_workers=n_workers, domain_size=domain_size)
 
     # Simulate tumor growth
-    for step in tqdm(range(n_steps - 1)):
-
-        treat = False
-        if len(traces) == treatment_iteration:
-            treat = True
-            # For all genotypes which are alive
-            active_genotypes = np.concatenate([np.tile(np.array(list(genotype)).astype(int), (tumor.genotypes_counts[genotype], 1)) for genotype in tumor.genotypes_counts.keys() if tumor.genotypes_counts[genotype] > 0])
-            print(active_genotypes)
-            print(active_genotypes.shape)
-            # TODO: treatment types - all cells, most common mutation, immunotherapy
-            # Most common mutation
-            treatment_target = np.argmax(np.sum(active_genotypes[:,3:] == 1, axis=0)) # Ignore first indices which is the generation, used to order the genotypes for the plots
-            prevalence = np.sum(active_genotypes[:,treatment_target+3]==1)
-            print(f"Starting treatment with target {treatment_target}, which is present in {prevalence}/{active_genotypes.shape[0]} of cells")
-        if len(traces) > treatment_iteration and len(traces) <= treatment_iteration + treatment_duration:
-            treat = True
-        if len(traces) > treatment_iteration + treatment_duration and treatment_target != -1:
-            print(f"Stopped treating with target {treatment_target}, killed {cells_killed} cells")
-            treatment_target = -1
-
-        rng = np.random.default_rng(seed + step)
-        cells_killed += tumor.update(treat=treat, treatment_target=treatment_target, rng=rng)
-        traces.append(dict(genotypes_counts=deepcopy(tumor.genotypes_counts)))
+    for step in tqdm(range(n_steps - 1), disable=not progress):
+
+        treat, treatment_target = get_treatment(tumor, len(traces), treatment_duration, treatment_iteration, treatment_target, cells_killed)
+
+        if scheduler == "next_reaction":
+            # Each step is an interval of dt in simulated time
+            if treat != engine.treat or treatment_target != engine.treatment_target:
+                engine.set_treatment(treat, treatment_target)
+            cells_killed += engine.run(dt)
+        elif scheduler == "checkerboard":
+            # Each step updates every deme with cancer cells once
+            cells_killed += engine.step(treat=treat, treatment_target=treatment_target)
+        else:
+            cells_killed += tumor.update(streams, treat=treat, treatment_target=treatment_target)
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    if scheduler == "checkerboard":
+        engine.close()
 
     # Return tumor
     return tumor, traces, treatment_target, cells_killed
 
-def simulate_fission():
-    raise NotImplementedError
+def simulate_fission(n_steps, tumor, traces=None, treatment_duration=10, treatment_iteration=-1, treatment_target=-1, cells_killed=0, seed=42, scheduler="steps", progress=True, **kwargs):
+    """Glands grow and split: only the demes on the tumor's frontier are
+    updated, daughters stay in their deme, and a frontier deme that is above
+    its carrying capacity gives half of its cancer cells to an empty neighbour."""
+    if scheduler != "steps":
+        raise ValueError(f"Fission only runs with the steps scheduler, got {scheduler}.")
+    if traces is None:
+        traces = TraceRecorder(clones=tumor.clones)
+    if len(traces) == 0:
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    streams = RandomStreams(seed)
+    for step in tqdm(range(n_steps - 1), disable=not progress):
+        treat, treatment_target = get_treatment(tumor, len(traces), treatment_duration, treatment_iteration, treatment_target, cells_killed)
+        cells_killed += tumor.update(streams, treat=treat, treatment_target=treatment_target, demes=tumor.frontier, dispersal=False, fission=True)
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    return tumor, traces, treatment_target, cells_killed
+
+
+def simulate_boundary(n_steps, tumor, traces=None, treatment_duration=10, treatment_iteration=-1, treatment_target=-1, cells_killed=0, seed=42, scheduler="steps", progress=True, **kwargs):
+    """Boundary-driven growth: only demes on the tumor's frontier are updated,
+    so the tumor's core is frozen."""
+    if scheduler != "steps":
+        raise ValueError(f"Boundary growth only runs with the steps scheduler, got {scheduler}.")
+    if traces is None:
+        traces = TraceRecorder(clones=tumor.clones)
+    if len(traces) == 0:
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    streams = RandomStreams(seed)
+    for step in tqdm(range(n_steps - 1), disable=not progress):
+        treat, treatment_target = get_treatment(tumor, len(traces), treatment_duration, treatment_iteration, treatment_target, cells_killed)
+        cells_killed += tumor.update(streams, treat=treat, treatment_target=treatment_target, demes=tumor.frontier)
+        traces.record(tumor.genotypes_counts, tumor.time)
+
+    return tumor, traces, treatment_target, cells_killed
 
 
-def simulate_boundary():
-    raise NotImplementedError
+MODE_LIST = [
+    simulate_nonspatial,
+    simulate_invasion,
+    simulate_fission,
+    simulate_boundary,
+]
@@ -0,0 +1,96 @@
+"""
+Sparse matrices of mutations, counting the mutated allele copies of each site.
+"""
+from .genome import to_positions
+
+import numpy as np
+
+
+class MutationMatrix(object):
+    """Compressed sparse row matrix with one row per clone or cell and one
+    column per site, holding the number of allele copies mutated at the site.
+
+    Files are written with the same keys as `scipy.sparse.save_npz`, so they
+    can also be read with `scipy.sparse.load_npz`. Row and column labels are
+    stored alongside.
+    """
+
+    def __init__(self, data, indices, indptr, shape, rows=None, columns=None):
+        self.data = np.asarray(data)
+        self.indices = np.asarray(indices)
+        self.indptr = np.asarray(indptr)
+        self.shape = tuple(int(n) for n in shape)
+        self.rows = rows
+        self.columns = columns
+
+    @property
+    def nnz(self):
+        return self.data.shape[0]
+
+    @classmethod
+    def from_genomes(cls, genomes, n_segments, segment_size, rows=None, columns=None):
+        """Build the matrix straight from the genomes' allele bitsets."""
+        n_sites = n_segments * segment_size
+        row_idx = []
+        sites = []
+        for i, genome in enumerate(genomes):
+            for seg in range(len(genome)):
+                for hap in genome[seg]:
+                    for all in genome[seg][hap]:
+                        if all:
+                            positions = to_positions(all)
+                            row_idx.append(np.full(len(positions), i, dtype=np.int64))
+                            sites.append(np.array(positions, dtype=np.int64) + seg * segment_size)
+        if len(sites) > 0:
+            # Each (row, site) pair appears once per mutated copy
+            keys, data = np.unique(np.concatenate(row_idx) * n_sites + np.concatenate(sites), return_counts=True)
+        else:
+            keys, data = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        row_idx, indices = np.divmod(keys, n_sites)
+        indptr = np.zeros(len(genomes) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(row_idx, minlength=len(genomes)))
+        return cls(data.astype(np.int32), indices.astype(np.int32), indptr, (len(genomes), n_sites), rows=rows, columns=columns)
+
+    def take(self, idx, rows=None):
+        """Matrix made of rows `idx`, e.g. to expand clones into cells."""
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = self.indptr[idx]
+        lengths = self.indptr[idx + 1] - starts
+        indptr = np.zeros(len(idx) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        gather = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return MutationMatrix(self.data[gather], self.indices[gather], indptr, (len(idx), self.shape[1]), rows=rows, columns=self.columns)
+
+    def toarray(self):
+        dense = np.zeros(self.shape, dtype=self.data.dtype)
+        row_idx = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        dense[row_idx, self.indices] = self.data
+        return dense
+
+    def to_frame(self):
+        """Long-format view with one row per mutated site. Only meant for small matrices."""
+        import pandas as pd
+        row_idx = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        rows = row_idx if self.rows is None else np.asarray(self.rows)[row_idx]
+        sites = self.indices if self.columns is None else np.asarray(self.columns)[self.indices]
+        return pd.DataFrame(dict(row=rows, site=sites, count=self.data))
+
+    def to_scipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    def save(self, path):
+        arrays = dict(data=self.data, indices=self.indices, indptr=self.indptr,
+                      shape=np.array(self.shape), format=np.array(b'csr'))
+        if self.rows is not None:
+            arrays['rows'] = np.asarray(self.rows, dtype=str)
+        if self.columns is not None:
+            arrays['columns'] = np.asarray(self.columns, dtype=str)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['data'], f['indices'], f['indptr'], f['shape'],
+                       rows=f['rows'] if 'rows' in f else None,
+                       columns=f['columns'] if 'columns' in f else None)
@@ -0,0 +1,432 @@
+"""
+Checkerboard-parallel updates of the deme grid.
+
+The grid is tiled into square domains, which are coloured like a 2x2
+checkerboard. A step runs four phases, one per colour. Within a phase, the
+domains of that colour are at least one domain apart, so a domain's updates
+only reach its own demes and a halo of adjacent demes that belong to idle
+domains.
+
+For the whole run, the cells live in shared memory as a demes x slots array
+of clone IDs, next to the per-deme counts and the per-clone rates, and worker
+processes update the demes of their domains in place, each domain with its
+random stream for that step (see rng.py). What a worker can't do in place is
+deferred to the end of the phase: dispersals into the halo, mutations, which
+need the clone registry, and copies into demes that are out of slots. The
+main process applies them in domain order, so results only depend on the
+seed and not on the number of workers. The tumor's cell store is rebuilt
+from the shared arrays when the scheduler is closed.
+
+In a step, every deme with cancer cells is updated once, in a random order
+within its domain, with the same per-deme rules as `Deme.update`.
+"""
+from .cellstore import CELL_TYPES, CELL_TYPE_CODES, RATES, DIVISION, DEATH, DISPERSAL, MUTATION, TREATMENT, VIABILITY
+from .clones import NORMAL_CLONES
+from .deme import N_SAMPLED
+from .rng import RandomStreams
+
+import numpy as np
+
+from collections import Counter
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+COPY_OP, MUTATE_OP = range(2)
+
+# Clone IDs of the normal cell types, by type code
+NORMAL_CLONE_CODES = [NORMAL_CLONES.get(celltype, -1) for celltype in CELL_TYPES]
+
+
+class SharedArrays(object):
+    """Named arrays that live for a whole run, in shared memory blocks if
+    worker processes need to see them. Replacing an array, e.g. to grow it,
+    puts it in a new block."""
+
+    def __init__(self, shared=True):
+        self.shared = shared
+        self.blocks = dict()
+        self.arrays = dict()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def set(self, name, array):
+        array = np.asarray(array)
+        if not self.shared:
+            self.arrays[name] = np.array(array)
+            return
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.arrays[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        self.arrays[name][...] = array
+        old = self.blocks.get(name)
+        self.blocks[name] = block
+        if old is not None:
+            old.close()
+            old.unlink()
+
+    def get_spec(self):
+        """Picklable description of the arrays for the workers."""
+        return {name: (block.name, self.arrays[name].shape, self.arrays[name].dtype.str) for name, block in self.blocks.items()}
+
+    def close(self):
+        self.arrays.clear()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks.clear()
+
+
+# Blocks attached by a worker process, by array name
+_attached = dict()
+
+
+def _attach(spec):
+    arrays = dict()
+    for name, (block_name, shape, dtype) in spec.items():
+        cached = _attached.get(name)
+        if cached is not None and cached[0] != block_name:
+            # The array was replaced, drop the view before closing the old block
+            old_block = _attached.pop(name)[1]
+            cached = None
+            old_block.close()
+        if cached is None:
+            # Pool workers share the main process' resource tracker, and the
+            # main process unlinks the blocks
+            block = shared_memory.SharedMemory(name=block_name)
+            cached = _attached[name] = (block_name, block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+        arrays[name] = cached[2]
+    return arrays
+
+
+def get_death_rate(cell_death_rate, n_cells, carrying_capacity, maximum_death_rate):
+    # Same as Deme.get_death_rate
+    if n_cells <= carrying_capacity:
+        return cell_death_rate
+    return min(cell_death_rate * carrying_capacity, maximum_death_rate)
+
+
+def get_domain_demes(domain, grid_size, domain_size):
+    """Demes of a domain, which are numbered row by row."""
+    n_domains = -(-grid_size // domain_size)
+    domain_row, domain_col = divmod(domain, n_domains)
+    rows = np.arange(domain_row * domain_size, min((domain_row + 1) * domain_size, grid_size))
+    cols = np.arange(domain_col * domain_size, min((domain_col + 1) * domain_size, grid_size))
+    return (rows[:, None] * grid_size + cols[None, :]).ravel()
+
+
+def add_cell(arrays, deme, clone):
+    """Put a cell of `clone` in the next free slot of `deme`, followed by the
+    deme's normal cells if it is its first cancer cell (as Tumor.materialize).
+    Returns False if they don't fit."""
+    slots = arrays["slots"]
+    deme_size = arrays["deme_size"]
+    type_counts = arrays["type_counts"]
+    normal_counts = arrays["normal_counts"]
+    cancer = CELL_TYPE_CODES["cancer"]
+    code = arrays["clone_type"][clone]
+    materialize = code == cancer and type_counts[deme, cancer] == 0
+    size = deme_size[deme]
+    end = size + 1 + (normal_counts[deme].sum() if materialize else 0)
+    if end > slots.shape[1]:
+        return False
+    slots[deme, size] = clone
+    type_counts[deme, code] += 1
+    size += 1
+    if materialize:
+        # Normal cells were already counted in type_counts
+        for normal_code in np.flatnonzero(normal_counts[deme]).tolist():
+            n = normal_counts[deme, normal_code]
+            slots[deme, size : size + n] = NORMAL_CLONE_CODES[normal_code]
+            size += n
+        normal_counts[deme] = 0
+    deme_size[deme] = size
+    return True
+
+
+def update_death_rate(arrays, deme):
+    # Same as Deme.update_death_rate
+    if arrays["type_counts"][deme].sum() <= arrays["carrying_capacity"][deme]:
+        arrays["death_rate"][deme] = arrays["initial_death_rate"][deme]
+    else:
+        arrays["death_rate"][deme] = arrays["maximum_death_rate"][deme]
+
+
+def update_domain(domain, demes, arrays, treat, rng):
+    """Update the demes of a domain in place. Returns the operations deferred
+    to the end of the phase, in order, the changes in the number of cells of
+    each clone, the number of cells killed by treatment, and the number of
+    births and deaths and of demes updated, for the profiler."""
+    slots = arrays["slots"]
+    deme_size = arrays["deme_size"]
+    type_counts = arrays["type_counts"]
+    clone_type = arrays["clone_type"]
+    clone_rates = arrays["clone_rates"]
+    targeted = arrays["targeted"]
+    domain_of = arrays["domain"]
+    nbr_indptr = arrays["neighbor_indptr"]
+    nbr_indices = arrays["neighbor_indices"]
+    cancer = CELL_TYPE_CODES["cancer"]
+
+    # Type, rates and treatment flag of the clones met so far, as Python values
+    clones = dict()
+
+    deferred = []
+    deltas = Counter()
+    cells_killed = 0
+    n_events = 0
+    active = demes[type_counts[demes, cancer] > 0]
+    for deme in rng.permutation(active).tolist():
+        cells = slots[deme]
+        # Demes with cancer cells have rows for all their cells
+        n_cells = int(deme_size[deme]) # crowding at the start of the update, as in Deme.update
+        capacity = arrays["carrying_capacity"][deme]
+        max_death = arrays["maximum_death_rate"][deme]
+        sampled = rng.choice(n_cells, size=min(N_SAMPLED, n_cells), replace=False).tolist()
+        for i in range(len(sampled)):
+            slot = sampled[i]
+            clone = int(cells[slot])
+            if clone not in clones:
+                clones[clone] = (int(clone_type[clone]), clone_rates[clone].tolist(), treat and bool(targeted[clone]))
+            code, rates, is_targeted = clones[clone]
+            death_rate = rates[TREATMENT] if is_targeted else get_death_rate(rates[DEATH], n_cells, capacity, max_death)
+            if code == cancer:
+                division_rate = rates[DIVISION]
+                total = death_rate + division_rate
+                divide = total > 0 and rng.random() * total >= death_rate
+                success = rng.random() < (division_rate if divide else death_rate)
+            else: # assume non-cancer cells don't divide
+                divide = False
+                success = rng.random() < death_rate
+            if rates[VIABILITY] == 0:
+                divide = False
+                success = True
+            if not success:
+                continue
+            n_events += 1
+            if not divide:
+                cells_killed += int(is_targeted)
+                deltas[clone] -= 1
+                # The deme's last cell takes the freed slot
+                last = int(deme_size[deme]) - 1
+                cells[slot] = cells[last]
+                deme_size[deme] = last
+                type_counts[deme, code] -= 1
+                # Keep the remaining sampled slots valid
+                for j in range(i + 1, len(sampled)):
+                    if sampled[j] == last:
+                        sampled[j] = slot
+            elif rng.random() < rates[MUTATION]:
+                deferred.append((MUTATE_OP, deme, clone))
+            else:
+                target = deme
+                if rng.random() < rates[DISPERSAL]:
+                    neighbors = nbr_indices[nbr_indptr[deme] : nbr_indptr[deme + 1]]
+                    if len(neighbors) > 0:
+                        target = int(neighbors[rng.integers(len(neighbors))])
+                if domain_of[target] == domain and add_cell(arrays, target, clone):
+                    deltas[clone] += 1
+                else:
+                    deferred.append((COPY_OP, target, clone))
+        update_death_rate(arrays, deme)
+    return deferred, deltas, cells_killed, n_events, len(active)
+
+
+def _update_domains(args):
+    spec, domains, grid_size, domain_size, treat, seed, use = args
+    arrays = _attach(spec)
+    streams = RandomStreams(seed)
+    return [update_domain(domain, get_domain_demes(domain, grid_size, domain_size), arrays, treat, streams.get("domain", domain, use))
+            for domain in domains]
+
+
+class CheckerboardScheduler(object):
+    def __init__(self, tumor, seed=42, n_workers=1, domain_size=32):
+        if tumor.dims != 2:
+            raise ValueError("The checkerboard scheduler only runs on 2-D tumors.")
+        self.tumor = tumor
+        self.seed = seed
+        self.streams = RandomStreams(seed)
+        self.n_workers = n_workers
+        self.domain_size = domain_size
+        self.n_steps = 0
+        self.treatment_target = None
+
+        grid_size = tumor.grid_size
+        n_domains = -(-grid_size // domain_size)
+        if tumor.periodic and n_domains > 1 and n_domains % 2 == 1:
+            # The first and last domains of a row would have the same colour and touch across the edge
+            raise ValueError(f"A periodic grid needs an even number of domains per side, got {n_domains}.")
+        rows, cols = np.divmod(np.arange(tumor.n_demes), grid_size)
+        domain_of = (rows // domain_size) * n_domains + cols // domain_size
+        domain_rows, domain_cols = np.divmod(np.arange(n_domains * n_domains), n_domains)
+        self.domain_phase = 2 * (domain_rows % 2) + domain_cols % 2
+
+        self.pool = None
+        if n_workers > 1:
+            # Start the tracker first so that the workers inherit it
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(n_workers)
+
+        self.arrays = SharedArrays(shared=self.pool is not None)
+        for name in ["carrying_capacity", "initial_death_rate", "maximum_death_rate", "death_rate",
+                     "type_counts", "normal_counts", "neighbor_indptr", "neighbor_indices"]:
+            self.arrays.set(name, getattr(tumor, name))
+        self.arrays.set("domain", domain_of)
+        self.load_cells()
+
+    def load_cells(self):
+        """Copy the cells of the tumor's store into the shared slots, and the
+        types and rates of its clones into the shared clone tables."""
+        tumor = self.tumor
+        store = tumor.cells
+        n = len(store)
+        n_slots = 16
+        while n_slots < 2 * (store.deme_size.max(initial=0) + N_SAMPLED):
+            n_slots *= 2
+        slots = np.zeros((tumor.n_demes, n_slots), dtype=np.int32)
+        slots[store.deme[:n], store.slot[:n]] = store.genotype[:n]
+        self.arrays.set("slots", slots)
+        self.arrays.set("deme_size", store.deme_size)
+
+        n_clones = max(len(tumor.clones), 1)
+        self.arrays.set("clone_type", np.zeros(n_clones, dtype=np.int8))
+        self.arrays.set("clone_rates", np.zeros((n_clones, len(RATES)), dtype=np.float32))
+        self.arrays.set("targeted", np.zeros(n_clones, dtype=bool))
+        # Cells of a clone share their type and rates
+        self.arrays["clone_type"][store.genotype[:n]] = store.type[:n]
+        self.arrays["clone_rates"][store.genotype[:n]] = store.rates[:n]
+
+    def reserve_slots(self):
+        """Double the slots of every deme."""
+        slots = self.arrays["slots"]
+        grown = np.zeros((slots.shape[0], 2 * slots.shape[1]), dtype=slots.dtype)
+        grown[:, : slots.shape[1]] = slots
+        del slots
+        self.arrays.set("slots", grown)
+
+    def reserve_clones(self, n_clones):
+        size = len(self.arrays["clone_type"])
+        if n_clones > size:
+            while size < n_clones:
+                size *= 2
+            for name in ["clone_type", "clone_rates", "targeted"]:
+                old = self.arrays[name]
+                grown = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+                grown[: len(old)] = old
+                del old
+                self.arrays.set(name, grown)
+
+    def set_treatment(self, treat, treatment_target=None):
+        """Flag the clones carrying the treatment target."""
+        if not treat or treatment_target == self.treatment_target:
+            return
+        self.treatment_target = treatment_target
+        targeted = self.arrays["targeted"]
+        targeted[:] = False
+        # Only live clones have prototypes
+        for clone in list(self.tumor.cells.prototypes):
+            if not self.tumor.clones.is_normal(clone):
+                targeted[clone] = self.tumor.is_targeted(clone, treatment_target)
+
+    def add_clone(self, parent, deme):
+        """Mutated daughter of a cell of clone `parent` in `deme`, as a new clone."""
+        tumor = self.tumor
+        store = tumor.cells
+        new_cell = store.make_cell(parent, self.arrays["clone_rates"][parent]).divide()
+        new_cell.set_params()
+        # Deferred operations are applied in the same order whatever the number of workers
+        new_cell.mutate(self.streams.get("mutation", deme), tumor.selection.update_dict)
+        clone = new_cell.genotype_id = tumor.clones.register(parent, deme, tumor.time)
+        new_cell.parent = None
+        store.prototypes[clone] = new_cell
+        self.reserve_clones(clone + 1)
+        self.arrays["clone_type"][clone] = CELL_TYPE_CODES[new_cell.type]
+        self.arrays["clone_rates"][clone] = [getattr(new_cell, rate, 0.0) for rate in RATES]
+        if self.treatment_target is not None:
+            self.arrays["targeted"][clone] = tumor.is_targeted(clone, self.treatment_target)
+        return clone
+
+    def update_phase(self, phase, treat):
+        """Update the domains of one colour that have cancer cells. Returns
+        their results in domain order."""
+        active = self.arrays["type_counts"][:, CELL_TYPE_CODES["cancer"]] > 0
+        domains = np.unique(self.arrays["domain"][active])
+        domains = domains[self.domain_phase[domains] == phase].tolist()
+        # Domains use their stream once per step
+        use = self.n_steps
+        grid_size = self.tumor.grid_size
+        if self.pool is None:
+            return [update_domain(domain, get_domain_demes(domain, grid_size, self.domain_size), self.arrays.arrays, treat,
+                                  self.streams.get("domain", domain, use)) for domain in domains]
+        # Domains are dealt to the workers in turn and their results put back in domain order
+        spec = self.arrays.get_spec()
+        chunks = [domains[i :: self.n_workers] for i in range(self.n_workers)]
+        results = self.pool.map(_update_domains, [(spec, chunk, grid_size, self.domain_size, treat, self.seed, use)
+                                                  for chunk in chunks if len(chunk) > 0])
+        ordered = [None] * len(domains)
+        for i, chunk_results in enumerate(results):
+            ordered[i :: self.n_workers] = chunk_results
+        return ordered
+
+    def apply(self, results):
+        """Apply the operations the domains deferred, in domain order. Returns
+        the number of cells killed by treatment."""
+        tumor = self.tumor
+        cells_killed = 0
+        for deferred, deltas, killed, _, _ in results:
+            cells_killed += killed
+            # Births go in before the domain's deaths, while the parents still have their prototypes
+            for op, deme, clone in deferred:
+                if op == MUTATE_OP:
+                    clone = self.add_clone(clone, deme)
+                while not add_cell(self.arrays.arrays, deme, clone):
+                    self.reserve_slots()
+                tumor.count_clone(clone, 1)
+                if op == MUTATE_OP:
+                    update_death_rate(self.arrays.arrays, deme)
+            for clone, delta in deltas.items():
+                tumor.count_clone(clone, delta)
+        return cells_killed
+
+    def step(self, treat=False, treatment_target=None):
+        """Update every deme with cancer cells once. Returns the number of
+        cells killed by treatment."""
+        self.set_treatment(treat, treatment_target)
+        # Grow before a deme is full, so that copies rarely wait for the end of a phase
+        if 2 * self.arrays["deme_size"].max() > self.arrays["slots"].shape[1]:
+            self.reserve_slots()
+        cells_killed = 0
+        for phase in range(4):
+            cells_killed += self.apply(self.update_phase(phase, treat))
+        self.n_steps += 1
+        self.tumor.time += 1
+        return cells_killed
+
+    def sync(self):
+        """Write the cells and per-deme counts back into the tumor."""
+        tumor = self.tumor
+        arrays = self.arrays
+        deme_size = arrays["deme_size"]
+        occupied = np.flatnonzero(deme_size)
+        sizes = deme_size[occupied]
+        in_use = np.arange(arrays["slots"].shape[1]) < sizes[:, None]
+        genotypes = arrays["slots"][occupied][in_use]
+        tumor.cells.load(np.repeat(occupied, sizes), genotypes, arrays["clone_type"][genotypes], arrays["clone_rates"][genotypes])
+        for name in ["type_counts", "normal_counts", "death_rate"]:
+            getattr(tumor, name)[...] = arrays[name]
+
+        # Only the demes that gained or lost all their cancer cells change the active set and the frontier
+        active = tumor.type_counts[:, CELL_TYPE_CODES["cancer"]] > 0
+        was_active = np.zeros(tumor.n_demes, dtype=bool)
+        was_active[tumor.active_demes.to_array()] = True
+        for index in np.flatnonzero(active != was_active).tolist():
+            tumor.set_active(index, active[index])
+
+    def close(self):
+        self.sync()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.arrays.close()
@@ -0,0 +1,266 @@
+"""
+Profiling of simulation runs.
+
+`tumorsim run --profile` times the phases of a run (simulating, writing
+records and cell data, saving snapshots) and the hot paths inside them,
+counts cell events, and samples the live cells, clones and the memory held by
+each part of the tumor at every record. The report is written as JSON to
+profile.json in the output directory.
+
+The hot paths are timed by wrapping the methods in HOT_PATHS on their classes
+while the run is instrumented and putting them back afterwards, so a run
+without --profile executes exactly the same code as before. Times are
+inclusive: tumor.update includes the deme.update calls it makes.
+"""
+from .tumor import Tumor, DEME_PARAMS
+from .deme import Deme
+from .cell import Cell, CancerCell
+from .cellstore import CellStore, CELL_TYPE_CODES
+from .clones import NORMAL_CLONES
+from .selection import Selection
+from .scheduler import NextReactionScheduler
+from .parallel import CheckerboardScheduler
+from .traces import TraceRecorder
+from .results import ResultWriter
+
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+PROFILE_VERSION = 1
+
+HOT_PATHS = [
+    # (class, method, name in the report)
+    (Tumor, "update", "tumor.update"),
+    (Deme, "update", "deme.update"),
+    (Deme, "fire", "deme.fire"),
+    (NextReactionScheduler, "run", "next_reaction.run"),
+    (CheckerboardScheduler, "update_phase", "checkerboard.update_phase"),
+    (CheckerboardScheduler, "apply", "checkerboard.apply"),
+    (CancerCell, "mutate", "cell.mutate"),
+    (Selection, "get_rates", "selection.get_rates"),
+    (TraceRecorder, "record", "traces.record"),
+    (TraceRecorder, "flush", "traces.flush"),
+    (ResultWriter, "write", "results.write"),
+    (Tumor, "get_cell_data", "tumor.get_cell_data"),
+    (Tumor, "set_cell_exps", "tumor.set_cell_exps"),
+]
+
+# Methods through which the demes add and remove cells, and how many cells a call adds or removes
+CELL_EVENTS = [
+    (Deme, "add_cell", lambda args: 1),
+    (Deme, "add_copy", lambda args: 1),
+    (Deme, "remove_cell", lambda args: 1),
+    (CellStore, "copy_many", lambda args: len(args[1])),
+    (CellStore, "remove_many", lambda args: len(args[1])),
+    # The checkerboard's domains count their own events
+    (CheckerboardScheduler, "apply", lambda args: sum(result[3] for result in args[1])),
+]
+
+# Methods that update demes without going through Deme.update or Deme.fire, and how many they update
+DEME_UPDATES = [
+    (CheckerboardScheduler, "apply", lambda args: sum(result[4] for result in args[1])),
+]
+
+# Tumor attributes that make up each subsystem, for the memory report
+SUBSYSTEMS = {
+    "cells": ["cells", "normal_cells"],
+    "clones": ["clones", "genotypes_counts"],
+    "demes": ["active_demes", "frontier", "n_active_neighbors", "type_counts", "normal_counts", "death_rate", "voxels"] + list(DEME_PARAMS),
+    "selection": ["selection"],
+    "expression": ["celltype_exps", "genotype_exps", "clone_exps", "clone_exp_rows"],
+}
+
+
+def _sizeof(obj, seen):
+    # Bytes held by `obj` and everything it references, counting each object
+    # once. The graph is walked with a stack, as it can be deeper than Python's
+    # recursion limit, and cells don't charge their parent to their owner.
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj) # includes the data of arrays that own it
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+            attributes = vars(obj)
+            seen.add(id(attributes))
+            size += sys.getsizeof(attributes)
+            for name, value in attributes.items():
+                if name == "parent" and isinstance(obj, Cell):
+                    continue
+                stack.append(name)
+                stack.append(value)
+    return size
+
+
+def get_memory(tumor, traces=None):
+    """Bytes held by each subsystem of `tumor`, and by the trace buffer."""
+    seen = set()
+    memory = dict()
+    for name, attributes in SUBSYSTEMS.items():
+        memory[name] = sum(_sizeof(getattr(tumor, attr), seen) for attr in attributes if hasattr(tumor, attr))
+    memory["traces"] = 0 if traces is None else _sizeof(traces, seen)
+    return memory
+
+
+def get_peak_rss():
+    """Peak resident memory of the process in bytes, None where it can't be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+
+def _timed(func, stats):
+    clock = time.perf_counter
+
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats[0] += 1
+            stats[1] += clock() - start
+    return timed
+
+
+def _counted(func, profiler, count, attr="cell_events"):
+    @functools.wraps(func)
+    def counted(*args, **kwargs):
+        setattr(profiler, attr, getattr(profiler, attr) + count(args))
+        return func(*args, **kwargs)
+    return counted
+
+
+def _get_stats(calls, seconds, wall_time):
+    return dict(
+        calls=calls,
+        seconds=seconds,
+        us_per_call=1e6 * seconds / calls if calls > 0 else None,
+        fraction=seconds / wall_time if wall_time > 0 else None,
+    )
+
+
+class Profiler(object):
+    """Wall time and call counts of the phases and hot paths of a run. A
+    disabled profiler does nothing, so callers don't need to check."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.phases = dict() # name -> [calls, seconds]
+        self.hot_paths = dict()
+        self.cell_events = 0
+        self.deme_updates = 0 # besides the timed deme.update and deme.fire calls
+        self.records = []
+        self.peak_memory = dict()
+
+    def phase(self, name):
+        """Context manager that times a phase of the run."""
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        stats = self.phases.setdefault(name, [0, 0.])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats[0] += 1
+            stats[1] += time.perf_counter() - start
+
+    @contextmanager
+    def instrument(self):
+        """Time the hot paths and count cell events inside the block."""
+        if not self.enabled:
+            yield
+            return
+        originals = []
+        try:
+            for owner, method, name in HOT_PATHS:
+                func = owner.__dict__[method]
+                originals.append((owner, method, func))
+                setattr(owner, method, _timed(func, self.hot_paths.setdefault(name, [0, 0.])))
+            for owner, method, count in CELL_EVENTS:
+                func = owner.__dict__[method]
+                originals.append((owner, method, func))
+                setattr(owner, method, _counted(func, self, count))
+            for owner, method, count in DEME_UPDATES:
+                func = owner.__dict__[method]
+                originals.append((owner, method, func))
+                setattr(owner, method, _counted(func, self, count, "deme_updates"))
+            yield
+        finally:
+            for owner, method, func in reversed(originals):
+                setattr(owner, method, func)
+
+    def sample(self, tumor, traces=None, step=0):
+        """Record the live cells and clones and the memory of each subsystem."""
+        if not self.enabled:
+            return
+        memory = get_memory(tumor, traces)
+        for name, size in memory.items():
+            self.peak_memory[name] = max(self.peak_memory.get(name, 0), size)
+        self.records.append(dict(
+            step=step,
+            time=float(tumor.time),
+            seconds=time.perf_counter() - self.start,
+            cell_events=self.cell_events,
+            n_cells=len(tumor.cells) + int(tumor.normal_counts.sum()),
+            n_cancer_cells=int(tumor.type_counts[:, CELL_TYPE_CODES["cancer"]].sum()),
+            n_clones=len(set(tumor.genotypes_counts) - set(NORMAL_CLONES.values())),
+            n_clones_total=len(tumor.clones),
+            n_active_demes=len(tumor.active_demes),
+            n_demes=int(tumor.n_demes),
+            memory=memory,
+        ))
+
+    def report(self, steps=0, **metadata):
+        """Everything measured so far as a dictionary. `steps` is the number
+        of steps simulated, for the rates."""
+        wall_time = time.perf_counter() - self.start
+        simulate = self.phases.get("simulate", [0, 0.])[1]
+        deme_updates = self.deme_updates + sum(self.hot_paths.get(name, [0, 0.])[0] for name in ["deme.update", "deme.fire"])
+        return dict(
+            version=PROFILE_VERSION,
+            metadata=metadata,
+            wall_time=wall_time,
+            phases={name: _get_stats(calls, seconds, wall_time) for name, (calls, seconds) in self.phases.items()},
+            hot_paths={name: _get_stats(calls, seconds, wall_time) for name, (calls, seconds) in self.hot_paths.items() if calls > 0},
+            events=dict(
+                steps=steps,
+                cell_events=self.cell_events,
+                deme_updates=deme_updates,
+                steps_per_second=steps / simulate if simulate > 0 else None,
+                events_per_second=self.cell_events / simulate if simulate > 0 else None,
+                deme_updates_per_second=deme_updates / simulate if simulate > 0 else None,
+            ),
+            records=self.records,
+            memory=dict(peak=self.peak_memory, peak_rss=get_peak_rss()),
+        )
+
+    def write(self, path, steps=0, **metadata):
+        report = self.report(steps=steps, **metadata)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
@@ -0,0 +1,219 @@
+"""
+Reading and writing of tumorsim results in different formats.
+
+Tables can be written as CSV, chunked compressed `.npz`, directories of
+`.npy` files that can be memory-mapped, or Parquet (requires pyarrow). In
+the binary formats, tables with a single dtype keep their values in blocks
+of columns, and mixed tables keep one array per column, so that columns can
+be loaded selectively. A `manifest.json` in the output directory lists every
+result with its file and format.
+"""
+from .mutations import MutationMatrix
+
+import numpy as np
+import pandas as pd
+
+import json
+import os
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+FORMATS = {"csv": ".csv", "npz": ".npz", "npy": "", "parquet": ".parquet"}
+CHUNK_SIZE = 1024  # columns per block in .npz files
+
+
+def get_table_path(path, format):
+    return path + FORMATS[format]
+
+
+def find_table(path):
+    """Path of the table written at `path` (without extension) in any format."""
+    for ext in [".csv", ".npz", ".parquet"]:
+        if os.path.exists(path + ext):
+            return path + ext
+    if os.path.isdir(path):
+        return path
+    raise FileNotFoundError(f"No table found at {path}.")
+
+
+def get_format(path):
+    if os.path.isdir(path):
+        return "npy"
+    for format, ext in FORMATS.items():
+        if ext != "" and path.endswith(ext):
+            return format
+    raise ValueError(f"Unknown table format: {path}")
+
+
+def _to_array(values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        # Labels are kept as fixed-width strings so no pickling is needed
+        values = np.array(["" if pd.isna(v) else str(v) for v in values.ravel()]).reshape(values.shape)
+    return values
+
+
+def _get_arrays(df, chunk_size):
+    arrays = dict(index=_to_array(df.index), columns=_to_array(df.columns))
+    dtypes = set(df.dtypes)
+    if len(dtypes) == 1 and df.shape[1] > 0:
+        values = _to_array(df.values)
+        for k, start in enumerate(range(0, df.shape[1], chunk_size)):
+            arrays[f"values_{k}"] = values[:, start : start + chunk_size]
+    else:
+        for j in range(df.shape[1]):
+            arrays[f"column_{j}"] = _to_array(df.iloc[:, j].values)
+    return arrays
+
+
+def write_table(df, path, format="csv"):
+    """Write a DataFrame to `path` plus the format's extension and return the file name."""
+    path = get_table_path(path, format)
+    if format == "csv":
+        df.to_csv(path)
+    elif format == "parquet":
+        df = df.copy()
+        df.columns = df.columns.astype(str)
+        df.to_parquet(path)
+    elif format == "npz":
+        np.savez_compressed(path, **_get_arrays(df, CHUNK_SIZE))
+    elif format == "npy":
+        os.makedirs(path, exist_ok=True)
+        for name, values in _get_arrays(df, max(df.shape[1], 1)).items():
+            np.save(os.path.join(path, f"{name}.npy"), values)
+    else:
+        raise ValueError(f"Unknown format {format}. Choose from {list(FORMATS)}.")
+    return path
+
+
+class _NpyDir(object):
+    # Mapping of array names to the .npy files of a directory, like NpzFile
+    def __init__(self, path, mmap=False):
+        self.path = path
+        self.mmap_mode = "r" if mmap else None
+        self.files = [f[:-4] for f in os.listdir(path) if f.endswith(".npy")]
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __getitem__(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode=self.mmap_mode)
+
+
+def _read_arrays(f, columns=None):
+    all_columns = f["columns"]
+    if columns is None:
+        positions = np.arange(len(all_columns))
+    else:
+        lookup = {str(c): j for j, c in enumerate(all_columns)}
+        positions = np.array([lookup[str(c)] for c in columns], dtype=np.int64)
+    index = f["index"]
+    if "values_0" in f:
+        chunk_size = max(f["values_0"].shape[1], 1)
+        if columns is None:
+            n_blocks = max(int(np.ceil(len(all_columns) / chunk_size)), 1)
+            blocks = [f[f"values_{k}"] for k in range(n_blocks)]
+            values = blocks[0] if n_blocks == 1 else np.concatenate(blocks, axis=1)
+        else:
+            # Only the blocks with requested columns are loaded
+            blocks = positions // chunk_size
+            values = None
+            for k in np.unique(blocks):
+                in_block = blocks == k
+                block = f[f"values_{k}"][:, positions[in_block] - k * chunk_size]
+                if values is None:
+                    values = np.empty((len(index), len(positions)), dtype=block.dtype)
+                values[:, in_block] = block
+        return pd.DataFrame(values, index=index, columns=all_columns[positions], copy=False)
+    return pd.DataFrame({all_columns[j]: f[f"column_{j}"] for j in positions}, index=index)
+
+
+def read_table(path, columns=None, mmap=False, dtype=None):
+    """Read a table written by `write_table`, optionally only some columns.
+    With `mmap`, tables written as .npy directories are memory-mapped."""
+    format = get_format(path)
+    if format == "csv":
+        if columns is not None:
+            header = list(pd.read_csv(path, nrows=0).columns)
+            usecols = [header[0]] + [str(c) for c in columns]
+            return pd.read_csv(path, index_col=0, usecols=usecols, dtype=dtype)[[str(c) for c in columns]]
+        return pd.read_csv(path, index_col=0, dtype=dtype)
+    if format == "parquet":
+        return pd.read_parquet(path, columns=None if columns is None else [str(c) for c in columns])
+    if format == "npz":
+        with np.load(path) as f:
+            return _read_arrays(f, columns)
+    return _read_arrays(_NpyDir(path, mmap=mmap), columns)
+
+
+def get_columns(path):
+    """Column names of a table, without loading its values."""
+    format = get_format(path)
+    if format == "csv":
+        return list(pd.read_csv(path, nrows=0).columns[1:])
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        return [c for c in pq.read_schema(path).names if not c.startswith("__index_level")]
+    if format == "npz":
+        with np.load(path) as f:
+            return list(f["columns"])
+    return list(np.load(os.path.join(path, "columns.npy")))
+
+
+class ResultWriter(object):
+    """Writes results in one format and keeps a manifest of them."""
+
+    def __init__(self, output_path, format="csv", **metadata):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format}. Choose from {list(FORMATS)}.")
+        self.output_path = output_path
+        self.format = format
+        self.manifest = dict(version=MANIFEST_VERSION, format=format, metadata=metadata, results=dict())
+
+    def write(self, name, data):
+        """Write a table or mutation matrix under `name`, which may contain
+        subdirectories, and return its path."""
+        path = os.path.join(self.output_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(data, MutationMatrix):
+            # Sparse matrices always use the scipy-compatible .npz
+            path = path + ".npz"
+            data.save(path)
+            self.add(name, path, "sparse", data.shape)
+        else:
+            df = pd.DataFrame(data)
+            path = write_table(df, path, self.format)
+            self.add(name, path, "table", df.shape)
+        return path
+
+    def add(self, name, path, kind, shape=None):
+        self.manifest["results"][name] = dict(
+            path=os.path.relpath(path, self.output_path),
+            kind=kind,
+            shape=None if shape is None else [int(n) for n in shape],
+        )
+        self.write_manifest()
+
+    def write_manifest(self):
+        with open(os.path.join(self.output_path, MANIFEST_FILE), "w") as f:
+            json.dump(self.manifest, f, indent=2)
+
+
+def read_manifest(output_path):
+    with open(os.path.join(output_path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest["version"] > MANIFEST_VERSION:
+        raise ValueError(f"Manifest version {manifest['version']} is newer than supported ({MANIFEST_VERSION}).")
+    return manifest
+
+
+def read_result(output_path, name, columns=None, mmap=False):
+    """Read a result listed in the manifest of `output_path`."""
+    entry = read_manifest(output_path)["results"][name]
+    path = os.path.join(output_path, entry["path"])
+    if entry["kind"] == "sparse":
+        return MutationMatrix.load(path)
+    if entry["kind"] == "trace":
+        from .traces import read_trace_counts
+        return read_trace_counts(path)
+    return read_table(path, columns=columns, mmap=mmap)
@@ -0,0 +1,187 @@
+"""
+Counter-based random streams.
+
+Every random draw of a simulation comes from a Philox stream keyed by
+(seed, deme, purpose), e.g. the updates of deme 12 or the placement of the
+first cancer cell (deme -1 for draws that don't belong to a deme). A stream
+is used once per event and its position in the Philox counter space is given
+by how many times the (deme, purpose) pair was used before, so the numbers a
+deme gets only depend on the seed and on its own history, and not on the
+order in which demes are visited, the scheduler or the number of workers.
+
+All streams share a single Philox generator, which is moved to a stream's
+counter and key when it needs numbers: creating a stream costs nothing and
+there is no generator per deme. Scalar uniforms, Bernoulli trials, bounded
+integers, exponentials and choices are served from a buffer of uniforms that
+is refilled in growing blocks, and so are small arrays of uniforms and small
+samples without replacement. Other draws (large arrays, permutations, ...) are
+forwarded to the generator, each one from its own part of the stream's
+counter space.
+"""
+import numpy as np
+
+PURPOSES = ["init", "selection", "expression", "schedule", "update", "mutation", "domain", "assay", "biopsy", "figure"]
+PURPOSE_CODES = {purpose: code for code, purpose in enumerate(PURPOSES)}
+
+MIN_BUFFER_SIZE = 8
+MAX_BUFFER_SIZE = 1024
+
+
+def get_key(seed, deme, purpose):
+    """Philox key of the streams of `purpose` in `deme`."""
+    return np.array([int(seed) % 2**64, ((int(deme) + 1) << 8) | PURPOSE_CODES[purpose]], dtype=np.uint64)
+
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (int, float, np.integer, np.floating))
+
+
+def get_streams(streams):
+    """`streams` itself, or the streams keyed by it if it is a seed."""
+    if isinstance(streams, RandomStreams):
+        return streams
+    return RandomStreams(streams)
+
+
+class RandomStreams(object):
+    def __init__(self, seed=42):
+        self.seed = int(seed)
+        self.bit_generator = np.random.Philox(key=get_key(seed, -1, "init"))
+        self.generator = np.random.Generator(self.bit_generator)
+        # Times each (deme, purpose) was used, at deme + 1
+        self.uses = dict()
+        # Moving the generator only writes into this state
+        self.key = get_key(seed, -1, "init")
+        self.counter = np.zeros(4, dtype=np.uint64)
+        self.state = {
+            "bit_generator": "Philox",
+            "state": {"counter": self.counter, "key": self.key},
+            "buffer": np.zeros(4, dtype=np.uint64),
+            "buffer_pos": 4,
+            "has_uint32": 0,
+            "uinteger": 0,
+        }
+
+    def get(self, purpose, deme=-1, use=None):
+        """Stream for the next use of (deme, purpose), or for use `use`."""
+        if use is None:
+            uses = self.uses.get(purpose)
+            if uses is None:
+                uses = self.uses[purpose] = []
+            if deme + 1 >= len(uses):
+                uses.extend([0] * (deme + 2 - len(uses)))
+            use = uses[deme + 1]
+            uses[deme + 1] = use + 1
+        return RandomStream(self, ((deme + 1) << 8) | PURPOSE_CODES[purpose], use)
+
+    def move_to(self, key, block, use, call):
+        """Point the generator at a block of a stream's counter space."""
+        self.key[1] = key
+        self.counter[0] = block
+        self.counter[1] = use
+        self.counter[2] = call
+        self.bit_generator.state = self.state
+        return self.generator
+
+
+class RandomStream(object):
+    """Numbers of one use of a (deme, purpose) pair, with a Generator-like interface."""
+
+    def __init__(self, streams, key, use):
+        self.streams = streams
+        self.key = key
+        self.use = use
+        self.buffer = None
+        self.pos = 0
+        self.n_blocks = 0 # Philox blocks of 4 numbers taken by the buffer so far
+        self.n_calls = 0 # draws forwarded to the generator so far
+
+    def refill(self, n=1):
+        # Grow the buffer, and make it big enough for the `n` numbers asked for
+        size = MIN_BUFFER_SIZE if self.buffer is None else min(2 * len(self.buffer), MAX_BUFFER_SIZE)
+        size = max(size, -(-n // 4) * 4)
+        generator = self.streams.move_to(self.key, self.n_blocks, self.use, 0)
+        self.buffer = generator.random(size).tolist()
+        self.n_blocks += size // 4
+        self.pos = 0
+
+    def uniform(self):
+        if self.buffer is None or self.pos == len(self.buffer):
+            self.refill()
+        u = self.buffer[self.pos]
+        self.pos += 1
+        return u
+
+    def take(self, n):
+        """List of the next `n` uniforms of the buffer."""
+        values = []
+        while n > 0:
+            if self.buffer is None or self.pos == len(self.buffer):
+                self.refill(n)
+            k = min(n, len(self.buffer) - self.pos)
+            values += self.buffer[self.pos : self.pos + k]
+            self.pos += k
+            n -= k
+        return values
+
+    def forward(self, name, *args, **kwargs):
+        self.n_calls += 1
+        generator = self.streams.move_to(self.key, 0, self.use, self.n_calls)
+        return getattr(generator, name)(*args, **kwargs)
+
+    def random(self, size=None):
+        if size is None:
+            return self.uniform()
+        shape = (size,) if _is_scalar(size) else tuple(size)
+        n = 1
+        for length in shape:
+            n *= int(length)
+        if n <= MAX_BUFFER_SIZE:
+            return np.array(self.take(n)).reshape(shape)
+        return self.forward("random", size)
+
+    def integers(self, low, high=None, size=None):
+        if size is None and _is_scalar(low) and _is_scalar(high):
+            if high is None:
+                low, high = 0, low
+            return int(low) + int(self.uniform() * (int(high) - int(low)))
+        return self.forward("integers", low, high, size)
+
+    def binomial(self, n, p, size=None):
+        if size is None and _is_scalar(n) and _is_scalar(p) and n == 1:
+            return int(self.uniform() < p)
+        return self.forward("binomial", n, p, size)
+
+    def exponential(self, scale=1.0, size=None):
+        if size is None and _is_scalar(scale):
+            return -scale * np.log1p(-self.uniform())
+        return self.forward("exponential", scale, size)
+
+    def choice(self, a, size=None, replace=True, p=None):
+        population = _is_scalar(a)
+        n = int(a) if population else len(a)
+        if size is None:
+            if p is None:
+                i = int(self.uniform() * n)
+            else:
+                cdf = np.cumsum(p)
+                i = min(int(np.searchsorted(cdf, self.uniform() * cdf[-1], side="right")), n - 1)
+            return i if population else a[i]
+        if population and not replace and p is None and _is_scalar(size) and size <= MAX_BUFFER_SIZE:
+            # Partial Fisher-Yates shuffle, only storing the swapped entries
+            if size > n:
+                raise ValueError("Cannot take a larger sample than population when replace is False")
+            swapped = dict()
+            picked = []
+            for i, u in enumerate(self.take(int(size))):
+                j = i + int(u * (n - i))
+                picked.append(swapped.get(j, j))
+                swapped[j] = swapped.get(i, i)
+            return np.array(picked, dtype=np.int64)
+        return self.forward("choice", a, size, replace, p)
+
+    def __getattr__(self, name):
+        # Any other Generator method, e.g. poisson or multinomial
+        if name.startswith("_") or not hasattr(np.random.Generator, name):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.forward(name, *args, **kwargs)
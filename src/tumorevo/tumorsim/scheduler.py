@@ -0,0 +1,165 @@
+"""
+Continuous-time simulation of tumor growth with the next-reaction method
+(Gibson and Bruck, 2000). Each deme is a reaction channel whose propensity is
+its number of cells times a tumor-wide bound on the per-cell event rates. The
+putative firing times of all demes are kept in an indexed priority queue, and
+after each event only the demes whose propensities changed are rescheduled.
+"""
+from .cellstore import DIVISION, DEATH, TREATMENT, CELL_TYPE_CODES
+
+import numpy as np
+
+
+class IndexedPriorityQueue(object):
+    """Binary min-heap of times, indexed by item so that the time of any item
+    can be changed in O(log n)."""
+
+    def __init__(self, times):
+        self.times = list(times)
+        # A sorted array is a valid heap
+        self.heap = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.pos = [0] * len(self.times)
+        for i, item in enumerate(self.heap):
+            self.pos[item] = i
+
+    def __len__(self):
+        return len(self.heap)
+
+    def top(self):
+        item = self.heap[0]
+        return item, self.times[item]
+
+    def update(self, item, time):
+        old_time = self.times[item]
+        self.times[item] = time
+        if time < old_time:
+            self._sift_up(self.pos[item])
+        elif time > old_time:
+            self._sift_down(self.pos[item])
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.pos[heap[i]] = i
+        self.pos[heap[j]] = j
+
+    def _sift_up(self, i):
+        heap, times = self.heap, self.times
+        while i > 0:
+            parent = (i - 1) // 2
+            if times[heap[i]] >= times[heap[parent]]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        heap, times = self.heap, self.times
+        n = len(heap)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and times[heap[child + 1]] < times[heap[child]]:
+                child += 1
+            if times[heap[child]] >= times[heap[i]]:
+                break
+            self._swap(i, child)
+            i = child
+
+
+class NextReactionScheduler(object):
+    def __init__(self, tumor, streams, treat=False, treatment_target=None):
+        if tumor.dims != 2:
+            # The queue has one entry per deme, and the demes of a 3-D tumor are created as it grows
+            raise ValueError("The next-reaction scheduler only runs on 2-D tumors.")
+        self.tumor = tumor
+        self.streams = streams
+        # Event times come from one stream, the events themselves from the demes' streams
+        self.rng = streams.get("schedule")
+        self.time = tumor.time
+        self.n_events = 0
+        self.set_treatment(treat, treatment_target)
+
+    def set_treatment(self, treat, treatment_target=None):
+        """Change the treatment and reschedule every deme, since the rate bound may change."""
+        self.treat = treat
+        self.treatment_target = treatment_target
+        self.rate_bound = self.get_rate_bound()
+        # Only demes with cancer cells evolve
+        type_counts = self.tumor.type_counts
+        self.propensities = (self.rate_bound * type_counts.sum(axis=1) * (type_counts[:, CELL_TYPE_CODES['cancer']] > 0)).tolist()
+        self.queue = IndexedPriorityQueue(
+            [self.draw_time(propensity) for propensity in self.propensities]
+        )
+
+    def get_rate_bound(self):
+        """Upper bound on the sum of the death and division rates of any cell."""
+        store = self.tumor.cells
+        rates = store.rates[: len(store)]
+        max_division = max(
+            [rates[:, DIVISION].max(initial=0.)]
+            + [cell.max_birth_rate for cell in store.prototypes.values() if cell.type == 'cancer']
+        )
+        max_death = max(
+            [rates[:, DEATH].max(initial=0.)]
+            + [self.tumor.maximum_death_rate.max()]
+        )
+        if self.treat:
+            max_death = max(max_death, rates[:, TREATMENT].max(initial=0.), 1.)
+        return float(max_division + max_death)
+
+    def get_propensity(self, deme):
+        # Only demes with cancer cells evolve
+        if deme.n_cancer > 0:
+            return self.rate_bound * deme.n_cells
+        return 0.
+
+    def draw_time(self, propensity):
+        if propensity > 0:
+            return self.time + self.rng.exponential(1. / propensity)
+        return np.inf
+
+    def reschedule(self, deme):
+        """Update the putative time of a deme whose propensity changed without
+        it firing, reusing its current time (Gibson and Bruck, 2000)."""
+        old = self.propensities[deme.index]
+        new = self.get_propensity(deme)
+        if new == old:
+            return
+        self.propensities[deme.index] = new
+        if new == 0:
+            time = np.inf
+        elif old == 0:
+            time = self.draw_time(new)
+        else:
+            time = self.time + (old / new) * (self.queue.times[deme.index] - self.time)
+        self.queue.update(deme.index, time)
+
+    def run(self, duration):
+        """Process events until `duration` of simulated time has passed.
+        Returns the number of cells killed by treatment."""
+        end_time = self.time + duration
+        cells_killed = 0
+        deme_list = self.tumor.deme_list
+        while True:
+            index, time = self.queue.top()
+            if time > end_time:
+                break
+            self.time = time
+            deme = deme_list[index]
+            target_deme, killed = deme.fire(
+                self.rate_bound,
+                treat=self.treat,
+                treatment_target=self.treatment_target,
+                rng=self.streams.get("update", index),
+            )
+            cells_killed += killed
+            self.n_events += 1
+            # The fired deme always draws a new time
+            self.propensities[index] = self.get_propensity(deme)
+            self.queue.update(index, self.draw_time(self.propensities[index]))
+            if target_deme is not None and target_deme is not deme:
+                self.reschedule(target_deme)
+        self.time = end_time
+        self.tumor.time = end_time
+        return cells_killed
@@ -1,12 +1,17 @@
+from .genome import from_array, to_array
+from .rng import RandomStreams
+
 import numpy as np
+from collections import OrderedDict
 
 class Selection(object):
     def __init__(self, n_segments=10, segment_size=1000, prop_driver=0.1, prop_resistance=0.1,
                  driver_effects=1.1, resistant_effects=1.1,
-                 max_ploidy=6, max_cn=12, max_nullisomy=2, max_mut_drivers=1000, ):
+                 max_ploidy=6, max_cn=12, max_nullisomy=2, max_mut_drivers=1000, rate_cache_size=100000, rng=None):
         # Fixed about the genome
         self.n_segments = n_segments
         self.segment_size = segment_size
+        self.n_genes = n_segments * segment_size
         self.prop_driver = prop_driver
         self.prop_resistance = prop_resistance
         
@@ -22,60 +27,150 @@ class Selection(object):
 
         self.drivers = []
         self.passengers = []
+        self.rate_cache = RateCache(maxsize=rate_cache_size)
+        if rng is None:
+            raise ValueError("Selection needs a random stream or a seed for its drivers and resistance genes.")
+        if isinstance(rng, (int, np.integer)):
+            rng = RandomStreams(rng).get("selection")
 
         # Put drivers and passengers in position
-        self.make_drivers()
+        self.make_drivers(rng)
+        self.make_resistant(rng)
         self.make_expmap()
         self.update_dict = {'viability': self.update_viability,
                             'division_rate': self.update_division_rate,
                             'dispersal_rate': self.update_dispersal_rate,
-                            'treatment_effectiveness': self.update_treatment_effectiveness}
+                            'treatment_effectiveness': self.update_treatment_effectiveness,
+                            'rates': self.get_rates}
 
-    def make_drivers(self): 
+    def make_drivers(self, rng):
         # supressor, notdriver, oncogene
         self.drivers = []
         self.passengers = []
         self.driver_types = []
+        # Bitsets per segment, to be applied to alleles
+        self.driver_masks = []
+        self.tsg_masks = []
+        self.oncogene_masks = []
         for _ in range(self.n_segments):
-            driver_types = np.random.choice([-1,0,1], p=[self.prop_driver/2, 1.-self.prop_driver, self.prop_driver/2], 
+            driver_types = rng.choice([-1,0,1], p=[self.prop_driver/2, 1.-self.prop_driver, self.prop_driver/2], 
                                                 size=self.segment_size)
             self.drivers.append(np.where(driver_types!=0)[0])
             self.passengers.append(np.where(driver_types==0)[0])
             self.driver_types.append(driver_types)
+            self.driver_masks.append(from_array(driver_types != 0))
+            self.tsg_masks.append(from_array(driver_types == -1))
+            self.oncogene_masks.append(from_array(driver_types == 1))
     
     def make_expmap(self):
         # Effect of snv on exp: up or down depending on wether tsg or og
         self.mul_effect = []
-        for _ in range(self.n_segments):
+        for seg in range(self.n_segments):
             mul_effect = np.ones((self.segment_size,))
-            mul_effect[np.where(self.driver_types == 1)] = 2.
-            mul_effect[np.where(self.driver_types == -1)] = 0.5
+            mul_effect[np.where(self.driver_types[seg] == 1)] = 2.
+            mul_effect[np.where(self.driver_types[seg] == -1)] = 0.5
             self.mul_effect.append(mul_effect)
+        self.mul_effects = np.concatenate(self.mul_effect)
 
     def update_exp(self, seg_baseline_exp, seg_idx, allele_muts):
-        return seg_baseline_exp * self.mul_effect[seg_idx] * allele_muts
+        return seg_baseline_exp * self.mul_effect[seg_idx] * to_array(allele_muts, self.segment_size)
 
-    def get_tsgs(self):
-        tsgs = []
+    def get_exps(self, genomes, baseline_exp):
+        """Expression of many genomes at once, as a genomes x genes matrix.
+
+        Each mutated copy of a gene adds `baseline * mul_effect` to its
+        baseline expression, and genes in segments with no copies are off.
+        Mutated alleles of all genomes are unpacked in a single call and
+        summed into a matrix of mutated copies per gene."""
+        n_genomes = len(genomes)
+        n_bytes = (self.segment_size + 7) // 8
+        copy_numbers = np.zeros((n_genomes, self.n_segments), dtype=np.int64)
+        rows = []
+        segs = []
+        chunks = []
+        for i, genome in enumerate(genomes):
+            copy_numbers[i] = genome.get_copy_numbers()
+            for seg in range(len(genome)):
+                for hap in genome[seg]:
+                    for all in genome[seg][hap]:
+                        if all: # unmutated alleles don't change expression
+                            rows.append(i)
+                            segs.append(seg)
+                            chunks.append(all.to_bytes(n_bytes, 'little'))
+
+        n_mutated = np.zeros((n_genomes, self.n_segments, self.segment_size), dtype=np.float32)
+        if len(chunks) > 0:
+            bits = np.frombuffer(b''.join(chunks), dtype=np.uint8).reshape(len(chunks), n_bytes)
+            bits = np.unpackbits(bits, axis=1, count=self.segment_size, bitorder='little')
+            # Alleles were visited in (genome, segment) order, so sum each run of equal keys
+            keys = np.array(rows) * self.n_segments + np.array(segs)
+            starts = np.concatenate([[0], np.where(np.diff(keys) != 0)[0] + 1])
+            n_mutated = n_mutated.reshape(n_genomes * self.n_segments, self.segment_size)
+            n_mutated[keys[starts]] = np.add.reduceat(bits, starts, axis=0, dtype=np.float32)
+        n_mutated = n_mutated.reshape(n_genomes, self.n_genes)
+
+        baseline_exp = np.asarray(baseline_exp, dtype=np.float32)
+        exps = baseline_exp * (1. + self.mul_effects.astype(np.float32) * n_mutated)
+        exps *= np.repeat(copy_numbers > 0, self.segment_size, axis=1)
+        return exps
+
+    def __getstate__(self):
+        # Cached rates can be recomputed, so snapshots don't carry them
+        state = dict(self.__dict__)
+        state['rate_cache'] = RateCache(maxsize=self.rate_cache.maxsize)
+        return state
+
+    def get_genes(self, masks):
+        # Genome-wide indices of the genes set in per-segment masks
+        genes = []
         for seg in range(self.n_segments):
-            idx = np.where(self.driver_types[seg] == -1)[0]
-            tsgs.append(idx + seg*self.segment_size)
-        tsgs = np.concatenate(tsgs)
-        return tsgs
+            idx = np.where(to_array(masks[seg], self.segment_size))[0]
+            genes.append(idx + seg*self.segment_size)
+        genes = np.concatenate(genes)
+        return genes
+
+    def get_tsgs(self):
+        return self.get_genes(self.tsg_masks)
 
     def get_oncogenes(self):
-        tsgs = []
+        return self.get_genes(self.oncogene_masks)
+
+    def make_resistant(self, rng):
+        self.resistance_masks = []
+        confers_resistance = []
         for seg in range(self.n_segments):
-            idx = np.where(self.driver_types[seg] == 1)[0]
-            tsgs.append(idx + seg*self.segment_size)
-        tsgs = np.concatenate(tsgs)
-        return tsgs
+            resistance = rng.binomial(1, self.prop_resistance, size=self.segment_size)
+            resistance[self.drivers[seg]] = 0
+            self.resistance_masks.append(from_array(resistance))
+            confers_resistance.append(resistance)
+        self.confers_resistance = np.concatenate(confers_resistance)
+
+    def count_drivers(self, genome):
+        # Single pass over the genome, shared by all the rate updates
+        n_mutated_drivers = 0
+        for seg in range(len(genome)):
+            driver_mask = self.driver_masks[seg]
+            for hap in genome[seg]:
+                for all in genome[seg][hap]:
+                    n_mutated_drivers += (all & driver_mask).bit_count() # more mutated copies of a gene shouldn't make a big difference though
+        return n_mutated_drivers
 
-    def make_resistant(self):
-        self.confers_resistance = np.random.binomial(1, self.prop_resistance, size=self.n_genes)
-        self.confers_resistance[self.drivers] = 0.
+    def get_rates(self, genome, baseline_division_rate, baseline_dispersal_rate, baseline_treatment_effectiveness):
+        """Viability, division rate, dispersal rate and treatment effectiveness
+        of a genome. Cells of the same genotype get the same rates, so results
+        are cached per genome and baselines."""
+        key = (genome, baseline_division_rate, baseline_dispersal_rate, baseline_treatment_effectiveness)
+        rates = self.rate_cache.get(key)
+        if rates is None:
+            n_mutated_drivers = self.count_drivers(genome)
+            rates = (self.get_viability(n_mutated_drivers),
+                     self.get_fitness(baseline_division_rate, n_mutated_drivers),
+                     self.get_fitness(baseline_dispersal_rate, n_mutated_drivers),
+                     self.get_fitness(baseline_treatment_effectiveness, n_mutated_drivers))
+            self.rate_cache.put(key, rates)
+        return rates
 
-    def update_viability(self, genome):
+    def get_viability(self, n_mutated_drivers):
         avg_ploidy = 1
         if avg_ploidy > self.max_ploidy:
             return 0
@@ -85,38 +180,56 @@ class Selection(object):
         nullisomy_count = 1
         if nullisomy_count > self.max_nullisomy:
             return 0
-        n_mutated_drivers = 1 
         if n_mutated_drivers > self.max_mut_drivers:
             return 0
         return 1
 
-    def update_division_rate(self, baseline_fitness, genome):
+    def get_fitness(self, baseline_fitness, n_mutated_drivers):
         # Make it sensible to copy number
-        fitness = baseline_fitness
-        for seg in range(len(genome)):
-            for hap in genome[seg]:
-                for all in genome[seg][hap]:
-                    fitness += self.driver_effects * len(all.intersection(self.drivers[seg])) # more mutated copies of a gene shouldn't make a big difference though
-        fitness = np.min([1., fitness])                    
+        fitness = baseline_fitness + self.driver_effects * n_mutated_drivers
+        fitness = np.min([1., fitness])
         return fitness
 
+    def update_viability(self, genome):
+        return self.get_viability(self.count_drivers(genome))
+
+    def update_division_rate(self, baseline_fitness, genome):
+        return self.get_fitness(baseline_fitness, self.count_drivers(genome))
+
     def update_dispersal_rate(self, baseline_fitness, genome):
-        # Make it sensible to copy number
-        fitness = baseline_fitness
-        for seg in range(len(genome)):
-            for hap in genome[seg]:
-                for all in genome[seg][hap]:
-                    fitness += self.driver_effects * len(all.intersection(self.drivers[seg])) # more mutated copies of a gene shouldn't make a big difference though
-        fitness = np.min([1., fitness])
-        return fitness
+        return self.get_fitness(baseline_fitness, self.count_drivers(genome))
     
     def update_treatment_effectiveness(self, baseline_fitness, genome):
-        # Make it sensible to copy number
-        fitness = baseline_fitness
-        for seg in range(len(genome)):
-            for hap in genome[seg]:
-                for all in genome[seg][hap]:
-                    fitness += self.driver_effects * len(all.intersection(self.drivers[seg])) # more mutated copies of a gene shouldn't make a big difference though
-        fitness = np.min([1., fitness])                    
-        return fitness
-    
+        return self.get_fitness(baseline_fitness, self.count_drivers(genome))
+
+
+class RateCache(object):
+    """Bounded cache with least-recently-used eviction and hit/miss counters."""
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,130 @@
+"""
+Parameter sweeps over simulation configs, with results cached by content.
+
+A sweep spec is a YAML file such as
+
+    sim_config: dcis.yaml
+    steps: 500
+    replicates: 5
+    random_seed: 42
+    axes:
+      selection_params.driver_effects: [0.5, 1.1]
+      deme_params.carrying_capacity: [1, 5]
+
+which expands into every combination of the axes' values times the
+replicates. Replicate r uses the same seeds at every point, and keeps them
+when replicates are added. Each job's result is cached under a hash of its
+resolved config, steps and seeds, so re-running a sweep only computes the
+jobs that are not in the cache yet.
+"""
+from .ensemble import SUMMARY_COLUMNS, get_replicate_seeds, run_replicate
+
+import pandas as pd
+
+from copy import deepcopy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import yaml
+
+
+def load_sweep(path):
+    """Read a sweep spec and the base config it points to."""
+    with open(path) as f:
+        spec = yaml.safe_load(f)
+    base_config = spec.get("config")
+    if base_config is None:
+        # Paths are relative to the spec
+        with open(os.path.join(os.path.dirname(os.path.abspath(path)), spec["sim_config"])) as f:
+            base_config = yaml.safe_load(f)
+    return spec, base_config
+
+
+def set_param(config, name, value):
+    """Set a parameter given by a dotted path, e.g. `deme_params.carrying_capacity`."""
+    keys = name.split(".")
+    for key in keys[:-1]:
+        config = config.setdefault(key, dict())
+    config[keys[-1]] = value
+
+
+def get_job_key(config, steps, seeds):
+    content = json.dumps(dict(config=config, steps=steps, seeds=list(seeds)), sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def expand_sweep(spec, base_config):
+    """List of jobs, one per combination of axis values and replicate."""
+    axes = spec.get("axes", dict())
+    names = list(axes)
+    n_replicates = spec.get("replicates", 1)
+    seeds = get_replicate_seeds(spec.get("random_seed", 42), n_replicates)
+    jobs = []
+    for values in itertools.product(*[axes[name] for name in names]):
+        config = deepcopy(base_config)
+        for name, value in zip(names, values):
+            set_param(config, name, value)
+        for replicate in range(n_replicates):
+            jobs.append(dict(
+                point=dict(zip(names, values)),
+                replicate=replicate,
+                config=config,
+                seeds=seeds[replicate],
+                key=get_job_key(config, spec["steps"], seeds[replicate]),
+            ))
+    return jobs
+
+
+def _run_job(args):
+    key, config, steps, replicate, seeds = args
+    summary, clone_sizes = run_replicate(config, steps, replicate, seeds)
+    return key, summary, clone_sizes["count"].tolist()
+
+
+def read_cached(cache_dir, key):
+    path = os.path.join(cache_dir, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_cached(cache_dir, key, result):
+    path = os.path.join(cache_dir, f"{key}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(result, f)
+    os.replace(path + ".tmp", path)
+
+
+def run_sweep(spec, base_config, cache_dir, n_jobs=None):
+    """Run the jobs of a sweep that are not cached yet and return a tidy
+    table with one row per job: axis values, replicate and summary."""
+    os.makedirs(cache_dir, exist_ok=True)
+    jobs = expand_sweep(spec, base_config)
+    missing = dict()
+    for job in jobs:
+        if job["key"] not in missing and read_cached(cache_dir, job["key"]) is None:
+            missing[job["key"]] = job
+
+    if len(missing) > 0:
+        if n_jobs is None:
+            n_jobs = os.cpu_count()
+        n_jobs = max(min(n_jobs, len(missing)), 1)
+        args = [(key, job["config"], spec["steps"], job["replicate"], job["seeds"]) for key, job in missing.items()]
+        with multiprocessing.Pool(n_jobs) as pool:
+            # Results are cached as they finish, so an interrupted sweep keeps them
+            for key, summary, clone_sizes in pool.imap_unordered(_run_job, args):
+                write_cached(cache_dir, key, dict(summary=summary, clone_sizes=clone_sizes))
+
+    rows = []
+    for job in jobs:
+        summary = read_cached(cache_dir, job["key"])["summary"]
+        row = dict(job["point"])
+        row.update({column: summary[column] for column in SUMMARY_COLUMNS})
+        row["replicate"] = job["replicate"]
+        row["key"] = job["key"]
+        rows.append(row)
+    results = pd.DataFrame(rows, columns=list(spec.get("axes", dict())) + SUMMARY_COLUMNS + ["key"])
+    return results, len(missing)
@@ -0,0 +1,132 @@
+from .results import read_table, write_table
+
+import numpy as np
+import pandas as pd
+
+import os
+import shutil
+
+TRACE_COLUMNS = ["step", "time", "clone", "count"]
+
+
+class TraceRecorder(object):
+    """Sparse recorder of clone sizes over time.
+
+    Each record appends one (step, clone, count) triple per live clone to
+    growable arrays. With a `path`, buffered triples are appended to a single
+    long-format CSV every `buffer_size` triples or on `flush`, and dropped
+    from memory. Clone IDs are written as the registry's labels. In formats
+    other than CSV, `path` is a directory and each flush writes a new part.
+    """
+
+    def __init__(self, path=None, clones=None, buffer_size=100000, append=False, format="csv"):
+        self.path = path
+        self.format = format
+        self.clones = clones
+        self.buffer_size = buffer_size
+        self.n_records = 0
+        self.size = 0
+        self.n_flushed = 0
+        self.step = np.zeros(1024, dtype=np.int64)
+        self.time = np.zeros(1024, dtype=np.float64)
+        self.clone = np.zeros(1024, dtype=np.int64)
+        self.count = np.zeros(1024, dtype=np.int64)
+        if path is not None and not append and os.path.exists(path):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        # Extent of the file after the last flush, to undo later writes on resume
+        self.file_size = 0
+        self.n_parts = 0
+        if path is not None and append and os.path.exists(path):
+            if os.path.isdir(path):
+                self.n_parts = len([f for f in os.listdir(path) if f.startswith("part_")])
+            else:
+                self.file_size = os.path.getsize(path)
+
+    def __len__(self):
+        return self.n_records
+
+    def record(self, genotypes_counts, time=0.0):
+        n = len(genotypes_counts)
+        while self.size + n > self.step.shape[0]:
+            self._grow()
+        end = self.size + n
+        self.step[self.size : end] = self.n_records
+        self.time[self.size : end] = time
+        self.clone[self.size : end] = list(genotypes_counts.keys())
+        self.count[self.size : end] = list(genotypes_counts.values())
+        self.size = end
+        self.n_records += 1
+        if self.path is not None and self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered triples to the trace file."""
+        if self.path is None or self.size == 0:
+            return
+        df = self.get_frame()
+        if self.format == "csv":
+            df.to_csv(self.path, mode="a", header=not os.path.exists(self.path), index=False)
+            self.file_size = os.path.getsize(self.path)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            write_table(df, os.path.join(self.path, f"part_{self.n_parts:05d}"), self.format)
+            self.n_parts += 1
+        self.n_flushed += self.size
+        self.size = 0
+
+    def truncate(self):
+        """Drop anything written to the trace file after the last flush of this
+        recorder, e.g. by a run that continued past a snapshot."""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        if os.path.isdir(self.path):
+            for f in os.listdir(self.path):
+                if f.startswith("part_") and int(f.split("_")[1].split(".")[0]) >= self.n_parts:
+                    part = os.path.join(self.path, f)
+                    if os.path.isdir(part):
+                        shutil.rmtree(part)
+                    else:
+                        os.remove(part)
+        else:
+            os.truncate(self.path, self.file_size)
+
+    def get_frame(self):
+        """Buffered triples as a long-format DataFrame."""
+        clones = self.clone[: self.size]
+        if self.clones is not None:
+            labels = np.array(self.clones.get_labels(range(len(self.clones))), dtype=object)
+            clones = labels[clones]
+        return pd.DataFrame(
+            dict(
+                step=self.step[: self.size],
+                time=self.time[: self.size],
+                clone=clones,
+                count=self.count[: self.size],
+            ),
+            columns=TRACE_COLUMNS,
+        )
+
+    def _grow(self):
+        for attr in ["step", "time", "clone", "count"]:
+            old = getattr(self, attr)
+            new = np.zeros(2 * old.shape[0], dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, attr, new)
+
+
+def read_trace_counts(path):
+    """Read a trace written by TraceRecorder as a steps x clones table of counts."""
+    if os.path.isdir(path):
+        parts = sorted(f for f in os.listdir(path) if f.startswith("part_"))
+        df = pd.concat([read_table(os.path.join(path, part)) for part in parts], ignore_index=True)
+        df["clone"] = df["clone"].astype(str)
+    else:
+        df = pd.read_csv(path, dtype=dict(clone=str))
+    counts = df.pivot_table(index="step", columns="clone", values="count", aggfunc="sum", fill_value=0)
+    counts = counts.reindex(np.arange(df["step"].max() + 1), fill_value=0)
+    counts.index.name = None
+    counts.columns.name = None
+    return counts
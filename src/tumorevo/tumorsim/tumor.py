@@ -1,264 +1,474 @@
-from .deme import Deme
-from .cell import EpithelialCell, StromalCell
+from .deme import DemeList
+from .cell import EpithelialCell, StromalCell, ImmuneCell
+from .cellstore import CellStore, CELL_TYPES, CELL_TYPE_CODES
+from .counts import GenotypeCounts, IndexSet
+from .clones import CloneRegistry, NORMAL_CLONES
+from .genome import to_positions
+from .geometry import get_borders, get_disk_labels, get_inner_rims, get_random_centers, read_labels
+from .mutations import MutationMatrix
+from .rng import get_streams
 from ..constants import *
 
 import numpy as np
 import pandas as pd
 
-from collections import Counter
 import logging
 
-def bresenham_circumference(x0, y0, radius):
-    x = radius
-    y = 0
-    err = 0
-
-    points = []
-
-    while x >= y:
-        points.append((x0 + x, y0 + y))
-        points.append((x0 + y, y0 + x))
-        points.append((x0 - y, y0 + x))
-        points.append((x0 - x, y0 + y))
-        points.append((x0 - x, y0 - y))
-        points.append((x0 - y, y0 - x))
-        points.append((x0 + y, y0 - x))
-        points.append((x0 + x, y0 - y))
-
-        y += 1
-        err += 1 + 2*y
-        if 2*(err-x) + 1 > 0:
-            x -= 1
-            err += 1 - 2*x
-
-    points = pd.DataFrame(points).drop_duplicates().values
-    points = [(p[0], p[1]) for p in points]
-    return points
-
-def get_inside(border):
-    points = []
-    for (x,y) in border:
-        # Add points inside -- general for any shape
-        # find another x with this y
-        for b in border:
-            if b[1] == y:
-                if b[0]-x > 1: # if to the right
-                    points.extend([(x_,y) for x_ in range(x+1,b[0])])
-                if b[0]-x > 1: # if to the left
-                    points.extend([(x_,y) for x_ in range(b[0],x-1)])
-    points = pd.DataFrame(points).drop_duplicates().values
-    points = [(p[0], p[1]) for p in points]
-    return points
+TOPOLOGIES = {
+    # Offsets of a deme's neighbours as (row, col)
+    "von_neumann": [(-1, 0), (0, 1), (1, 0), (0, -1)],
+    "moore": [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)],
+    # Odd rows are shifted half a deme to the right
+    "hexagonal": [
+        [(-1, -1), (-1, 0), (0, 1), (1, 0), (1, -1), (0, -1)],
+        [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (0, -1)],
+    ],
+}
+
+def get_neighbor_index(grid_size, topology="von_neumann", periodic=False):
+    """Neighbours of every deme of a square grid, as a CSR adjacency over deme
+    indices (row * grid_size + col): the neighbours of deme i are
+    `indices[indptr[i]:indptr[i+1]]`. With `periodic`, the grid wraps around
+    like a torus."""
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Unknown topology {topology}. Choose from {list(TOPOLOGIES)}.")
+    if topology == "hexagonal":
+        if periodic and grid_size % 2 == 1:
+            raise ValueError("A periodic hexagonal grid needs an even grid size.")
+        offsets = TOPOLOGIES[topology]
+    else:
+        offsets = [TOPOLOGIES[topology], TOPOLOGIES[topology]]
+
+    rows, cols = np.divmod(np.arange(grid_size * grid_size), grid_size)
+    neighbors = []
+    for even, odd in zip(*offsets):
+        # Offsets depend on the parity of the row for hexagonal grids
+        r = rows + np.where(rows % 2 == 0, even[0], odd[0])
+        c = cols + np.where(rows % 2 == 0, even[1], odd[1])
+        if periodic:
+            r, c = r % grid_size, c % grid_size
+        valid = (r >= 0) & (r < grid_size) & (c >= 0) & (c < grid_size)
+        neighbors.append(np.where(valid, r * grid_size + c, -1))
+    neighbors = np.stack(neighbors, axis=1)
+
+    valid = neighbors >= 0
+    indptr = np.zeros(grid_size * grid_size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(valid.sum(axis=1))
+    return indptr, neighbors[valid].astype(np.int64)
+
+DEME_PARAMS = dict(carrying_capacity=1, initial_death_rate=0.1, maximum_death_rate=0.5)
+
+def get_deme_map(value, grid_size):
+    """Per-deme values of a parameter as a grid_size x grid_size array. `value`
+    may be a scalar, a nested list, or the path of a .npy or .csv image."""
+    if isinstance(value, str):
+        value = np.load(value) if value.endswith(".npy") else np.loadtxt(value, delimiter=",")
+    value = np.asarray(value, dtype=np.float64)
+    if value.ndim > 0 and value.shape != (grid_size, grid_size):
+        raise ValueError(f"Deme parameter map has shape {value.shape}, expected {(grid_size, grid_size)}.")
+    return np.array(np.broadcast_to(value, (grid_size, grid_size)))
+
+def get_dominant_clones(demes, clones, counts):
+    """Most frequent clone of each deme in (deme, clone, count) triplets, the
+    lowest clone ID on ties. Returns the demes and their clones."""
+    order = np.lexsort((clones, -counts, demes))
+    demes, clones = demes[order], clones[order]
+    # The first triplet of each deme
+    first = np.ones(len(demes), dtype=bool)
+    first[1:] = demes[1:] != demes[:-1]
+    return demes[first], clones[first]
 
 class Tumor(object):
-    def __init__(self, cancer_cell, selection, n_structures=1, structure_radius=0, grid_size=10, epithelial_cell_params=dict(), stromal_cell_params=dict(), immune_cell_params=dict(), deme_params=dict()):
+    dims = 2
+    coord_names = ['row', 'col']
+
+    def __init__(self, cancer_cell, selection, streams, n_structures=1, structure_radius=0, structure_centers=None, structure_labels=None, grid_size=10, topology="von_neumann", periodic=False, epithelial_cell_params=dict(), stromal_cell_params=dict(), immune_cell_params=dict(), deme_params=dict()):
+        # All the random draws of the tumor come from `streams`, or from the streams of a seed
+        streams = get_streams(streams)
         self.grid_size = grid_size
-        self.selection = selection
-        self.celltype_exps = dict()
-        self.n_genes = self.selection.n_segments * self.selection.segment_size
-        self.celltypes = ['cancer', 'epithelial', 'stromal', 'immune']
-        self.make_celltype_exps()
-            
-        # Initialize grid of empty demes
-        self.positions = []
-        self.grid = []
-        self.deme_list = []
-        for grid_row in range(self.grid_size):
-            row = []
-            for grid_col in range(self.grid_size):
-                deme = Deme(
-                    tumor=self,
-                    row=grid_row,
-                    col=grid_col,
-                    **deme_params
-                )
-                self.deme_list.append(deme)
-                row.append(deme)
-            self.grid.append(row)
+        self.n_demes = self.grid_size * self.grid_size
+        deme_values = {param: get_deme_map(deme_params.get(param, default), self.grid_size).ravel() for param, default in DEME_PARAMS.items()}
+        self.init_state(selection, self.n_demes, deme_values, epithelial_cell_params, stromal_cell_params, immune_cell_params, streams)
 
-        # Initialize cell positions
+        self.topology = topology
+        self.periodic = periodic
+        self.neighbor_indptr, self.neighbor_indices = get_neighbor_index(self.grid_size, topology, periodic)
+        self.n_neighbors = np.diff(self.neighbor_indptr)
+
+        # Tissue structures as a label image, 0 for stroma
         center = int(self.grid_size / 2)
-        if structure_radius <= 0:
+        if structure_labels is not None:
+            if isinstance(structure_labels, str):
+                structure_labels = read_labels(structure_labels, self.grid_size)
+            structure_labels = np.asarray(structure_labels, dtype=np.int32)
+        elif np.any(np.asarray(structure_radius) > 0):
+            radii = np.broadcast_to(structure_radius, (n_structures,))
+            if structure_centers is None:
+                # One structure goes in the centre, more are scattered
+                structure_centers = [(center, center)] if n_structures == 1 else get_random_centers(self.grid_size, radii, streams.get("init"))
+            structure_labels = get_disk_labels(self.grid_size, structure_centers, radii)
+        else:
+            structure_labels = np.zeros((self.grid_size, self.grid_size), dtype=np.int32)
+        self.structure_labels = structure_labels
+
+        # Initialize cell positions
+        if not np.any(structure_labels > 0):
             # Put cancer cell in center deme    
-            self.grid[center][center].add_cell(cancer_cell)
+            self.get_deme(center, center).add_cell(cancer_cell)
         else:
-            structure_borders = []
-            structure_in_borders = []
-            structure_circles = []
-            for s_idx in range(n_structures):
-                # Get border
-                border = bresenham_circumference(center, center, structure_radius)
-                structure_borders.append(border)
-
-                # add healthy epithelial cells in border of shape
-                for (row,col) in border:
-                    # Fill them up to carrying capacity
-                    i = 0
-                    while i < self.grid[row][col].carrying_capacity:
-                        epithelial_cell = EpithelialCell(**epithelial_cell_params)
-                        self.grid[row][col].add_cell(epithelial_cell)
-                        i += 1
-
-                # Get inside
-                circle = get_inside(border)
-                structure_circles.append(circle)
-
-                in_border = bresenham_circumference(center, center, structure_radius-1)                        
-                structure_in_borders.append(in_border)
-                if s_idx == 0:
-                    # add a cancer cell inside the border 
-                    pos = np.random.choice(len(in_border))
-                    self.grid[in_border[pos][0]][in_border[pos][1]].add_cell(cancer_cell)
-
-            # add healthy stromal cells outside of border
-            for row in range(grid_size):
-                for col in range(grid_size):
-                    if (row,col) not in structure_circles and (row,col) not in structure_borders:
-                        # Fill them up to carrying capacity
-                        i = 0
-                        while i < self.grid[row][col].carrying_capacity:
-                            stromal_cell = StromalCell(**stromal_cell_params)
-                            self.grid[row][col].add_cell(stromal_cell)
-                            i += 1                    
-
-        self.genotypes_parents = dict()
-        self.genotypes_counts = Counter()
-
-        self.update_genotype_counts()
-
-    def make_celltype_exps(self):
+            # Fill demes up to carrying capacity: epithelial cells in the
+            # walls of the structures and stromal cells outside of them
+            n_fill = np.ceil(self.carrying_capacity).astype(np.int64)
+            borders = get_borders(structure_labels).ravel()
+            stroma = structure_labels.ravel() == 0
+            self.add_normal_cells('epithelial', np.flatnonzero(borders), n_fill[borders])
+            self.add_normal_cells('stromal', np.flatnonzero(stroma), n_fill[stroma])
+
+            # add a cancer cell inside the wall of the first structure
+            first = structure_labels.ravel() == structure_labels[structure_labels > 0].min()
+            candidates = np.flatnonzero(get_inner_rims(structure_labels).ravel() & first)
+            if len(candidates) == 0:
+                candidates = np.flatnonzero(first)
+            pos = streams.get("init").choice(len(candidates))
+            self.deme_list[candidates[pos]].add_cell(cancer_cell)
+
+    def init_state(self, selection, n_demes, deme_values, epithelial_cell_params, stromal_cell_params, immune_cell_params, streams):
+        """Set up the cells, clones and per-deme arrays of `n_demes` demes, with
+        the deme parameters in `deme_values`. Shared by the 2-D and 3-D tumors."""
+        self.selection = selection
+        self.celltype_exps = dict()
+        self.n_genes = self.selection.n_segments * self.selection.segment_size
+        self.celltypes = CELL_TYPES
+        self.make_celltype_exps(streams.get("expression"))
+        self.genotype_exps = dict()
+        self.clone_exps = None
+        self.clone_exp_rows = None
+        self.time = 0. # simulated time, advanced by the next-reaction scheduler
+
+        # All cells live in a single store, demes index into it
+        self.cells = CellStore(n_demes)
+
+        # Tumor-wide clone registry and genotype counts, updated by the demes as cells are born and die
+        self.clones = CloneRegistry()
+        self.genotypes_counts = GenotypeCounts()
+
+        # Demes with cancer cells, kept current by the demes so that updates don't scan the grid
+        self.active_demes = IndexSet(n_demes)
+        # Active demes that have a neighbour without cancer cells, kept current with the active set
+        self.frontier = IndexSet(n_demes)
+        self.n_active_neighbors = np.zeros(n_demes, dtype=np.int32)
+
+        # Deme state lives in arrays over deme indices
+        for param in DEME_PARAMS:
+            setattr(self, param, deme_values[param])
+        self.death_rate = np.array(self.initial_death_rate)
+        self.type_counts = np.zeros((n_demes, len(CELL_TYPES)), dtype=np.int64)
+        # Normal cells are only counts until a cancer cell arrives in their deme
+        self.normal_counts = np.zeros((n_demes, len(CELL_TYPES)), dtype=np.int64)
+        self.normal_cells = dict(
+            epithelial=EpithelialCell(**epithelial_cell_params),
+            stromal=StromalCell(**stromal_cell_params),
+            immune=ImmuneCell(**immune_cell_params),
+        )
+        for cell in self.normal_cells.values():
+            self.cells.prototypes[cell.genotype_id] = cell
+        self.deme_list = DemeList(self)
+
+    def get_deme(self, row, col):
+        return self.deme_list[row * self.grid_size + col]
+
+    def get_coords(self, index):
+        """Grid coordinates (row, col) of the demes at `index`, one row per deme."""
+        return np.stack(np.divmod(index, self.grid_size), axis=-1)
+
+    def get_deme_map(self, param):
+        """A per-deme array, e.g. `carrying_capacity`, as a grid_size x grid_size view."""
+        return getattr(self, param).reshape(self.grid_size, self.grid_size)
+
+    def add_normal_cells(self, celltype, index, counts):
+        """Add `counts` normal cells of `celltype` to the demes at `index`,
+        as counts only."""
+        index = np.asarray(index, dtype=np.int64)
+        counts = np.broadcast_to(np.asarray(counts, dtype=np.int64), index.shape)
+        code = CELL_TYPE_CODES[celltype]
+        added = np.zeros(len(self.type_counts), dtype=np.int64)
+        np.add.at(added, index, counts)
+        self.type_counts[:, code] += added
+        self.normal_counts[:, code] += added
+        self.genotypes_counts.add(NORMAL_CLONES[celltype], int(added.sum()))
+        # Demes with cancer cells need rows for all their cells
+        for i in self.active_demes:
+            if added[i] > 0:
+                self.materialize(i)
+
+    def count_clone(self, clone, delta):
+        """Add `delta` cells to the tumor-wide count of `clone`. A cancer clone
+        that dies out loses its prototype, and with it its genome, and only
+        lives on in the clone registry."""
+        self.genotypes_counts.add(clone, delta)
+        if delta < 0 and clone not in self.genotypes_counts and not self.clones.is_normal(clone):
+            self.cells.prototypes.pop(clone, None)
+
+    def materialize(self, index):
+        """Create the cell store rows of the normal cells of deme `index`,
+        which were only counted so far."""
+        counts = self.normal_counts[index]
+        for code in np.nonzero(counts)[0]:
+            cell = self.normal_cells[CELL_TYPES[code]]
+            for _ in range(counts[code]):
+                self.cells.add(cell, index)
+        counts[:] = 0
+
+    def get_cells(self):
+        """Deme and clone of every cell: the rows of the cell store followed by
+        the normal cells that are only counted."""
+        store = self.cells
+        n = len(store)
+        demes, codes = np.nonzero(self.normal_counts)
+        counts = self.normal_counts[demes, codes]
+        genotypes = np.array([NORMAL_CLONES[CELL_TYPES[code]] for code in codes], dtype=store.genotype.dtype)
+        deme = np.concatenate([store.deme[:n], np.repeat(demes, counts).astype(store.deme.dtype)])
+        genotype = np.concatenate([store.genotype[:n], np.repeat(genotypes, counts)])
+        return deme, genotype
+
+    def make_celltype_exps(self, rng):
         self.celltype_exps = dict()
         for celltype in self.celltypes:
-            exp = np.random.beta(.1, 1., size=self.n_genes)
+            exp = rng.beta(.1, 1., size=self.n_genes)
             exp[np.where(self.selection.get_tsgs())] = 0.8
             exp[np.where(self.selection.get_oncogenes())] = 0.01 
             self.celltype_exps[celltype] = exp
 
+    @property
+    def genotypes_parents(self):
+        return self.clones.get_parents()
+
     def get_genotype_frequencies(self, normalize=True):
-        # Get unique genotypes and their frequencies
-        genotypes = list(self.genotypes_counts.keys())
-        snvs = []
-        counts = []
-        for genotype in genotypes:
-            if genotype not in normal_names:
-                snvs.append(np.array(list(genotype), dtype=int)[1:])
-                counts.append(self.genotypes_counts[genotype])
-        freqs = np.array(counts)
+        # Get live cancer clones and their frequencies
+        genotypes = [genotype for genotype in self.genotypes_counts if not self.clones.is_normal(genotype)]
+        freqs = np.array([self.genotypes_counts[genotype] for genotype in genotypes])
         if normalize:
             freqs = freqs / np.sum(freqs)
-        return snvs, freqs
+        return genotypes, freqs
+
+    def get_mutation_prevalences(self):
+        """Number of live cancer cells carrying a mutation in each gene."""
+        prevalences = np.zeros(self.n_genes, dtype=int)
+        for genotype, count in self.genotypes_counts.items():
+            if self.clones.is_normal(genotype):
+                continue
+            genome = self.cells.prototypes[genotype].genome
+            for seg in range(len(genome)):
+                muts = 0
+                for hap in genome[seg]:
+                    for allele in genome[seg][hap]:
+                        muts |= allele
+                prevalences[seg * self.selection.segment_size + np.array(to_positions(muts), dtype=int)] += count
+        return prevalences
+
+    def get_deme_genotype_counts(self):
+        """Number of cells of each clone in each deme, as (deme, clone, count)
+        triplets sorted by deme and clone, with only the clones present."""
+        store = self.cells
+        n = len(store)
+        # Normal cells that are only counts
+        normal_demes, normal_codes = np.nonzero(self.normal_counts)
+        normal_clones = np.array([NORMAL_CLONES.get(celltype, -1) for celltype in CELL_TYPES], dtype=np.int64)
+        demes = np.concatenate([store.deme[:n], normal_demes]).astype(np.int64)
+        clones = np.concatenate([store.genotype[:n], normal_clones[normal_codes]]).astype(np.int64)
+        weights = np.concatenate([np.ones(n, dtype=np.int64), self.normal_counts[normal_demes, normal_codes]])
+        n_clones = int(clones.max(initial=-1)) + 1
+        keys, inverse = np.unique(demes * n_clones + clones, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.int64)
+        demes, clones = np.divmod(keys, max(n_clones, 1))
+        return demes, clones, counts
 
     def get_deme_genotype_frequencies(self, normalize=True):
         # Get unique genotypes and their frequencies per deme
         # Create grid containing genotype freqs at each deme
+        demes, clones, counts = self.get_deme_genotype_counts()
+        starts = np.searchsorted(demes, np.arange(self.n_demes + 1))
         grid = []
         for grid_row in range(self.grid_size):
             row = []
             for grid_col in range(self.grid_size):
-                if len(self.grid[grid_row][grid_col].cells) > 0:
-                    row.append(self.grid[grid_row][grid_col].get_genotype_frequencies(normalize=normalize))
+                deme = grid_row * self.grid_size + grid_col
+                freqs = counts[starts[deme] : starts[deme + 1]]
+                if len(freqs) > 0:
+                    if normalize:
+                        freqs = freqs / np.sum(freqs)
+                    row.append((clones[starts[deme] : starts[deme + 1]].tolist(), freqs))
                 else:
                     row.append("")
             grid.append(row)
         return grid
 
     def get_genotype_matrix(self):
-        # Create grid containing most frequent genotype at each deme
-        grid = []
-        for grid_row in range(self.grid_size):
-            row = []
-            for grid_col in range(self.grid_size):
-                if len(self.grid[grid_row][grid_col].cells) > 0:
-                    row.append(self.grid[grid_row][grid_col].get_most_frequent_genotype())
-                else:
-                    row.append("")
-            grid.append(row)
-        return grid
+        # Create grid containing most frequent genotype at each deme, -1 if empty
+        grid = np.full(len(self.deme_list), -1, dtype=int)
+        demes, clones = get_dominant_clones(*self.get_deme_genotype_counts())
+        grid[demes] = clones
+        return grid.reshape(self.grid_size, self.grid_size)
 
-    def update_genotype_parents(self):
-        self.genotypes_parents = dict()
-        for deme in self.deme_list:
-            self.genotypes_parents.update(deme.genotypes_parents)
-
-    def update_genotype_counts(self):
-        self.genotypes_counts = Counter()
-        for deme in self.deme_list:
-            self.genotypes_counts = self.genotypes_counts + deme.genotypes_counts
+    def get_neighbors(self, index):
+        """Indices of the demes adjacent to deme `index`."""
+        return self.neighbor_indices[self.neighbor_indptr[index] : self.neighbor_indptr[index + 1]]
 
     def get_neighboring_demes(self, deme):
-        grid_row = deme.row
-        grid_col = deme.col
-
-        possible_demes = []
-        pos = []
-        # Von Neumann neighborhood
-        for tup in [(grid_row - 1, grid_col), (grid_row, grid_col + 1), (grid_row + 1, grid_col), (grid_row, grid_col - 1)]:
-            if tup[0] > 0 and tup[0] < self.grid_size:
-                if tup[1] > 0 and tup[1] < self.grid_size:
-                    pos.append(tup)
-                    possible_demes.append(self.grid[tup[0]][tup[1]])
-
-        # Other structure
-        # for in_border in self.structure_in_borders:
-        #     for tup in in_border:
-        #         possible_demes.append(self.grid[tup[0]][tup[1]])
-
-        return possible_demes
-
-    def update(self, treat=False, treatment_target=None, rng=None):
+        return [self.deme_list[index] for index in self.get_neighbors(deme.index)]
+
+    def get_frontier(self):
+        """Indices of the demes with cancer cells that have a neighbour without."""
+        return np.sort(self.frontier.to_array())
+
+    def set_active(self, index, active):
+        """Add or remove deme `index` from the demes with cancer cells, and
+        update the frontier around it."""
+        neighbors = self.get_neighbors(index)
+        if active:
+            self.active_demes.add(index)
+            self.n_active_neighbors[neighbors] += 1
+        else:
+            self.active_demes.remove(index)
+            self.n_active_neighbors[neighbors] -= 1
+        # Only the deme and its neighbours can join or leave the frontier
+        for i in [index] + neighbors.tolist():
+            if i in self.active_demes and self.n_active_neighbors[i] < self.n_neighbors[i]:
+                self.frontier.add(i)
+            elif i in self.frontier:
+                self.frontier.remove(i)
+
+    def split_deme(self, index, rng):
+        """Fission of deme `index`: half of its cancer cells, picked at random,
+        move to a neighbour without cancer cells. Returns the neighbour, or
+        None if all the neighbours have cancer cells."""
+        free = [i for i in self.get_neighbors(index).tolist() if i not in self.active_demes]
+        if len(free) == 0:
+            return None
+        target = free[rng.integers(len(free))]
+        store = self.cells
+        members = store.get_members(index)
+        cancer = members[store.type[members] == CELL_TYPE_CODES['cancer']]
+        moved = cancer[rng.permutation(len(cancer))[: len(cancer) // 2]]
+        genotypes, codes = store.genotype[moved], store.type[moved]
+        # The rows stay where they are, only the demes' member arrays are sliced
+        store.move_many(moved, target)
+        source_deme, target_deme = self.deme_list[index], self.deme_list[target]
+        # Count the arrivals first, so that the clones never look extinct
+        target_deme.count_cells(genotypes, codes)
+        source_deme.count_cells(genotypes, codes, -1)
+        source_deme.update_death_rate()
+        target_deme.update_death_rate()
+        return target
+
+    def update(self, streams, treat=False, treatment_target=None, demes=None, dispersal=True, fission=False):
+        """Update up to 10 demes drawn from `demes` (by default, all the demes
+        with cancer cells). With `fission`, frontier demes above their carrying
+        capacity split after their update. Returns the number of cells killed
+        by treatment."""
         cells_killed = 0
 
-        deme_list = [deme for deme in self.deme_list if deme.types_counts['cancer'] > 0]
-        demes = rng.choice(deme_list, size=min(10, len(deme_list)), replace=False)
-        for deme in demes:
-            cells_killed += deme.update(treat=treat, treatment_target=treatment_target, rng=rng)
+        if demes is None:
+            demes = self.active_demes
+        demes = demes.sample(min(10, len(demes)), streams.get("schedule"))
+        for index in demes:
+            # Each deme draws from its own stream
+            rng = streams.get("update", index)
+            deme = self.deme_list[index]
+            cells_killed += deme.update(treat=treat, treatment_target=treatment_target, rng=rng, dispersal=dispersal)
+            if fission and index in self.frontier and deme.n_cells > self.carrying_capacity[index] and deme.n_cancer > 1:
+                self.split_deme(index, rng)
 
-        self.update_genotype_parents()
-        self.update_genotype_counts()
+        self.time += 1
 
         return cells_killed
 
-    def set_cell_exps(self):
-        for deme in self.deme_list:
-            for cell in deme.cells:        
-                if cell.type == 'cancer':
-                    cell.baseline_exp = self.celltype_exps['cancer']
-                    cell.exp = cell.get_exp(self.selection.update_exp)
-                else:
-                    cell.exp = self.celltype_exps[cell.type]
-
-    def get_cell_data(self,):
-        n_cells = sum(self.genotypes_counts.values())
-        cell_gen = []
-        cell_exp = np.zeros((n_cells, self.selection.segment_size*self.selection.n_segments))
-        cell_crd = np.zeros((n_cells, 2))
-        cell_names = []
-        cell_ids = []
-        i = 0
-        for deme in self.deme_list:
-            for cell in deme.cells:
-                cell_name = f'C{i}'
-                cell_gen[i] = cell.get_genome_df()
-                cell_gen[i]['cell'] = cell_name
-                cell_exp[i] = cell.exp
-                cell_crd[i][0], cell_crd[i][1] = deme.row, deme.col # should be after expanding demes
-                cell_ids.append(cell.genotype_id)
-                cell_names.append(cell_name)
-                i += 1
+    def is_targeted(self, genotype, treatment_target):
+        """Check if cells of a clone carry a mutation in the treatment target gene."""
+        genome = self.cells.prototypes[genotype].genome
+        seg, pos = divmod(treatment_target, self.selection.segment_size)
+        return any((allele >> pos) & 1 for hap in genome[seg] for allele in genome[seg][hap])
 
+    def set_cell_exps(self):
+        # Expression only depends on the genotype, so compute one row per clone in the store
+        # and let cells reference the row of their clone
+        clones = np.unique(self.get_cells()[1])
+        exps = np.zeros((len(clones), self.n_genes), dtype=np.float32)
+        is_cancer = np.array([not self.clones.is_normal(clone) for clone in clones], dtype=bool)
+        genomes = [self.cells.prototypes[clone].genome for clone in clones[is_cancer]]
+        exps[is_cancer] = self.selection.get_exps(genomes, self.celltype_exps['cancer'])
+        for row in np.where(~is_cancer)[0]:
+            exps[row] = self.celltype_exps[self.cells.prototypes[clones[row]].type]
+        self.clone_exps = exps
+        self.clone_exp_rows = np.full(len(self.clones), -1, dtype=np.int64)
+        self.clone_exp_rows[clones] = np.arange(len(clones))
+        self.genotype_exps = dict(zip(clones.tolist(), exps))
+
+    def get_cell_exps(self, cells=None):
+        """Dense cells x genes expression, gathered from the clone rows. Only
+        meant for small sets of cells."""
+        genotype = self.get_cells()[1]
+        if cells is None:
+            cells = np.arange(len(genotype))
+        return self.clone_exps[self.clone_exp_rows[genotype[cells]]]
+
+    def get_gene_names(self):
         gene_names = []
         for segment in range(self.selection.n_segments):
             gn = [f'G{segment}_{i}' for i in range(self.selection.segment_size)]
             gene_names.extend(gn)
-
-        cell_gn_df = pd.concat(cell_gen)
-
-        return dict(cell_gen=cell_gn_df, 
-                    cell_exp=pd.DataFrame(cell_exp.astype(float), index=cell_names, columns=gene_names), 
-                    cell_crd=pd.DataFrame(cell_crd.astype(int), index=cell_names, columns=['row', 'col']),
+        return gene_names
+
+    def get_mutation_matrix(self, cells=False):
+        """Sparse clones x sites matrix of mutated allele copies of the clones
+        in the tumor, or cells x sites if `cells` is set."""
+        store = self.cells
+        genotype = self.get_cells()[1]
+        clones = np.unique(genotype)
+        genomes = [store.prototypes[clone].genome for clone in clones]
+        mutations = MutationMatrix.from_genomes(genomes, self.selection.n_segments, self.selection.segment_size,
+                                                rows=self.clones.get_labels(clones), columns=self.get_gene_names())
+        if cells:
+            cell_names = [f'C{i}' for i in range(len(genotype))]
+            mutations = mutations.take(np.searchsorted(clones, genotype), rows=cell_names)
+        return mutations
+
+    def get_cell_data(self, dense_exp=False, long_gen=False):
+        store = self.cells
+        # Normal cells that are only counted get rows here, after the store's
+        deme, genotype = self.get_cells()
+        n_cells = len(genotype)
+        cell_crd = self.get_coords(deme) # should be after expanding demes
+        cell_names = [f'C{i}' for i in range(n_cells)]
+        cell_ids = self.clones.get_labels(genotype)
+
+        # Cells find the mutations of their clone through cell_ids
+        cell_data = dict(clone_mut=self.get_mutation_matrix(), 
+                    cell_crd=pd.DataFrame(cell_crd.astype(int), index=cell_names, columns=self.coord_names),
                     cell_ids=pd.DataFrame(cell_ids, index=cell_names, columns=['cell_id']))
+        if long_gen:
+            # One row per position of every allele of every cell, only for small tumors
+            cell_gen = []
+            for i in range(n_cells):
+                cell_gen.append(store.prototypes[genotype[i]].get_genome_df())
+                cell_gen[i]['cell'] = cell_names[i]
+            cell_data['cell_gen'] = pd.concat(cell_gen)
+        if self.clone_exps is not None:
+            # Clones x genes, cells find their row through cell_ids
+            clones = np.where(self.clone_exp_rows >= 0)[0]
+            gene_names = self.get_gene_names()
+            cell_data['clone_exp'] = pd.DataFrame(self.clone_exps[self.clone_exp_rows[clones]],
+                                                  index=self.clones.get_labels(clones), columns=gene_names)
+            if dense_exp:
+                cell_data['cell_exp'] = pd.DataFrame(self.get_cell_exps(np.arange(n_cells)), index=cell_names, columns=gene_names)
+        return cell_data
+
+    def get_genotype_data(self, genotypes):
+        """Genomes of the given clones in the packed bitset encoding, as hex strings."""
+        genomes = [self.cells.prototypes[genotype].genome.pack(self.selection.segment_size).hex() for genotype in genotypes]
+        return pd.DataFrame(dict(genome=genomes), index=self.clones.get_labels(genotypes))
 
     def get_gene_data(self):
         gene_names = [f'G{i}' for i in range(self.n_genes)]
-        return dict(driver_types=pd.DataFrame(self.selection.driver_types, index=gene_names), 
+        return dict(driver_types=pd.DataFrame(np.concatenate(self.selection.driver_types), index=gene_names), 
                     confers_resistance=pd.DataFrame(self.selection.confers_resistance, index=gene_names))
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+Three-dimensional tumors on a sparse voxel grid.
+
+The demes of a `Tumor3D` live on a grid_size^3 `VoxelGrid` that only holds
+the demes cancer cells could reach so far, and the tumor's per-deme arrays
+grow along with it. Everything else works as in the 2-D `Tumor`. Spatial
+exports (the genotype grid) are 2-D cross-sections, see voxels.py.
+"""
+from .tumor import Tumor, DEME_PARAMS, get_dominant_clones
+from .voxels import VoxelGrid, get_section, parse_section
+from .rng import get_streams
+
+import numpy as np
+
+
+class Tumor3D(Tumor):
+    dims = 3
+    coord_names = ['x', 'y', 'z']
+
+    def __init__(self, cancer_cell, selection, streams, grid_size=100, topology="von_neumann", periodic=False, section=None, epithelial_cell_params=dict(), stromal_cell_params=dict(), immune_cell_params=dict(), deme_params=dict()):
+        streams = get_streams(streams)
+        self.grid_size = grid_size
+        self.topology = topology
+        self.periodic = periodic
+        self.voxels = VoxelGrid(grid_size, topology, periodic)
+
+        # New demes get the same parameters, so there are no per-deme maps
+        self.deme_param_values = dict()
+        for param, default in DEME_PARAMS.items():
+            value = deme_params.get(param, default)
+            if not np.isscalar(value) or isinstance(value, str):
+                raise ValueError(f"Deme parameter {param} must be a single value in a 3-D tumor.")
+            self.deme_param_values[param] = float(value)
+        capacity = self.voxels.capacity
+        deme_values = {param: np.full(capacity, value) for param, value in self.deme_param_values.items()}
+        self.init_state(selection, capacity, deme_values, epithelial_cell_params, stromal_cell_params, immune_cell_params, streams)
+
+        # Cross-section that is exported, through the centre of the z axis by default
+        center = int(self.grid_size / 2)
+        self.section = (2, center) if section is None else parse_section(section, self.grid_size)
+
+        # Put cancer cell in center voxel
+        self.get_deme(center, center, center).add_cell(cancer_cell)
+
+    @property
+    def n_demes(self):
+        return len(self.voxels)
+
+    @property
+    def n_neighbors(self):
+        return self.voxels.n_neighbors
+
+    def reserve(self):
+        """Grow the per-deme arrays to the capacity of the voxel grid."""
+        capacity = self.voxels.capacity
+        size = len(self.death_rate)
+        if capacity == size:
+            return
+        for param, value in self.deme_param_values.items():
+            setattr(self, param, np.concatenate([getattr(self, param), np.full(capacity - size, value)]))
+        self.death_rate = np.concatenate([self.death_rate, self.initial_death_rate[size:]])
+        for name in ['type_counts', 'normal_counts', 'n_active_neighbors']:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros((capacity - size,) + array.shape[1:], dtype=array.dtype)]))
+        self.active_demes.grow(capacity)
+        self.frontier.grow(capacity)
+        self.cells.grow_demes(capacity)
+
+    def get_deme(self, x, y, z):
+        index = self.voxels.get_index(x, y, z)
+        self.reserve()
+        return self.deme_list[index]
+
+    def get_coords(self, index):
+        """Voxel coordinates (x, y, z) of the demes at `index`, one row per deme."""
+        return self.voxels.coords[index]
+
+    def get_neighbors(self, index):
+        neighbors = self.voxels.get_neighbors(index)
+        self.reserve()
+        return neighbors
+
+    def get_genotype_matrix(self, section=None):
+        """Most frequent genotype at each deme of a cross-section, e.g. "x=10"
+        (by default the tumor's `section`), -1 if empty."""
+        axis, position = self.section if section is None else parse_section(section, self.grid_size)
+        demes, clones = get_dominant_clones(*self.get_deme_genotype_counts())
+        in_section, crd = get_section(self.get_coords(demes), axis, position)
+        grid = np.full((self.grid_size, self.grid_size), -1, dtype=int)
+        grid[crd[:, 0], crd[:, 1]] = clones[in_section]
+        return grid
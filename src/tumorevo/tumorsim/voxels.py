@@ -0,0 +1,101 @@
+"""
+Sparse voxel grids for three-dimensional tumors.
+
+A dense grid_size^3 grid of demes doesn't fit in memory for useful sizes, so
+the demes of a 3-D tumor are only created when they are first needed, and
+numbered in that order. A hash from packed (x, y, z) coordinates to deme
+indices finds them. The neighbours of a deme are created the first time
+they are asked for, so the grid only holds the demes that cancer cells
+could reach so far.
+
+Cross-sections are given as strings like "z=50", the plane of voxels at
+position 50 along z. The two other axes, in order, are its (row, col).
+"""
+import numpy as np
+
+import itertools
+
+AXES = ["x", "y", "z"]
+
+TOPOLOGIES_3D = {
+    # Offsets of a voxel's neighbours as (x, y, z)
+    "von_neumann": [(-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1)],
+    "moore": [offset for offset in itertools.product([-1, 0, 1], repeat=3) if offset != (0, 0, 0)],
+}
+
+
+def parse_section(section, grid_size=None):
+    """Axis and position of a cross-section given as e.g. "z=50"."""
+    axis, position = section.split("=")
+    axis = axis.strip()
+    if axis not in AXES:
+        raise ValueError(f"Unknown axis {axis}, expected one of {AXES}.")
+    position = int(position)
+    if position < 0 or (grid_size is not None and position >= grid_size):
+        raise ValueError(f"Section position {position} is out of the grid.")
+    return AXES.index(axis), position
+
+
+def get_section(coords, axis, position):
+    """Mask of the voxels at `coords`, one (x, y, z) row each, that are in the
+    plane at `position` along `axis`, and their (row, col) in that plane."""
+    coords = np.asarray(coords)
+    mask = coords[:, axis] == position
+    return mask, np.delete(coords[mask], axis, axis=1)
+
+
+class VoxelGrid(object):
+    def __init__(self, grid_size, topology="von_neumann", periodic=False, capacity=1024):
+        if topology not in TOPOLOGIES_3D:
+            raise ValueError(f"Unknown 3-D topology {topology}, expected one of {list(TOPOLOGIES_3D)}.")
+        self.grid_size = grid_size
+        self.periodic = periodic
+        self.offsets = np.array(TOPOLOGIES_3D[topology], dtype=np.int64)
+        self.n = 0
+        self.index = dict() # packed coordinates -> deme
+        self.coords = np.zeros((capacity, 3), dtype=np.int32)
+        self.n_neighbors = np.zeros(capacity, dtype=np.int32)
+        # Neighbours of each deme, packed at the start of its row once they were asked for
+        self.neighbors = np.zeros((capacity, len(self.offsets)), dtype=np.int32)
+        self.has_neighbors = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def capacity(self):
+        return len(self.coords)
+
+    def _grow(self):
+        for name in ["coords", "n_neighbors", "neighbors", "has_neighbors"]:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+
+    def _shift(self, coords):
+        # Coordinates of a voxel's neighbours that are in the grid
+        shifted = np.asarray(coords, dtype=np.int64) + self.offsets
+        if self.periodic:
+            return shifted % self.grid_size
+        return shifted[np.all((shifted >= 0) & (shifted < self.grid_size), axis=1)]
+
+    def get_index(self, x, y, z):
+        """Deme at (x, y, z), created if it doesn't exist yet."""
+        key = (x * self.grid_size + y) * self.grid_size + z
+        index = self.index.get(key)
+        if index is None:
+            index = self.n
+            if index == self.capacity:
+                self._grow()
+            self.index[key] = index
+            self.coords[index] = (x, y, z)
+            self.n_neighbors[index] = len(self._shift((x, y, z)))
+            self.n += 1
+        return index
+
+    def get_neighbors(self, index):
+        """Indices of the demes adjacent to deme `index`, which are created the first time."""
+        if not self.has_neighbors[index]:
+            neighbors = [self.get_index(x, y, z) for x, y, z in self._shift(self.coords[index]).tolist()]
+            self.neighbors[index, : len(neighbors)] = neighbors
+            self.has_neighbors[index] = True
+        return self.neighbors[index, : self.n_neighbors[index]]
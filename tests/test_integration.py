@@ -1,40 +1,101 @@
 import numpy as np
+import pandas as pd
 
 import pytest
 from click.testing import CliRunner
 import os
+import json
+import yaml
 
 from tumorevo.tumorsim import main
 from tumorevo.tumorsim.modes import *
-from tumorevo.tumorsim.cell import TumorCell
 
-MODE_LIST = [
-    simulate_nonspatial,
-    simulate_invasion,
-    # simulate_fission,
-    # simulate_boundary,
-]
+
+def make_config(mode):
+    return dict(
+        mode=mode,
+        spatial_params=dict(grid_size=10),
+        deme_params=dict(carrying_capacity=4),
+        cell_params=dict(n_segments=2,
+                         cancer_params=dict(segment_size=50, division_rate=0.5, death_rate=0.1, mutation_rate=0.1, dispersal_rate=0.2),
+                         epithelial_params=dict(), stromal_params=dict(), immune_params=dict()),
+        selection_params=dict(segment_size=50),
+        treatment_params=dict(),
+    )
 
 
 @pytest.mark.parametrize("mode", list(range(len(MODE_LIST))))
 def test_simulation(mode):
-    tumor_cell = TumorCell(n_genes=100)
-    env, traces = MODE_LIST[mode](1000, tumor_cell)
+    tumor = make_tumor(make_config(mode), seed=0)
+    env, traces, _, _ = MODE_LIST[mode](200, tumor, seed=0, progress=False)
 
-    assert len(traces) == 1000
+    assert len(traces) == 200
     assert isinstance(env.get_genotype_frequencies(), tuple)
 
 
 @pytest.mark.parametrize("mode", list(range(len(MODE_LIST))))
-def test_cli(mode):
+def test_cli(mode, tmp_path):
     runner = CliRunner()
+    config = str(tmp_path / "config.yaml")
+    outs = tmp_path / "outs"
+    with open(config, "w") as f:
+        yaml.safe_dump(make_config(mode), f)
 
     # run program
-    with runner.isolated_filesystem():
-        result = runner.invoke(main, ["--mode", mode, "-o", "./outs"])
-
-        # test output
-        assert result.exit_code == 0
-        assert os.path.isfile("./outs/parents.csv")
-        assert os.path.isfile("./outs/trace_counts.csv")
-        assert os.path.isfile("./outs/genotypes.csv")
+    result = runner.invoke(main, ["--sim-config", config, "-s", "100", "-o", str(outs)])
+
+    # test output
+    assert result.exit_code == 0
+    assert os.path.isfile(outs / "parents_0.csv")
+    assert os.path.isfile(outs / "trace_counts.csv")
+    assert os.path.isfile(outs / "genotypes_0.csv")
+    assert os.path.isfile(outs / "grid_0.csv") == (mode > 0)
+    if mode > 0:
+        # One (deme, clone, count) row per clone present in a deme, adding up to the final clone sizes
+        deme_counts = pd.read_csv(outs / "genotype_counts_demes_0.csv", index_col=0)
+        assert list(deme_counts.columns) == ["deme", "clone", "count"]
+        assert (deme_counts["count"] > 0).all()
+        assert not deme_counts.duplicated(["deme", "clone"]).any()
+        trace = pd.read_csv(outs / "trace_counts.csv")
+        final = trace[trace["step"] == trace["step"].max()].set_index("clone")["count"]
+        assert deme_counts.groupby("clone")["count"].sum().sort_index().equals(final[final > 0].sort_index())
+
+
+def test_profile(tmp_path):
+    from tumorevo.tumorsim.deme import Deme
+    runner = CliRunner()
+    config = str(tmp_path / "config.yaml")
+    with open(config, "w") as f:
+        yaml.safe_dump(make_config(1), f)
+    update = Deme.update
+
+    result = runner.invoke(main, ["--sim-config", config, "-s", "100", "--record-after-steps", "50", "-o", str(tmp_path / "plain")])
+    assert result.exit_code == 0
+    assert not os.path.isfile(tmp_path / "plain" / "profile.json")
+    result = runner.invoke(main, ["--sim-config", config, "-s", "100", "--record-after-steps", "50", "--profile", "-o", str(tmp_path / "profiled")])
+    assert result.exit_code == 0
+
+    # Instrumented methods are put back, and don't change the results
+    assert Deme.update is update
+    for name in ["trace_counts.csv", "genotypes_1.csv"]:
+        with open(tmp_path / "plain" / name) as f, open(tmp_path / "profiled" / name) as g:
+            assert f.read() == g.read()
+
+    with open(tmp_path / "profiled" / "profile.json") as f:
+        report = json.load(f)
+    assert report["phases"]["simulate"]["calls"] == 2
+    assert report["hot_paths"]["tumor.update"]["calls"] > 0
+    assert report["events"]["steps"] == 100
+    assert [record["step"] for record in report["records"]] == [50, 100]
+    assert report["records"][-1]["n_cells"] >= report["records"][-1]["n_cancer_cells"]
+    assert report["memory"]["peak"]["cells"] > 0
+
+    # The checkerboard scheduler updates its demes without Deme.update
+    checkerboard = dict(make_config(1), scheduler_params=dict(scheduler="checkerboard", domain_size=5))
+    with open(config, "w") as f:
+        yaml.safe_dump(checkerboard, f)
+    result = runner.invoke(main, ["--sim-config", config, "-s", "50", "--profile", "-o", str(tmp_path / "checkerboard")])
+    assert result.exit_code == 0
+    with open(tmp_path / "checkerboard" / "profile.json") as f:
+        report = json.load(f)
+    assert report["events"]["cell_events"] > 0 and report["events"]["deme_updates"] > 0
@@ -0,0 +1,617 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from collections import Counter
+
+from tumorevo.tumorsample.main import CellSNVs
+from tumorevo.tumorsim.cell import CancerCell, StromalCell
+from tumorevo.tumorsim.cellstore import CellStore, CELL_TYPES, CELL_TYPE_CODES, DEATH, DIVISION
+from tumorevo.tumorsim.checkpoint import load_snapshot, save_snapshot
+from tumorevo.tumorsim.clones import CloneRegistry, NORMAL_CLONES
+from tumorevo.tumorsim.counts import GenotypeCounts, IndexSet
+from tumorevo.tumorsim.ensemble import get_replicate_seeds, run_ensemble
+from tumorevo.tumorsim.genome import GENOME_TABLE, from_array, to_array, to_bits, to_positions
+from tumorevo.tumorsim.geometry import get_borders, get_disk_labels, get_inner_rims
+from tumorevo.tumorsim.modes import simulate_boundary, simulate_fission, simulate_invasion
+from tumorevo.tumorsim.mutations import MutationMatrix
+from tumorevo.tumorsim.profiling import get_memory
+from tumorevo.tumorsim.scheduler import IndexedPriorityQueue, NextReactionScheduler
+from tumorevo.tumorsim.results import find_table, read_table, write_table
+from tumorevo.tumorsim.rng import RandomStreams
+from tumorevo.tumorsim.selection import RateCache, Selection
+from tumorevo.tumorsim.sweep import expand_sweep, run_sweep
+from tumorevo.tumorsim.traces import TraceRecorder, read_trace_counts
+from tumorevo.tumorsim.tumor import Tumor, get_neighbor_index
+from tumorevo.tumorsim.tumor3d import Tumor3D
+from tumorevo.tumorsim.voxels import VoxelGrid, get_section
+
+
+def test_cellstore():
+    store = CellStore(n_demes=3, capacity=2)
+    cancer_cell = CancerCell(n_segments=2, segment_size=10)
+    cancer_cell.genotype_id = 3
+    stromal_cell = StromalCell(n_segments=2, segment_size=10)
+
+    for deme in range(3):
+        store.add(stromal_cell, deme)
+    idx = store.add(cancer_cell, 1)
+    store.copy(idx, 2)
+    assert len(store) == 5
+    assert store.capacity >= 5
+    assert list(store.deme_size) == [1, 2, 2]
+
+    # Removing a row moves the last one into it
+    moved = store.remove(0)
+    assert moved == 4
+    assert len(store) == 4
+    assert store.deme_size[0] == 0
+    for deme in range(3):
+        members = store.get_members(deme)
+        assert np.all(store.deme[members] == deme)
+        assert np.all(store.slot[members] == np.arange(len(members)))
+
+    rng = np.random.default_rng(42)
+    sampled = store.sample(2, 2, rng)
+    assert sorted(store.get_genotype_id(i) for i in sampled) == [1, 3]
+    assert store.get_cell(sampled[0]).n_segments == 2
+
+    # Batches of copies and removals, as in Deme.update
+    cancer_rows = np.flatnonzero(store.genotype[: len(store)] == 3)
+    new_rows = store.copy_many(cancer_rows, [0, 0])
+    assert len(store) == 6 and store.deme_size[0] == 2
+    store.remove_many(np.concatenate([cancer_rows, new_rows[:1]]))
+    assert len(store) == 3 and list(store.deme_size) == [1, 1, 1]
+    assert sorted(store.genotype[: len(store)].tolist()) == [1, 1, 3]
+    for deme in range(3):
+        members = store.get_members(deme)
+        assert np.all(store.deme[members] == deme)
+        assert np.all(store.slot[members] == np.arange(len(members)))
+
+
+def test_genome_sharing():
+    cell = CancerCell(n_segments=3, segment_size=10)
+    daughter = cell.divide()
+    assert daughter.genome is cell.genome
+
+    genome = cell.genome.set_allele(1, "p", 0, to_bits([1, 2]))
+    assert cell.genome[1]["p"][0] == 0
+    assert to_positions(genome[1]["p"][0]) == [1, 2]
+    # Only the changed segment is new
+    assert genome[0] is cell.genome[0] and genome[2] is cell.genome[2]
+    # Equal genomes are the same object
+    assert cell.genome.set_allele(1, "p", 0, to_bits([2, 1])) is genome
+    assert genome.add_allele(0, "m", 0).get_copy_numbers() == [3, 2, 2]
+    assert genome.remove_allele(0, "m", 0).get_copy_numbers() == [1, 2, 2]
+
+    # Packed encoding round trip
+    assert GENOME_TABLE.unpack(genome.pack(10), 10) is genome
+    # Also with more alleles than fit in a byte
+    amplified = genome
+    for _ in range(300):
+        amplified = amplified.add_allele(1, "m", to_bits([3]))
+    assert amplified.get_copy_numbers()[1] == 302
+    assert GENOME_TABLE.unpack(amplified.pack(10), 10) is amplified
+
+    # Genomes that nothing holds leave the table
+    n_genomes = len(GENOME_TABLE)
+    extra = genome.add_allele(2, "p", to_bits([7]))
+    assert len(GENOME_TABLE) == n_genomes + 1
+    del extra
+    assert len(GENOME_TABLE) == n_genomes
+
+
+def test_bitsets():
+    mask = np.zeros(20, dtype=int)
+    mask[[0, 3, 19]] = 1
+    bits = from_array(mask)
+    assert bits == to_bits([0, 3, 19])
+    assert to_positions(bits) == [0, 3, 19]
+    assert np.all(to_array(bits, 20) == mask)
+
+    selection = Selection(n_segments=2, segment_size=20, rng=0)
+    assert np.all(selection.get_tsgs() == np.where(np.concatenate(selection.driver_types) == -1)[0])
+    genome = GENOME_TABLE.diploid(2).set_allele(0, "p", 0, selection.driver_masks[0])
+    assert selection.count_drivers(genome) == len(selection.drivers[0])
+
+
+def test_indexed_priority_queue():
+    queue = IndexedPriorityQueue([3.0, np.inf, 1.0, 2.0])
+    assert queue.top() == (2, 1.0)
+    queue.update(1, 0.5)
+    assert queue.top() == (1, 0.5)
+    queue.update(1, np.inf)
+    queue.update(2, 5.0)
+    assert queue.top() == (3, 2.0)
+    assert sorted(queue.times[item] for item in queue.heap)[:2] == [2.0, 3.0]
+
+
+def test_next_reaction():
+    # Records are dt apart in simulated time
+    tumor, traces, _, _ = simulate_invasion(20, make_tumor(), seed=0, scheduler="next_reaction", dt=0.5)
+    times = np.unique(traces.get_frame()["time"])
+    assert np.allclose(times, 0.5 * np.arange(20))
+    assert tumor.time == 9.5
+
+    tumor = make_tumor()
+    engine = NextReactionScheduler(tumor, RandomStreams(0))
+    engine.run(2.)
+    assert engine.time == tumor.time == 2.
+    assert engine.n_events > 0
+    # Thinning needs a bound on the event rates of every cell
+    rates = tumor.cells.rates[: len(tumor.cells)]
+    assert engine.rate_bound >= (rates[:, DIVISION] + rates[:, DEATH]).max()
+    assert engine.queue.top()[1] == min(engine.queue.times) > engine.time
+
+    # A deme with more cells fires sooner, but not before now
+    deme = tumor.deme_list[next(iter(tumor.active_demes))]
+    old_time = engine.queue.times[deme.index]
+    idx = deme.add_copy(deme.cells[0])
+    engine.reschedule(deme)
+    assert engine.propensities[deme.index] == engine.get_propensity(deme)
+    assert engine.time <= engine.queue.times[deme.index] < old_time
+
+    # An empty deme that gets a cancer cell is scheduled, and unscheduled once it is empty again
+    empty = tumor.deme_list[int(np.flatnonzero(np.array(engine.propensities) == 0)[0])]
+    assert engine.queue.times[empty.index] == np.inf
+    new_idx = empty.add_copy(idx)
+    engine.reschedule(empty)
+    assert engine.time <= engine.queue.times[empty.index] < np.inf
+    empty.remove_cell(new_idx)
+    engine.reschedule(empty)
+    assert engine.queue.times[empty.index] == np.inf
+
+
+def test_genotype_counts():
+    counts = GenotypeCounts()
+    counts.add("a")
+    counts.add("a")
+    counts.add("b")
+    counts.add("a", -2)
+    assert dict(counts) == {"b": 1}
+    with pytest.raises(ValueError):
+        counts.add("a", -1)
+
+
+def test_clone_registry():
+    clones = CloneRegistry(capacity=2)
+    founder = clones.register(deme=5)
+    child = clones.register(parent=founder, deme=6, time=2.0)
+    assert child == founder + 1
+    assert clones.get_parents() == {child: founder}
+    assert clones.get_labels([-1, 1, child]) == ["", "stromal", str(child)]
+    assert clones.get_table()["birth_time"][child] == 2.0
+
+
+def test_trace_recorder(tmp_path):
+    clones = CloneRegistry()
+    clone = clones.register()
+    path = str(tmp_path / "trace_counts.csv")
+    traces = TraceRecorder(path=path, clones=clones, buffer_size=3)
+    traces.record(GenotypeCounts({1: 10, clone: 1}))
+    traces.record(GenotypeCounts({1: 10, clone: 2}), time=1.0)
+    traces.record(GenotypeCounts({clone: 3}), time=2.0)
+    traces.flush()
+    assert len(traces) == 3
+    assert traces.size == 0
+
+    counts = read_trace_counts(path)
+    assert counts.shape == (3, 2)
+    assert counts[str(clone)].tolist() == [1, 2, 3]
+    assert counts["stromal"].tolist() == [10, 10, 0]
+
+
+def test_rate_cache():
+    cache = RateCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 2)
+
+    selection = Selection(n_segments=2, segment_size=10, rng=0)
+    genome = CancerCell(n_segments=2, segment_size=10).genome
+    rates = selection.get_rates(genome, 0.1, 0.1, 0.1)
+    assert selection.get_rates(genome, 0.1, 0.1, 0.1) is rates
+    assert selection.rate_cache.hits == 1
+
+
+def test_clone_exps():
+    selection = Selection(n_segments=3, segment_size=20, prop_driver=0.3, rng=0)
+    cell = CancerCell(n_segments=3, segment_size=20)
+    genome = cell.genome.set_allele(0, 'p', 0, to_bits([1, 4, 7]))
+    genome = genome.add_allele(1, 'm', to_bits([2, 3]))
+    genome = genome.set_allele(2, 'p', 0, to_bits([5]))
+    genome = genome.remove_allele(2, 'p', 0).remove_allele(2, 'm', 0)
+    baseline_exp = np.random.default_rng(0).random(60)
+
+    exps = selection.get_exps([cell.genome, genome], baseline_exp)
+    assert exps.shape == (2, 60)
+    assert np.allclose(exps[0], baseline_exp)
+    for clone_genome, exp in zip([cell.genome, genome], exps):
+        cell.genome = clone_genome
+        cell.baseline_exp = baseline_exp
+        assert np.allclose(exp, cell.get_exp(selection.update_exp))
+    assert np.all(exps[1, 40:] == 0)
+
+
+def test_mutation_matrix(tmp_path):
+    cell = CancerCell(n_segments=2, segment_size=10)
+    genome = cell.genome.set_allele(0, 'p', 0, to_bits([1, 4]))
+    genome = genome.add_allele(0, 'p', to_bits([4]))
+    genome = genome.set_allele(1, 'm', 0, to_bits([9]))
+
+    mutations = MutationMatrix.from_genomes([cell.genome, genome], 2, 10, rows=['a', 'b'])
+    assert mutations.shape == (2, 20)
+    assert mutations.nnz == 3
+    dense = mutations.toarray()
+    assert np.all(dense[0] == 0)
+    assert dense[1, 1] == 1 and dense[1, 4] == 2 and dense[1, 19] == 1
+
+    cells = mutations.take([1, 0, 1])
+    assert np.all(cells.toarray() == dense[[1, 0, 1]])
+
+    mutations.save(tmp_path / 'mut.npz')
+    loaded = MutationMatrix.load(tmp_path / 'mut.npz')
+    assert np.all(loaded.toarray() == dense)
+    assert list(loaded.rows) == ['a', 'b']
+
+    # tumorsample keeps the cells' SNVs sparse and only densifies the sites it reads
+    loaded.columns = [f'G{i}' for i in range(20)]
+    snvs = CellSNVs(loaded, [1, 0, 1], ['C0', 'C1', 'C2'])
+    assert list(snvs.loc[['C2', 'C1']].index) == ['C2', 'C1']
+    frame = snvs.loc[['C2', 'C1'], ['G4', 'G19', 'G0']]
+    assert frame.values.tolist() == [[1, 1, 0], [0, 0, 0]]
+    assert list(frame.columns) == ['G4', 'G19', 'G0']
+
+
+@pytest.mark.parametrize("format", ["csv", "npz", "npy"])
+def test_tables(tmp_path, format):
+    df = pd.DataFrame(np.random.rand(5, 3000), index=[f"C{i}" for i in range(5)],
+                      columns=[f"G{i}" for i in range(3000)])
+    path = write_table(df, str(tmp_path / "exp"), format)
+    assert find_table(str(tmp_path / "exp")) == path
+    assert np.allclose(read_table(path).values, df.values)
+    assert list(read_table(path).index) == list(df.index)
+    subset = read_table(path, columns=["G2999", "G3"])
+    assert list(subset.columns) == ["G2999", "G3"]
+    assert np.allclose(subset.values, df[["G2999", "G3"]].values)
+
+    mixed = pd.DataFrame(dict(row=[1, 2], cell_id=["3", "epithelial"]), index=["C0", "C1"])
+    path = write_table(mixed, str(tmp_path / "ids"), format)
+    assert read_table(path, dtype=str)["cell_id"].tolist() == ["3", "epithelial"]
+
+
+def make_tumor():
+    cancer_cell = CancerCell(n_segments=2, segment_size=20, division_rate=0.5, death_rate=0.1,
+                             mutation_rate=0.5, dispersal_rate=0.3)
+    selection = Selection(n_segments=2, segment_size=20, rng=1)
+    return Tumor(cancer_cell, selection, streams=1, grid_size=5, deme_params=dict(carrying_capacity=4))
+
+
+def test_deme_update():
+    streams = RandomStreams(3)
+    cancer_cell = CancerCell(n_segments=2, segment_size=20, division_rate=0.9, death_rate=0.3,
+                             mutation_rate=0.3, dispersal_rate=0.5)
+    selection = Selection(n_segments=2, segment_size=20, rng=streams.get("selection"))
+    tumor = Tumor(cancer_cell, selection, streams=streams, grid_size=5, deme_params=dict(carrying_capacity=4))
+    store = tumor.cells
+    deme = tumor.get_deme(2, 2)
+    neighbors = tumor.get_neighbors(deme.index).tolist()
+    cancer = CELL_TYPE_CODES["cancer"]
+    first = store.get_members(deme.index)[store.type[store.get_members(deme.index)] == cancer][0]
+    for _ in range(7):
+        deme.add_copy(first)
+
+    rng = streams.get("update", deme.index)
+    events = Counter()
+    for _ in range(50):
+        n_cancer = int(tumor.type_counts[deme.index, cancer])
+        n_total = int(tumor.type_counts[:, cancer].sum())
+        n_dispersed = int(tumor.type_counts[neighbors, cancer].sum())
+        n_clones = len(tumor.clones)
+        deme.update(rng=rng)
+        events["death"] += int(tumor.type_counts[deme.index, cancer]) < n_cancer
+        events["division"] += int(tumor.type_counts[:, cancer].sum()) > n_total
+        events["mutation"] += len(tumor.clones) > n_clones
+        events["dispersal"] += int(tumor.type_counts[neighbors, cancer].sum()) > n_dispersed
+
+        # The counts of the demes and the tumor agree with the rows in the store
+        n = len(store)
+        type_counts = tumor.normal_counts.copy()
+        np.add.at(type_counts, (store.deme[:n], store.type[:n]), 1)
+        assert np.array_equal(type_counts, tumor.type_counts)
+        normal_clones = [NORMAL_CLONES.get(celltype, -1) for celltype in CELL_TYPES]
+        for index in [deme.index] + neighbors:
+            members = store.get_members(index)
+            assert np.all(store.deme[members] == index)
+            assert np.all(store.slot[members] == np.arange(len(members)))
+            genotypes_counts = Counter(store.genotype[members].tolist())
+            for code in np.flatnonzero(tumor.normal_counts[index]).tolist():
+                genotypes_counts[normal_clones[code]] += int(tumor.normal_counts[index, code])
+            assert tumor.deme_list[index].genotypes_counts == genotypes_counts
+        genotypes_counts = Counter(store.genotype[:n].tolist())
+        for code in np.flatnonzero(tumor.normal_counts.sum(axis=0)).tolist():
+            genotypes_counts[normal_clones[code]] += int(tumor.normal_counts[:, code].sum())
+        assert tumor.genotypes_counts == genotypes_counts
+        if tumor.type_counts[deme.index, cancer] == 0:
+            break
+    assert all(events[event] > 0 for event in ["death", "division", "mutation", "dispersal"]), events
+
+
+def test_deme_view():
+    tumor = make_tumor()
+    store = tumor.cells
+    source = tumor.get_deme(2, 2)
+    target = tumor.get_neighbors(source.index)[0]
+    assert target not in tumor.deme_list.demes
+    cancer = source.cells[store.type[source.cells] == CELL_TYPE_CODES["cancer"]]
+    clone = int(store.genotype[cancer[0]])
+    n_clone = tumor.genotypes_counts[clone]
+
+    # The view is made after its deme got the rows, and counts them once
+    new_rows = store.copy_many(np.repeat(cancer, 3), np.full(3 * len(cancer), target))
+    tumor.deme_list[target].count_cells(store.genotype[new_rows], store.type[new_rows])
+    deme = tumor.deme_list[target]
+    normal_clones = [NORMAL_CLONES.get(celltype, -1) for celltype in CELL_TYPES]
+    genotypes_counts = Counter(store.genotype[deme.cells].tolist())
+    for code in np.flatnonzero(tumor.normal_counts[target]).tolist():
+        genotypes_counts[normal_clones[code]] += int(tumor.normal_counts[target, code])
+    assert deme.genotypes_counts == genotypes_counts
+    assert deme.genotypes_counts[clone] == 3 * len(cancer)
+    assert tumor.genotypes_counts[clone] == n_clone + 3 * len(cancer)
+    assert deme.n_cancer == 3 * len(cancer)
+
+    # Existing views follow the rows too
+    deme.remove_cell(new_rows[0])
+    assert deme.genotypes_counts[clone] == 3 * len(cancer) - 1
+
+
+def test_snapshot(tmp_path):
+    tumor, traces, _, _ = simulate_invasion(20, make_tumor(), seed=0)
+    save_snapshot(str(tmp_path / "snapshot.pkl.gz"), tumor=tumor, traces=traces)
+    tumor, traces, _, _ = simulate_invasion(20, tumor, traces=traces, seed=1)
+
+    state = load_snapshot(str(tmp_path / "snapshot.pkl.gz"))
+    resumed, resumed_traces, _, _ = simulate_invasion(20, state["tumor"], traces=state["traces"], seed=1)
+    assert resumed.genotypes_counts == tumor.genotypes_counts
+    assert np.array_equal(resumed.get_genotype_matrix(), tumor.get_genotype_matrix())
+    assert resumed_traces.get_frame().equals(traces.get_frame())
+
+
+def make_config():
+    return dict(
+        mode=1,
+        spatial_params=dict(grid_size=5),
+        deme_params=dict(carrying_capacity=4),
+        cell_params=dict(n_segments=2,
+                         cancer_params=dict(segment_size=20, division_rate=0.5, death_rate=0.1, mutation_rate=0.5, dispersal_rate=0.3),
+                         epithelial_params=dict(), stromal_params=dict(), immune_params=dict()),
+        selection_params=dict(segment_size=20),
+        treatment_params=dict(),
+    )
+
+
+def test_ensemble(tmp_path):
+    config = make_config()
+    seeds = get_replicate_seeds(0, 3)
+    assert len(set(seeds)) == 3
+
+    summaries, clone_sizes, quantiles, histogram = run_ensemble(config, 20, 3, random_seed=0, n_jobs=2, output_path=str(tmp_path))
+    assert list(summaries["replicate"]) == [0, 1, 2]
+    assert len(pd.read_csv(tmp_path / "ensemble_summary.csv")) == 3
+    assert histogram["n_clones"].sum() == len(clone_sizes)
+    assert np.all(clone_sizes.groupby("replicate")["count"].sum().values == summaries.loc[summaries["n_cells"] > 0, "n_cells"].values)
+
+    again, _, _, _ = run_ensemble(config, 20, 3, random_seed=0, n_jobs=1)
+    assert again.drop(columns="seconds").equals(summaries.drop(columns="seconds"))
+
+
+def test_sweep(tmp_path):
+    spec = dict(steps=10, replicates=2, random_seed=0,
+                axes={"deme_params.carrying_capacity": [2, 4], "cell_params.cancer_params.dispersal_rate": [0.1]})
+    jobs = expand_sweep(spec, make_config())
+    assert len(jobs) == 4
+    assert jobs[0]["config"]["deme_params"]["carrying_capacity"] == 2
+    assert jobs[0]["seeds"] == jobs[2]["seeds"]
+    assert len(set(job["key"] for job in jobs)) == 4
+
+    results, n_computed = run_sweep(spec, make_config(), str(tmp_path), n_jobs=1)
+    assert n_computed == 4
+    assert list(results["deme_params.carrying_capacity"]) == [2, 2, 4, 4]
+
+    spec["replicates"] = 3
+    extended, n_computed = run_sweep(spec, make_config(), str(tmp_path), n_jobs=1)
+    assert n_computed == 2
+    assert extended.set_index("key").loc[results["key"], "n_cells"].tolist() == results["n_cells"].tolist()
+
+
+def test_checkerboard():
+    results = []
+    for n_workers in [1, 2]:
+        tumor, _, _, _ = simulate_invasion(10, make_tumor(), seed=0, scheduler="checkerboard", n_workers=n_workers, domain_size=2)
+        n = len(tumor.cells)
+        for deme in tumor.deme_list:
+            assert np.all(tumor.cells.slot[deme.cells] == np.arange(deme.n_cells))
+        # The counts written back from shared memory agree with the store
+        store = tumor.cells
+        assert np.array_equal(np.bincount(store.deme[:n], minlength=tumor.n_demes), store.deme_size)
+        type_counts = tumor.normal_counts.copy()
+        np.add.at(type_counts, (store.deme[:n], store.type[:n]), 1)
+        assert np.array_equal(type_counts, tumor.type_counts)
+        assert sorted(tumor.active_demes) == np.flatnonzero(tumor.type_counts[:, 0] > 0).tolist()
+        results.append((tumor.cells.genotype[:n].copy(), tumor.cells.deme[:n].copy(), tumor.genotypes_counts))
+    assert results[0][2] == results[1][2]
+    assert np.array_equal(results[0][0], results[1][0])
+    assert np.array_equal(results[0][1], results[1][1])
+
+
+def test_neighbor_index():
+    indptr, indices = get_neighbor_index(4)
+    get = lambda i: sorted(indices[indptr[i] : indptr[i + 1]])
+    assert get(0) == [1, 4]
+    assert get(5) == [1, 4, 6, 9]
+
+    indptr, indices = get_neighbor_index(4, "moore")
+    assert get(0) == [1, 4, 5]
+    assert np.all(np.diff(indptr)[[5, 6, 9, 10]] == 8)
+
+    indptr, indices = get_neighbor_index(4, "hexagonal")
+    assert get(5) == [1, 2, 4, 6, 9, 10]
+    assert get(9) == [4, 5, 8, 10, 12, 13]
+
+    for topology, n in [("von_neumann", 4), ("moore", 8), ("hexagonal", 6)]:
+        indptr, indices = get_neighbor_index(4, topology, periodic=True)
+        assert np.all(np.diff(indptr) == n)
+        # Adjacency is symmetric
+        pairs = set(zip(np.repeat(np.arange(16), n), indices))
+        assert all((j, i) in pairs for i, j in pairs)
+
+
+def test_extinct_clones():
+    for scheduler in ["steps", "checkerboard"]:
+        tumor, _, _, _ = simulate_invasion(60, make_tumor(), seed=0, scheduler=scheduler, domain_size=2)
+        assert len(tumor.clones) > len(tumor.genotypes_counts)
+        # Only the live clones keep their prototypes, and prototypes don't hold their ancestors
+        prototypes = tumor.cells.prototypes
+        assert set(prototypes) == set(tumor.genotypes_counts) | set(NORMAL_CLONES.values())
+        assert all(cell.parent is None for cell in prototypes.values())
+
+
+def test_memory():
+    tumor = make_tumor()
+    memory = get_memory(tumor)
+    # A long lineage neither overflows the stack nor counts towards the cells
+    cell = tumor.cells.prototypes[len(NORMAL_CLONES)]
+    ancestor = cell
+    for _ in range(5000):
+        ancestor = ancestor.divide()
+    cell.parent = ancestor
+    assert get_memory(tumor)["cells"] <= memory["cells"]
+
+
+def test_active_demes():
+    tumor, _, _, _ = simulate_invasion(30, make_tumor(), seed=0)
+    active = [deme.index for deme in tumor.deme_list if deme.types_counts['cancer'] > 0]
+    assert sorted(tumor.active_demes) == active
+
+    frontier = [index for index in active
+                if any(tumor.deme_list[n].types_counts['cancer'] == 0 for n in tumor.get_neighbors(index))]
+    assert tumor.get_frontier().tolist() == frontier
+
+    s = IndexSet(5)
+    for item in [3, 1, 4]:
+        s.add(item)
+    s.remove(3)
+    assert len(s) == 2 and 3 not in s and sorted(s) == [1, 4]
+    assert sorted(s.sample(2, np.random.default_rng(0))) == [1, 4]
+
+
+def test_fission_boundary():
+    tumor, _, _, _ = simulate_fission(200, make_tumor(), seed=0, progress=False)
+    assert len(tumor.active_demes) > 1
+    for deme in tumor.deme_list:
+        assert np.all(tumor.cells.deme[deme.cells] == deme.index)
+        assert np.all(tumor.cells.slot[deme.cells] == np.arange(deme.n_cells))
+
+    tumor, _, _, _ = simulate_boundary(200, make_tumor(), seed=0, progress=False)
+    frontier = [index for index in tumor.active_demes
+                if any(n not in tumor.active_demes for n in tumor.get_neighbors(index))]
+    assert tumor.get_frontier().tolist() == sorted(frontier)
+
+    store = CellStore(3)
+    rows = [store.add(StromalCell(), deme) for deme in [0, 0, 0, 1]]
+    store.move_many(rows[:2], 2)
+    assert store.get_members(0).tolist() == [rows[2]] and store.get_members(2).tolist() == rows[:2]
+    assert store.slot[rows[2]] == 0 and store.deme[rows[0]] == 2
+    # Rows in and out of the tail of the source
+    kept = store.get_members(1).tolist()
+    rows = [store.add(StromalCell(), 1) for _ in range(5)]
+    store.move_many([rows[4], rows[0], rows[2]], 2)
+    members = store.get_members(1)
+    assert sorted(members.tolist()) == sorted(kept + [rows[1], rows[3]])
+    assert np.all(store.slot[members] == np.arange(3)) and np.all(store.deme[members] == 1)
+    assert store.get_members(2).tolist()[2:] == [rows[4], rows[0], rows[2]]
+
+
+def test_tumor3d():
+    voxels = VoxelGrid(10, "moore")
+    index = voxels.get_index(0, 0, 0)
+    assert voxels.n_neighbors[index] == 7 and len(voxels.get_neighbors(index)) == 7
+    assert voxels.get_index(1, 1, 1) in voxels.get_neighbors(index) and len(voxels) == 8
+    voxels = VoxelGrid(10, periodic=True)
+    assert len(voxels.get_neighbors(voxels.get_index(0, 0, 9))) == 6
+    assert voxels.get_index(9, 0, 9) in voxels.get_neighbors(0)
+
+    cancer_cell = CancerCell(n_segments=2, segment_size=20, division_rate=0.5, death_rate=0.1,
+                             mutation_rate=0.5, dispersal_rate=0.3)
+    selection = Selection(n_segments=2, segment_size=20, rng=1)
+    tumor = Tumor3D(cancer_cell, selection, streams=1, grid_size=1000, deme_params=dict(carrying_capacity=4))
+    tumor, _, _, _ = simulate_invasion(100, tumor, seed=0, progress=False)
+    active = [deme.index for deme in tumor.deme_list if deme.n_cancer > 0]
+    assert len(active) > 1 and sorted(tumor.active_demes) == active
+    assert tumor.get_frontier().tolist() == [index for index in active
+                                             if any(n not in tumor.active_demes for n in tumor.get_neighbors(index))]
+    assert np.all(tumor.get_coords(0) == 500)
+
+    in_section, crd = get_section(tumor.get_coords(np.arange(tumor.n_demes)), 0, 500)
+    grid = tumor.get_genotype_matrix("x=500")
+    assert grid.shape == (1000, 1000)
+    occupied = [index for index in np.flatnonzero(in_section) if tumor.deme_list[index].n_cells > 0]
+    assert (grid >= 0).sum() == len(occupied)
+
+
+def test_normal_counts(tmp_path):
+    capacity = np.ones((10, 10))
+    capacity[:, 5:] = 2
+    np.save(tmp_path / "capacity.npy", capacity)
+    cancer_cell = CancerCell(n_segments=2, segment_size=20)
+    tumor = Tumor(cancer_cell, Selection(n_segments=2, segment_size=20, rng=0), streams=0, grid_size=10, structure_radius=3,
+                  deme_params=dict(carrying_capacity=str(tmp_path / "capacity.npy")))
+    assert np.array_equal(tumor.get_deme_map("carrying_capacity"), capacity)
+
+    # Only the cancer cell's deme has rows for its normal cells
+    cancer_deme = tumor.cells.deme[0]
+    assert len(tumor.cells) == 1 + tumor.type_counts[cancer_deme, 1:].sum()
+    assert tumor.genotypes_counts[NORMAL_CLONES["stromal"]] == capacity[tumor.structure_labels == 0].sum()
+    assert tumor.deme_list[99].n_cells == 2 and len(tumor.deme_list[99].cells) == 0
+
+    cell_data = tumor.get_cell_data()
+    assert len(cell_data["cell_ids"]) == sum(tumor.genotypes_counts.values())
+    demes, clones, counts = tumor.get_deme_genotype_counts()
+    assert np.array_equal(np.bincount(demes, weights=counts, minlength=tumor.n_demes), tumor.type_counts.sum(axis=1))
+    assert np.all(counts > 0) and np.all(np.diff(demes) >= 0)
+
+
+def test_structure_labels():
+    labels = get_disk_labels(12, [(3, 3), (8, 8)], [2, 3])
+    assert set(np.unique(labels)) == {0, 1, 2}
+    assert labels[3, 3] == 1 and labels[3, 5] == 1 and labels[3, 6] == 0
+    borders = get_borders(labels)
+    assert borders[3, 5] and not borders[3, 3]
+    rims = get_inner_rims(labels)
+    assert rims[3, 4] and not rims[3, 3] and not np.any(rims & borders)
+
+    cancer_cell = CancerCell(n_segments=2, segment_size=20)
+    tumor = Tumor(cancer_cell, Selection(n_segments=2, segment_size=20, rng=0), streams=0, grid_size=12, structure_labels=labels)
+    assert tumor.genotypes_counts[NORMAL_CLONES["epithelial"]] == borders.sum()
+    assert tumor.genotypes_counts[NORMAL_CLONES["stromal"]] == np.sum(labels == 0)
+    assert labels.ravel()[tumor.cells.deme[0]] == 1
+
+
+def test_random_streams():
+    # A deme's numbers don't depend on the other demes' draws
+    streams = RandomStreams(7)
+    first = [streams.get("update", 3).random() for _ in range(3)]
+    other = RandomStreams(7)
+    other.get("update", 5).random()
+    other.get("schedule").choice(10, size=3, replace=False)
+    assert [other.get("update", 3).random() for _ in range(3)] == first
+    assert streams.get("update", 3, use=1).random() == first[1]
+    assert len(set(first)) == 3 and RandomStreams(8).get("update", 3).random() != first[0]
+
+    rng = streams.get("mutation", 0)
+    draws = [rng.random() for _ in range(2000)]
+    assert len(set(draws)) == 2000 and abs(np.mean(draws) - 0.5) < 0.05
+    assert rng.choice(["a", "b"], p=[0., 1.]) == "b" and 0 <= rng.integers(3) < 3